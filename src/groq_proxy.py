@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, make_response, g
 import requests
 import os
 import json
@@ -12,20 +12,36 @@ import time
 import uuid
 import random
 import traceback
-from cachetools import TTLCache  # Add this import
+import threading
+import queue
+import functools
+import hashlib
+import zlib
+import atexit
+import sqlite3
+import re
+import socket
+from collections import deque
+from cachetools import Cache, TLRUCache  # Add this import
+
+try:
+    import numpy as np  # Optional, only needed for the semantic cache
+except ImportError:
+    np = None
 
 # Logging configuration
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 LOG_RAW_DATA = os.environ.get("LOG_RAW_DATA", "1") == "1"  # Set to "0" to disable raw data logging
 MAX_CHUNKS_TO_LOG = int(os.environ.get("MAX_CHUNKS_TO_LOG", "20"))  # Maximum number of chunks to log
 LOG_TRUNCATE_LENGTH = int(os.environ.get("LOG_TRUNCATE_LENGTH", "1000"))  # Length to truncate logs
+LOG_FILE = os.environ.get("LOG_FILE", "proxy.log")  # File the log is written to, besides the console
 
 # Configure logging
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler("proxy.log"),
+        logging.FileHandler(LOG_FILE),
         logging.StreamHandler()
     ]
 )
@@ -102,6 +118,10 @@ CORS(app,
 
 # Groq API key - replace with your actual key or set as environment variable
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "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")
+# Optional extra keys (comma-separated); requests are spread across all of them
+GROQ_API_KEYS = list(dict.fromkeys(
+    key.strip() for key in [GROQ_API_KEY] + os.environ.get("GROQ_API_KEYS", "").split(",") if key.strip()
+))
 
 # OpenAI API endpoints that we'll intercept
 OPENAI_CHAT_ENDPOINT = "/v1/chat/completions"
@@ -121,16 +141,643 @@ MODEL_MAPPING = {
     # Add more mappings as needed
 }
 
+# Model capabilities - context window and output limits are checked locally before a request is sent
+MODEL_CAPABILITIES = {
+    "qwen-2.5-coder-32b": {"context_window": 131072, "max_output": 8192, "streaming": True, "tools": True},
+    "deepseek-r1-distill-qwen-32b": {"context_window": 131072, "max_output": 16384, "streaming": True, "tools": True},
+    "mixtral-8x7b-32768": {"context_window": 32768, "max_output": 32768, "streaming": True, "tools": True},
+    "llama3-70b-8192": {"context_window": 8192, "max_output": 8192, "streaming": True, "tools": True},
+    "llama3-8b-8192": {"context_window": 8192, "max_output": 8192, "streaming": True, "tools": True}
+}
+# Override or add capabilities (JSON format), e.g. {"my-model": {"context_window": 65536, "max_output": 4096}}
+try:
+    for capability_model, capability_overrides in json.loads(os.environ.get("MODEL_CAPABILITIES", "{}")).items():
+        MODEL_CAPABILITIES[capability_model] = {
+            **MODEL_CAPABILITIES.get(capability_model, {"context_window": 8192, "max_output": 4096, "streaming": True, "tools": False}),
+            **capability_overrides
+        }
+except (json.JSONDecodeError, AttributeError):
+    logger.warning("Failed to parse MODEL_CAPABILITIES environment variable. Using built-in capabilities.")
+CONTEXT_ROUTING_ENABLED = os.environ.get("CONTEXT_ROUTING_ENABLED", "1") == "1"  # Clamp or reroute prompts that do not fit
+CONTEXT_MIN_OUTPUT_TOKENS = int(os.environ.get("CONTEXT_MIN_OUTPUT_TOKENS", "256"))  # Room for output a model must have left
+
+# Repetition abort - stop streams that loop on their own output or re-emit an earlier response
+REPETITION_ABORT_ENABLED = os.environ.get("REPETITION_ABORT_ENABLED", "1") == "1"
+REPETITION_HISTORY_RESPONSES = 3  # Recent assistant messages of the conversation compared against
+# Per model: n-gram size in words, and how many words in a row may repeat this response (loop_words)
+# or an earlier one (echo_words) before the stream is stopped; 0 turns a check off. The echo check
+# is off by default: re-emitting a whole file after a small edit is a normal answer
+REPETITION_LIMITS = {
+    "default": {"ngram": 8, "loop_words": 150, "echo_words": 0}
+}
+try:
+    for repetition_model, repetition_overrides in json.loads(os.environ.get("REPETITION_LIMITS", "{}")).items():
+        REPETITION_LIMITS[repetition_model] = {**REPETITION_LIMITS.get(repetition_model, REPETITION_LIMITS["default"]), **repetition_overrides}
+except (json.JSONDecodeError, AttributeError):
+    logger.warning("Failed to parse REPETITION_LIMITS environment variable. Using default limits.")
+REPETITION_ABORT_MESSAGES = {
+    "loop": "\n\n[Response stopped: the model started repeating itself.]",
+    "echo": "\n\n[Response stopped: the model was repeating an earlier response from this conversation.]"
+}
+
+# Cache memory configuration - caches are bounded by bytes rather than item count
+CACHE_MEMORY_BUDGET_MB = int(os.environ.get("CACHE_MEMORY_BUDGET_MB", "64"))  # Global budget shared by all caches
+CACHE_COMPRESS_THRESHOLD = int(os.environ.get("CACHE_COMPRESS_THRESHOLD", "1024"))  # Compress values larger than this (bytes)
+CACHE_KEY_HASH_THRESHOLD = int(os.environ.get("CACHE_KEY_HASH_THRESHOLD", "256"))  # Hash keys longer than this (chars)
+CACHE_ENTRY_OVERHEAD = 64  # Approximate bookkeeping bytes per cache entry
+CACHE_DISK_PATH = os.environ.get("CACHE_DISK_PATH", "")  # SQLite file for the persistent cache tier (empty disables it)
+CACHE_DISK_MAX_MB = int(os.environ.get("CACHE_DISK_MAX_MB", "256"))  # Maximum size of the persistent cache tier
+CACHE_DISK_COMPACT_INTERVAL = int(os.environ.get("CACHE_DISK_COMPACT_INTERVAL", "300"))  # Seconds between compactions
+CACHE_DISK_FLUSH_INTERVAL = float(os.environ.get("CACHE_DISK_FLUSH_INTERVAL", "1"))  # Seconds between batched writes to the persistent tier
+
+class CacheEntry:
+    """A cached value in its stored (possibly compressed) form"""
+    __slots__ = ("encoding", "payload", "size", "raw_size", "expires")
+
+    def __init__(self, encoding, payload, size, raw_size, expires=None):
+        self.encoding = encoding
+        self.payload = payload
+        self.size = size
+        self.raw_size = raw_size
+        self.expires = expires  # Explicit expiry (cache timer) for entries restored from disk
+
+class CacheMemoryBudget:
+    """Global byte budget shared by every ByteBudgetCache registered with it"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.caches = []
+        self.lock = threading.Lock()
+
+    def register(self, cache):
+        self.caches.append(cache)
+
+    def used_bytes(self):
+        return sum(cache.used_bytes() for cache in self.caches)
+
+    def enforce(self):
+        """Evict least recently used entries from the largest caches until usage fits the budget"""
+        with self.lock:
+            while self.used_bytes() > self.max_bytes:
+                largest = max(self.caches, key=lambda cache: cache.used_bytes())
+                if not largest.evict_one():
+                    break
+
+class DiskCacheTier:
+    """
+    Optional SQLite-backed second tier behind the in-memory caches
+
+    Entries are written through in their stored (compressed) form with an
+    absolute expiry time, so they survive restarts. Writes, deletes and
+    access times are queued and committed in one transaction every
+    CACHE_DISK_FLUSH_INTERVAL seconds by a background thread, so setting a
+    cache entry never waits on SQLite; reads see queued writes. Values are
+    stored as text, bytes or JSON and nothing read back is unpickled.
+    Compaction drops expired rows and trims the least recently accessed rows
+    once the store grows beyond its byte limit.
+    """
+
+    def __init__(self, path, max_bytes, compact_interval, flush_interval=CACHE_DISK_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compact_interval = compact_interval
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # (cache, key) -> row to write, or None to delete; guarded by pending_lock
+        self.pending = {}
+        self.pending_access = {}
+        self.pending_lock = threading.Lock()
+        # Persistent caches by name, told which keys compaction removed
+        self.caches = {}
+        self.last_compaction = 0
+        self.compactions = 0
+        self.flushes = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    cache TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    encoding TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    raw_size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (cache, key)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed)")
+            # Older versions pickled some values; drop those rows rather than ever unpickling them
+            self.conn.execute("DELETE FROM cache_entries WHERE encoding IN ('pickle', 'zlib-pickle')")
+            self.conn.commit()
+        self.compact()
+        threading.Thread(target=self.writer, daemon=True).start()
+        atexit.register(self.flush)
+
+    def register(self, cache):
+        self.caches[cache.name] = cache
+
+    def put(self, cache_name, key, entry, ttl):
+        """
+        Queue an entry to be written to disk with an absolute expiry time
+
+        Returns:
+        bool: False if the value has no text, bytes or JSON form and stays in memory only
+        """
+        encoding, payload = entry.encoding, entry.payload
+        if encoding == "raw":
+            # Raw in-memory values are converted to bytes for storage
+            if isinstance(payload, str):
+                encoding, payload = "str", payload.encode("utf-8")
+            else:
+                try:
+                    encoding, payload = "json", json.dumps(payload).encode("utf-8")
+                except (TypeError, ValueError):
+                    return False
+        now = time.time()
+        with self.pending_lock:
+            self.pending[(cache_name, key)] = (cache_name, key, encoding, payload, entry.size, entry.raw_size, now + ttl, now)
+        return True
+
+    def get(self, cache_name, key):
+        """Return (entry, remaining_ttl) for a live entry, or None"""
+        now = time.time()
+        with self.pending_lock:
+            queued = (cache_name, key) in self.pending
+            row = self.pending.get((cache_name, key))
+        if row is not None:
+            encoding, payload, size, raw_size, expires = row[2:7]
+        elif not queued:
+            try:
+                with self.lock:
+                    row = self.conn.execute(
+                        "SELECT encoding, payload, size, raw_size, expires FROM cache_entries "
+                        "WHERE cache = ? AND key = ?",
+                        (cache_name, key)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                logger.error(f"Disk cache read failed for '{cache_name}': {str(e)}")
+                return None
+            if row is not None:
+                encoding, payload, size, raw_size, expires = row
+        with self.pending_lock:
+            if row is None or expires <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pending_access[(cache_name, key)] = now
+        return CacheEntry(encoding, payload, size, raw_size), expires - now
+
+    def delete(self, cache_name, key):
+        """Queue an entry's removal from disk"""
+        with self.pending_lock:
+            self.pending[(cache_name, key)] = None
+            self.pending_access.pop((cache_name, key), None)
+
+    def writer(self):
+        # Background thread that commits queued writes in batches and runs compaction
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            self.maybe_compact()
+
+    def flush(self):
+        """Commit queued writes, deletes and access times in one transaction"""
+        # Taking the queue and writing it under one lock keeps a later delete from being overwritten
+        with self.lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, {}
+                accessed, self.pending_access = self.pending_access, {}
+            if not pending and not accessed:
+                return
+            try:
+                self.conn.executemany(
+                    "DELETE FROM cache_entries WHERE cache = ? AND key = ?",
+                    [entry_key for entry_key, row in pending.items() if row is None]
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [row for row in pending.values() if row is not None]
+                )
+                self.conn.executemany(
+                    "UPDATE cache_entries SET accessed = ? WHERE cache = ? AND key = ?",
+                    [(when, cache_name, key) for (cache_name, key), when in accessed.items()]
+                )
+                self.conn.commit()
+                self.flushes += 1
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logger.error(f"Disk cache write of {len(pending)} entries failed: {str(e)}")
+
+    def load(self, cache_name):
+        """Return live (key, entry, remaining_ttl) rows, least recently accessed first"""
+        self.flush()
+        now = time.time()
+        try:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT key, encoding, payload, size, raw_size, expires FROM cache_entries "
+                    "WHERE cache = ? AND expires > ? ORDER BY accessed",
+                    (cache_name, now)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Disk cache load failed for '{cache_name}': {str(e)}")
+            return []
+        return [(key, CacheEntry(encoding, payload, size, raw_size), expires - now)
+                for key, encoding, payload, size, raw_size, expires in rows]
+
+    def maybe_compact(self):
+        if time.time() - self.last_compaction >= self.compact_interval:
+            self.compact()
+
+    def compact(self):
+        """Drop expired rows, then the least recently accessed rows until the store fits max_bytes"""
+        self.flush()
+        try:
+            with self.lock:
+                now = time.time()
+                self.last_compaction = now
+                removed = self.conn.execute("SELECT cache, key FROM cache_entries WHERE expires <= ?", (now,)).fetchall()
+                expired = len(removed)
+                self.conn.execute("DELETE FROM cache_entries WHERE expires <= ?", (now,))
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+                trimmed = 0
+                if total > self.max_bytes:
+                    rows = self.conn.execute("SELECT cache, key, size FROM cache_entries ORDER BY accessed").fetchall()
+                    victims = []
+                    for cache_name, key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        victims.append((cache_name, key))
+                        total -= size
+                    self.conn.executemany("DELETE FROM cache_entries WHERE cache = ? AND key = ?", victims)
+                    trimmed = len(victims)
+                    removed.extend(victims)
+                self.conn.commit()
+                self.conn.execute("PRAGMA incremental_vacuum")
+                self.compactions += 1
+            self.forget(removed)
+            if expired or trimmed:
+                logger.info(f"Disk cache compaction removed {expired} expired and {trimmed} least recently used entries")
+        except sqlite3.Error as e:
+            logger.error(f"Disk cache compaction failed: {str(e)}")
+
+    def forget(self, removed):
+        """Drop compacted rows from their caches' disk key sets, unless they were written again since"""
+        with self.pending_lock:
+            removed = [entry_key for entry_key in removed if entry_key not in self.pending]
+        for cache_name, key in removed:
+            cache = self.caches.get(cache_name)
+            if cache is not None:
+                cache.disk_keys.discard(key)
+
+    def stats(self):
+        try:
+            with self.lock:
+                entries, size = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+                ).fetchone()
+        except sqlite3.Error as e:
+            return {"path": self.path, "error": str(e)}
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "pending_writes": len(self.pending),
+            "flushes": self.flushes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "compactions": self.compactions
+        }
+
+# Persistent second cache tier, enabled by setting CACHE_DISK_PATH
+disk_cache_tier = None
+if CACHE_DISK_PATH:
+    try:
+        disk_cache_tier = DiskCacheTier(CACHE_DISK_PATH, CACHE_DISK_MAX_MB * 1024 * 1024, CACHE_DISK_COMPACT_INTERVAL)
+        logger.info(f"Persistent cache tier enabled at {CACHE_DISK_PATH}")
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open persistent cache tier at {CACHE_DISK_PATH}: {str(e)}")
+
+class ByteBudgetCache(TLRUCache):
+    """
+    TTL cache bounded by bytes instead of item count
+
+    Eviction is least-recently-used weighted by entry size. Keys longer than
+    CACHE_KEY_HASH_THRESHOLD are replaced by a SHA-256 digest and values larger
+    than CACHE_COMPRESS_THRESHOLD are stored zlib-compressed, so multi-megabyte
+    Cursor payloads cost a fraction of their raw size. Persistent caches write
+    through to the disk tier, fall back to it on a miss and are warmed from it
+    at startup. Keys known to be on disk are tracked in memory, so a miss on
+    any other key never touches SQLite.
+    """
+
+    def __init__(self, name, max_bytes, ttl, budget=None, persistent=False):
+        super().__init__(maxsize=max_bytes, ttu=self.entry_expiry, getsizeof=lambda entry: entry.size)
+        self.name = name
+        self.ttl = ttl
+        self.budget = budget
+        self.disk = disk_cache_tier if persistent else None
+        self.lock = threading.RLock()
+        self.evicting = False
+        self.evictions = 0
+        self.rejected = 0
+        # Keys written to or loaded from the disk tier, pruned when compaction removes their rows;
+        # anything else is a miss without a disk lookup
+        self.disk_keys = set()
+        if budget is not None:
+            budget.register(self)
+        if self.disk is not None:
+            self.disk.register(self)
+            self.warm_from_disk()
+
+    def entry_expiry(self, key, entry, now):
+        return entry.expires if entry.expires is not None else now + self.ttl
+
+    @staticmethod
+    def storage_key(key):
+        """Replace oversized string keys with a fixed-size digest"""
+        if isinstance(key, str) and len(key) > CACHE_KEY_HASH_THRESHOLD:
+            return "sha256:" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return key
+
+    @staticmethod
+    def encode_value(value):
+        """Convert a value to a CacheEntry, compressing it if it is large"""
+        if isinstance(value, str):
+            encoding, data = "str", value.encode("utf-8")
+        elif isinstance(value, bytes):
+            encoding, data = "bytes", value
+        elif value is None or isinstance(value, (bool, int, float)):
+            return CacheEntry("raw", value, sys.getsizeof(value), sys.getsizeof(value))
+        else:
+            try:
+                encoding, data = "json", json.dumps(value).encode("utf-8")
+            except (TypeError, ValueError):
+                # Objects without a JSON form are stored as-is with an estimated size
+                return CacheEntry("raw", value, sys.getsizeof(value), sys.getsizeof(value))
+
+        if len(data) >= CACHE_COMPRESS_THRESHOLD:
+            compressed = zlib.compress(data, 6)
+            if len(compressed) < len(data):
+                return CacheEntry("zlib-" + encoding, compressed, len(compressed), len(data))
+        if encoding == "str":
+            return CacheEntry("raw", value, len(data), len(data))
+        return CacheEntry(encoding, data, len(data), len(data))
+
+    @staticmethod
+    def decode_value(entry):
+        """Restore the original value from a CacheEntry"""
+        encoding, payload = entry.encoding, entry.payload
+        if encoding == "raw":
+            return payload
+        if encoding.startswith("zlib-"):
+            payload = zlib.decompress(payload)
+            encoding = encoding[len("zlib-"):]
+        if encoding == "str":
+            return payload.decode("utf-8")
+        if encoding == "json":
+            return json.loads(payload)
+        return payload
+
+    def __getitem__(self, key):
+        storage_key = self.storage_key(key)
+        try:
+            with self.lock:
+                entry = super().__getitem__(storage_key)
+                if self.evicting:
+                    # popitem() reads the entry it evicts; decoding it would be thrown away
+                    return entry
+        except KeyError:
+            if not self.promote(storage_key):
+                raise
+            with self.lock:
+                entry = super().__getitem__(storage_key)
+        return self.decode_value(entry)
+
+    def __setitem__(self, key, value):
+        storage_key = self.storage_key(key)
+        entry = self.encode_value(value)
+        key_size = len(storage_key) if isinstance(storage_key, str) else sys.getsizeof(storage_key)
+        entry.size += key_size + CACHE_ENTRY_OVERHEAD
+        try:
+            with self.lock:
+                super().__setitem__(storage_key, entry)
+        except ValueError:
+            # Entry is larger than the whole cache; skip it rather than flushing everything
+            self.rejected += 1
+            logger.warning(f"Cache '{self.name}': entry of {entry.size} bytes exceeds cache size, not cached")
+        else:
+            if self.budget is not None:
+                self.budget.enforce()
+        if self.disk is not None and isinstance(storage_key, str):
+            if self.disk.put(self.name, storage_key, entry, self.ttl):
+                self.disk_keys.add(storage_key)
+
+    def __delitem__(self, key):
+        storage_key = self.storage_key(key)
+        with self.lock:
+            # Memory evictions keep the disk copy; explicit deletes remove both
+            if self.disk is not None and not self.evicting and isinstance(storage_key, str):
+                self.disk.delete(self.name, storage_key)
+                self.disk_keys.discard(storage_key)
+                if not super().__contains__(storage_key):
+                    return
+            super().__delitem__(storage_key)
+
+    def __contains__(self, key):
+        storage_key = self.storage_key(key)
+        with self.lock:
+            if super().__contains__(storage_key):
+                return True
+        return self.promote(storage_key)
+
+    def popitem(self):
+        """Evict the least recently used entry, returning its stored (undecoded) CacheEntry"""
+        with self.lock:
+            self.evicting = True
+            try:
+                key, value = super().popitem()
+            finally:
+                self.evicting = False
+            self.evictions += 1
+            return key, value
+
+    def promote(self, storage_key):
+        """Load an entry from the disk tier into memory, returning True if found"""
+        if self.disk is None or storage_key not in self.disk_keys:
+            return False
+        found = self.disk.get(self.name, storage_key)
+        if found is None:
+            # Expired or compacted away
+            self.disk_keys.discard(storage_key)
+            return False
+        entry, remaining = found
+        self.insert_restored(storage_key, entry, remaining)
+        return True
+
+    def insert_restored(self, storage_key, entry, remaining):
+        """Insert a disk entry into memory, keeping its remaining TTL"""
+        try:
+            with self.lock:
+                entry.expires = self.timer() + remaining
+                super().__setitem__(storage_key, entry)
+        except ValueError:
+            self.rejected += 1
+            return
+        if self.budget is not None:
+            self.budget.enforce()
+
+    def warm_from_disk(self):
+        """Fill the memory tier from disk at startup so a restart does not start cold"""
+        rows = self.disk.load(self.name)
+        for storage_key, entry, remaining in rows:
+            self.disk_keys.add(storage_key)
+            self.insert_restored(storage_key, entry, remaining)
+        if rows:
+            logger.info(f"Cache '{self.name}': warmed {len(rows)} entries from disk")
+
+    def evict_one(self):
+        """Evict the least recently used entry, returning False if the cache is empty"""
+        try:
+            self.popitem()
+            return True
+        except KeyError:
+            return False
+
+    def used_bytes(self):
+        with self.lock:
+            return self.currsize
+
+    def stats(self):
+        """Return entry count and byte usage for reporting on /debug and /health"""
+        with self.lock:
+            self.expire()
+            entries = [Cache.__getitem__(self, key) for key in list(Cache.__iter__(self))]
+            return {
+                "entries": len(entries),
+                "bytes": self.currsize,
+                "max_bytes": self.maxsize,
+                "raw_bytes": sum(entry.raw_size for entry in entries),
+                "compressed_entries": sum(1 for entry in entries if entry.encoding.startswith("zlib-")),
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+                "ttl": self.ttl
+            }
+
+# One memory budget shared by every cache in the process
+cache_memory_budget = CacheMemoryBudget(CACHE_MEMORY_BUDGET_MB * 1024 * 1024)
+
+def get_cache_stats():
+    """Collect byte usage for every cache sharing the global budget"""
+    return {
+        "budget_bytes": cache_memory_budget.max_bytes,
+        "used_bytes": cache_memory_budget.used_bytes(),
+        "caches": {cache.name: cache.stats() for cache in cache_memory_budget.caches},
+        "disk": disk_cache_tier.stats() if disk_cache_tier is not None else None
+    }
+
 # Create a TTL cache for request deduplication (5 second TTL)
-request_cache = TTLCache(maxsize=1000, ttl=5)
+request_cache = ByteBudgetCache("request_cache", max_bytes=16 * 1024 * 1024, ttl=5, budget=cache_memory_budget)
 
 # Initialize a cache for storing R1 reasoning results
 # TTL of 1800 seconds (30 minutes) should be sufficient for a conversation
-r1_reasoning_cache = TTLCache(maxsize=100, ttl=1800)
+r1_reasoning_cache = ByteBudgetCache("r1_reasoning_cache", max_bytes=32 * 1024 * 1024, ttl=1800, budget=cache_memory_budget, persistent=True)
 
 # Add at the top with other constants
 GROQ_TIMEOUT = 120  # 120 seconds timeout for Groq API calls
+# Request deadlines - the time a client will wait bounds every upstream hop made for it
+DEADLINE_HEADER = "X-Request-Timeout"  # Seconds the client is willing to wait
+DEADLINE_MAX = float(os.environ.get("DEADLINE_MAX", "600"))  # Upper bound on a client-supplied deadline
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10"))  # Connect timeout per upstream hop
+# Default deadline in seconds per route ("chat", "simple", "agent", "direct") or model name
+ROUTE_DEADLINES = {"chat": 120, "simple": 120, "agent": 180, "direct": 60, "r1sonqwen": 240}
+try:
+    ROUTE_DEADLINES.update(json.loads(os.environ.get("ROUTE_DEADLINES", "{}")))
+except (json.JSONDecodeError, TypeError, ValueError):
+    logger.warning("Failed to parse ROUTE_DEADLINES environment variable. Using default deadlines.")
+R1_STAGE_RESERVE = float(os.environ.get("R1_STAGE_RESERVE", "45"))  # Seconds kept back for the Qwen stage of r1sonqwen
+R1_MIN_SECONDS = float(os.environ.get("R1_MIN_SECONDS", "10"))  # Reasoning is skipped if it would get less time than this
 MAX_RETRIES = 3    # Maximum number of retries for failed requests
+STREAM_CONTINUATION_ENABLED = os.environ.get("STREAM_CONTINUATION_ENABLED", "1") == "1"  # Resume streams that drop mid-response
+STREAM_CONTINUATION_MAX_ATTEMPTS = int(os.environ.get("STREAM_CONTINUATION_MAX_ATTEMPTS", "2"))  # Continuations per response
+
+# Circuit breakers and retry budget for upstream calls
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "1") == "1"  # Fail fast while an upstream is degraded
+CIRCUIT_BREAKER_WINDOW = int(os.environ.get("CIRCUIT_BREAKER_WINDOW", "60"))  # Seconds of call outcomes used for the error rate
+CIRCUIT_BREAKER_MIN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_MIN_CALLS", "5"))  # Calls in the window before a breaker can open
+CIRCUIT_BREAKER_ERROR_RATE = float(os.environ.get("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))  # Failure ratio that opens a breaker
+CIRCUIT_BREAKER_SLOW_CALL = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL", "30"))  # Seconds to first byte counted as a failure
+CIRCUIT_BREAKER_COOLDOWN = int(os.environ.get("CIRCUIT_BREAKER_COOLDOWN", "30"))  # Seconds a breaker stays open before trial calls
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_HALF_OPEN_CALLS", "1"))  # Trial calls allowed while half-open
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", "0.2"))  # Retries allowed as a fraction of live requests
+RETRY_BUDGET_MIN_PER_SECOND = float(os.environ.get("RETRY_BUDGET_MIN_PER_SECOND", "0.5"))  # Retries always allowed at low traffic
+RETRY_BUDGET_WINDOW = 10  # Seconds of traffic the retry budget is computed over
+
+# Rate-limit admission: pace requests from Groq's x-ratelimit-* headers instead of discovering limits through 429s
+RATE_LIMIT_ADMISSION_ENABLED = os.environ.get("RATE_LIMIT_ADMISSION_ENABLED", "1") == "1"
+RATE_LIMIT_MAX_QUEUE_WAIT = float(os.environ.get("RATE_LIMIT_MAX_QUEUE_WAIT", "10"))  # Longest a request is held before being rejected
+RATE_LIMIT_DEFAULT_RETRY_AFTER = 1  # Seconds to hold requests after a 429 without a retry-after header
+
+# API key pool - keys come from GROQ_API_KEY and GROQ_API_KEYS
+KEY_EJECT_AUTH_SECONDS = int(os.environ.get("KEY_EJECT_AUTH_SECONDS", "300"))  # How long a key answering 401 is left out
+KEY_EJECT_RATE_LIMIT_SECONDS = int(os.environ.get("KEY_EJECT_RATE_LIMIT_SECONDS", "30"))  # Default ejection after a 429 without retry-after
+# Rate-limit headers that report a key's remaining budget (OpenAI/Groq style, then Anthropic)
+KEY_POOL_TOKEN_HEADERS = ["x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining"]
+KEY_POOL_REQUEST_HEADERS = ["x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining"]
+
+# Priority lanes - admission scheduler shared by all completion routes
+# Off by default: before enabling, set ADMISSION_MAX_CONCURRENCY to the concurrency your Groq
+# rate-limit tier sustains, roughly requests per minute / 60 * average request duration in seconds
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "0") == "1"
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "8"))  # Requests in flight upstream at once
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "30"))  # Longest a request waits for a slot before being rejected
+WAITRESS_THREADS = int(os.environ.get("WAITRESS_THREADS", "32"))  # Server threads; must exceed ADMISSION_MAX_CONCURRENCY so requests can queue
+# Per class: weight for fair dequeueing, slots reserved for the class, and queue length limit
+PRIORITY_CLASSES = {
+    "interactive": {"weight": 6, "reserved": 2, "max_queue": 64},
+    "agent": {"weight": 3, "reserved": 1, "max_queue": 64},
+    "bulk": {"weight": 1, "reserved": 0, "max_queue": 128}
+}
+try:
+    for class_name, class_overrides in json.loads(os.environ.get("PRIORITY_CLASSES", "{}")).items():
+        PRIORITY_CLASSES[class_name] = {**PRIORITY_CLASSES.get(class_name, {"weight": 1, "reserved": 0, "max_queue": 64}), **class_overrides}
+except (json.JSONDecodeError, AttributeError):
+    logger.warning("Failed to parse PRIORITY_CLASSES environment variable. Using default priority classes.")
+# Class per route, overridden by a model entry in PRIORITY_MODEL_CLASSES, overridden by the X-Priority header
+PRIORITY_ROUTE_CLASSES = {"chat": "interactive", "simple": "interactive", "agent": "agent", "direct": "bulk"}
+try:
+    PRIORITY_MODEL_CLASSES = json.loads(os.environ.get("PRIORITY_MODEL_CLASSES", "{}"))  # e.g. {"r1sonqwen": "bulk"}
+except json.JSONDecodeError:
+    logger.warning("Failed to parse PRIORITY_MODEL_CLASSES environment variable. Ignoring it.")
+    PRIORITY_MODEL_CLASSES = {}
+PRIORITY_HEADER = "X-Priority"
+# Per-client fairness - clients are identified by IP ("ip"), or by bearer token ("auto") when every
+# user has a key of their own; a token shared by several users would make them one client
+CLIENT_IDENTITY = os.environ.get("CLIENT_IDENTITY", "ip")
+CLIENT_MAX_CONCURRENCY = int(os.environ.get("CLIENT_MAX_CONCURRENCY", "0"))  # Slots one client may hold at once (0 = unlimited)
+CLIENT_MAX_QUEUE = int(os.environ.get("CLIENT_MAX_QUEUE", "16"))  # Requests one client may have waiting
+CLIENT_DRR_TOKENS_PER_TURN = int(os.environ.get("CLIENT_DRR_TOKENS_PER_TURN", "4000"))  # Prompt tokens that cost one extra round-robin turn
+
+# Supersede-and-cancel - a newer request in the same conversation cancels the older in-flight stream
+SUPERSEDE_ENABLED = os.environ.get("SUPERSEDE_ENABLED", "1") == "1"
+SUPERSEDE_DEBOUNCE = float(os.environ.get("SUPERSEDE_DEBOUNCE", "0"))  # Seconds to hold a request in case a newer one replaces it
+
+# SSE heartbeats - send the role delta at once and comment lines while upstream is silent
+HEARTBEAT_ENABLED = os.environ.get("HEARTBEAT_ENABLED", "1") == "1"
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "5"))  # Seconds of silence before a keep-alive comment is sent
+# SSE coalescing - events arriving together after the first token are sent in one write
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "1") == "1"
+COALESCE_WINDOW_MS = float(os.environ.get("COALESCE_WINDOW_MS", "15"))  # Longest wait for more events on a fast stream
+COALESCE_MAX_BYTES = int(os.environ.get("COALESCE_MAX_BYTES", "4096"))  # Batch size that is flushed without waiting
+FIRST_TOKEN_SAMPLES = 500  # Recent admission-to-first-token times kept for /debug
+ADMISSION_WAIT_SAMPLES = 500  # Recent queue wait times kept per class
 
 # Constants for agent mode
 AGENT_MODE_ENABLED = True
@@ -160,30 +807,2029 @@ It is *EXTREMELY* important that your generated code can be run immediately by t
 8. NEVER repeatedly attempt the same edit multiple times. If an edit fails to apply after one retry, STOP and ask the user for guidance.
 </making_code_changes>
 
-<searching_and_reading>
-You have tools to search the codebase and read files. Follow these rules regarding tool calls:
-1. If available, heavily prefer the semantic search tool to grep search, file search, and list dir tools.
-2. If you need to read a file, prefer to read larger sections of the file at once over multiple smaller calls.
-3. If you have found a reasonable place to edit or answer, do not continue calling tools. Edit or answer from the information you have found.
-</searching_and_reading>
+<searching_and_reading>
+You have tools to search the codebase and read files. Follow these rules regarding tool calls:
+1. If available, heavily prefer the semantic search tool to grep search, file search, and list dir tools.
+2. If you need to read a file, prefer to read larger sections of the file at once over multiple smaller calls.
+3. If you have found a reasonable place to edit or answer, do not continue calling tools. Edit or answer from the information you have found.
+</searching_and_reading>
+
+<preventing_recursion>
+You must NEVER get stuck in a loop of repeatedly trying to apply the same code edit. If you notice that you're attempting to make the same edit more than once:
+1. STOP immediately
+2. Explain to the user that you were unable to apply the edit
+3. Describe what you were trying to do
+4. Ask the user for guidance on how to proceed
+5. Wait for the user's response before taking any further action
+</preventing_recursion>
+"""
+
+# Phrases in an agent-mode response that mean the model is repeating a failed edit
+AGENT_RECURSIVE_RESPONSE_INDICATORS = [
+    "I'll try again with the edit",
+    "Let me try again with the same edit",
+    "Let's try the edit again",
+    "I'll reapply the same edit"
+]
+AGENT_RECURSION_WARNING = "\n\n**WARNING: Potential recursive behavior detected. Please try a different approach instead of repeating the same edit.**"
+
+# Initialize a cache to track recent code edits (key: hash of edit, value: count)
+# TTL of 300 seconds (5 minutes) should be enough to prevent recursive edits in a single conversation
+code_edit_cache = ByteBudgetCache("code_edit_cache", max_bytes=1024 * 1024, ttl=300, budget=cache_memory_budget)
+
+# Track consecutive edits to the same file
+file_edit_counter = ByteBudgetCache("file_edit_counter", max_bytes=256 * 1024, ttl=600, budget=cache_memory_budget)  # 10 minutes TTL
+MAX_CONSECUTIVE_EDITS = 3  # Maximum number of consecutive edits to the same file
+
+# Semantic near-duplicate response cache (opt-in, needs numpy: pip install numpy)
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Minimum cosine similarity for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "500"))  # Number of vectors kept
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", "600"))  # Seconds a cached response stays valid
+SEMANTIC_CACHE_DIM = 1024  # Width of the hashed n-gram vectors
+SEMANTIC_CACHE_NGRAM = 4  # Byte n-gram length used for the signatures
+# Request fields that do not change the completion and are left out of the context fingerprint
+SEMANTIC_CACHE_IGNORED_PARAMS = {"messages", "model", "stream", "user"}
+
+if SEMANTIC_CACHE_ENABLED and np is None:
+    logger.warning("SEMANTIC_CACHE_ENABLED is set but numpy is not installed. Semantic cache disabled.")
+    SEMANTIC_CACHE_ENABLED = False
+
+# Volatile fragments that make otherwise identical system prompts differ; only stripped from system
+# messages, since in user text and code a date or x[10:20] is content
+VOLATILE_TEXT_PATTERNS = [
+    re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?"),  # ISO timestamps
+    re.compile(r"\b\d{1,2}:\d{2}(:\d{2})?\s*([AaPp][Mm])?\b"),  # Clock times
+    re.compile(r"\b\d{4}-\d{2}-\d{2}\b")  # Dates
+]
+CURSOR_MARKER_PATTERN = re.compile(r"<\|?cursor\|?>|<\|cursor_position\|>|█", re.IGNORECASE)  # Cursor position markers, stripped everywhere
+
+def message_text(message):
+    """Return the text of a message whose content may be a string or a list of parts"""
+    content = message.get('content', '')
+    if isinstance(content, list):
+        return "\n".join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content or ''
+
+def normalize_semantic_text(text, system=False):
+    """Strip cursor markers, and for system text dates and times, and collapse whitespace"""
+    text = CURSOR_MARKER_PATTERN.sub(" ", text)
+    if system:
+        for pattern in VOLATILE_TEXT_PATTERNS:
+            text = pattern.sub(" ", text)
+    return " ".join(text.split())
+
+def embed_text(text):
+    """
+    Embed text as an L2-normalized signed feature-hashing vector of byte n-grams
+
+    Everything is computed locally with NumPy; no model or network call is involved.
+    """
+    codes = np.frombuffer(normalize_semantic_text(text).lower().encode('utf-8'), dtype=np.uint8).astype(np.uint64)
+    vector = np.zeros(SEMANTIC_CACHE_DIM, dtype=np.float32)
+    if len(codes) < SEMANTIC_CACHE_NGRAM:
+        return vector
+    count = len(codes) - SEMANTIC_CACHE_NGRAM + 1
+    hashes = np.full(count, 14695981039346656037, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for offset in range(SEMANTIC_CACHE_NGRAM):
+            hashes = (hashes ^ codes[offset:offset + count]) * np.uint64(1099511628211)
+        hashes ^= hashes >> np.uint64(29)
+        hashes *= np.uint64(0xbf58476d1ce4e5b9)
+        hashes ^= hashes >> np.uint64(32)
+    buckets = (hashes % np.uint64(SEMANTIC_CACHE_DIM)).astype(np.int64)
+    signs = np.where((hashes >> np.uint64(63)) == 1, -1.0, 1.0)
+    vector += np.bincount(buckets, weights=signs, minlength=SEMANTIC_CACHE_DIM).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+class SemanticCache:
+    """
+    Near-duplicate response cache keyed by vector similarity
+
+    Each entry holds the embedding of the final user turn, a group id derived
+    from the upstream model and a fingerprint of the rest of the request, and
+    an expiry time. A lookup only considers live entries in the same group and
+    returns the most similar one if it clears the threshold. Response bodies
+    live in a ByteBudgetCache so they count against the shared memory budget.
+    """
+
+    def __init__(self, max_entries, dim, threshold, ttl):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self.groups = np.zeros(max_entries, dtype=np.uint64)
+        self.expires = np.zeros(max_entries, dtype=np.float64)
+        self.entry_ids = [None] * max_entries
+        self.responses = ByteBudgetCache("semantic_response_cache", max_bytes=16 * 1024 * 1024, ttl=ttl, budget=cache_memory_budget)
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.hit_similarity_total = 0.0
+
+    @staticmethod
+    def request_signature(model, messages, params):
+        """Return (group id, final user turn) for a request"""
+        final_user_index = None
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get('role') == 'user':
+                final_user_index = i
+                break
+        final_user_text = message_text(messages[final_user_index]) if final_user_index is not None else ""
+        context = [
+            [m.get('role'), normalize_semantic_text(message_text(m), m.get('role') == 'system')]
+            for i, m in enumerate(messages) if i != final_user_index
+        ]
+        relevant_params = {k: v for k, v in params.items() if k not in SEMANTIC_CACHE_IGNORED_PARAMS}
+        fingerprint = hashlib.sha256(
+            json.dumps([model, context, relevant_params], sort_keys=True, default=str).encode('utf-8')
+        ).digest()
+        return np.uint64(int.from_bytes(fingerprint[:8], "big")), final_user_text
+
+    def lookup(self, model, messages, params):
+        """Return (response, similarity) for the best live match, or None"""
+        group, text = self.request_signature(model, messages, params)
+        vector = embed_text(text)
+        with self.lock:
+            self.lookups += 1
+            live = (self.groups == group) & (self.expires > time.time())
+            if not live.any():
+                return None
+            similarities = self.vectors @ vector
+            similarities[~live] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            entry_id = self.entry_ids[best]
+        if similarity < self.threshold:
+            return None
+        response = self.responses.get(entry_id)
+        if response is None:
+            return None
+        with self.lock:
+            self.hits += 1
+            self.hit_similarity_total += similarity
+        return response, similarity
+
+    def store(self, model, messages, params, response):
+        group, text = self.request_signature(model, messages, params)
+        vector = embed_text(text)
+        entry_id = str(uuid.uuid4())
+        with self.lock:
+            # Reuse an empty or expired slot first, otherwise the one closest to expiring
+            slot = int(np.argmin(self.expires))
+            old_id = self.entry_ids[slot]
+            self.vectors[slot] = vector
+            self.groups[slot] = group
+            self.expires[slot] = time.time() + self.ttl
+            self.entry_ids[slot] = entry_id
+            self.stores += 1
+        if old_id is not None and old_id in self.responses:
+            del self.responses[old_id]
+        self.responses[entry_id] = response
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": True,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "entries": int((self.expires > time.time()).sum()),
+                "max_entries": len(self.entry_ids),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "stores": self.stores,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "average_hit_similarity": self.hit_similarity_total / self.hits if self.hits else None
+            }
+
+semantic_cache = SemanticCache(
+    SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL
+) if SEMANTIC_CACHE_ENABLED else None
+
+def parse_stream_delta(line):
+    """
+    Extract the delta from an OpenAI-style SSE data line
+    
+    Returns:
+    tuple: (content, finish_reason, has_tool_calls), or None if the line carries no choice
+    """
+    if not line.startswith('data: ') or line.strip() == 'data: [DONE]':
+        return None
+    try:
+        chunk = json.loads(line[6:])
+    except json.JSONDecodeError:
+        return None
+    choices = chunk.get('choices') or []
+    if not choices:
+        return None
+    delta = choices[0].get('delta') or {}
+    return delta.get('content') or "", choices[0].get('finish_reason'), bool(delta.get('tool_calls'))
+
+def cached_completion_stream(content, finish_reason, model):
+    """Replay a cached completion as an OpenAI-style SSE stream"""
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time())
+    for delta, reason in (({"role": "assistant", "content": content}, None), ({}, finish_reason or "stop")):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": reason}]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+def scan_stream_text(tail, text, patterns):
+    """
+    Look for patterns in the next chunk of a stream
+    
+    Only the last (longest pattern - 1) characters seen so far are carried
+    between calls, which is enough to catch a pattern split across chunks.
+    
+    Parameters:
+    tail (str): Carry-over from the previous call, "" at the start
+    text (str): The new chunk
+    patterns (list): Phrases to look for
+    
+    Returns:
+    tuple: (carry-over for the next call, patterns found)
+    """
+    window = tail + text
+    found = [pattern for pattern in patterns if pattern in window]
+    keep = max((len(pattern) for pattern in patterns), default=1) - 1
+    return (window[-keep:] if keep else ""), found
+
+def aggregate_completion(events, model, prompt_tokens=0):
+    """
+    Assemble a chat.completion object from a stream of OpenAI-style SSE events
+    
+    Content and tool call fragments are joined and the last finish_reason is
+    kept. Usage is taken from the stream (top level, or Groq's x_groq) and
+    estimated when the stream reports none. A complete chat.completion sent
+    as one event is returned as is. The stream is always read to the end so
+    its cleanup runs.
+    
+    Parameters:
+    events: Iterable of SSE events or lines
+    model (str): Model name reported in the response
+    prompt_tokens (int): Prompt size used when the stream reports no usage
+    
+    Returns:
+    dict: The chat.completion object, or {"error": {...}} if the stream carried an error event
+    """
+    completion_id = None
+    content_parts = []
+    tool_calls = {}
+    finish_reason = None
+    usage = None
+    result = None
+    for event in events:
+        for line in event.split("\n"):
+            line = line.strip()
+            if not line.startswith('data: ') or line == 'data: [DONE]' or result:
+                continue
+            try:
+                chunk = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            if 'error' in chunk:
+                result = {"error": chunk['error']}
+                continue
+            if chunk.get('object') == 'chat.completion':
+                result = dict(chunk, model=model)
+                continue
+            completion_id = completion_id or chunk.get('id')
+            usage = chunk.get('usage') or (chunk.get('x_groq') or {}).get('usage') or usage
+            for choice in (chunk.get('choices') or [])[:1]:
+                delta = choice.get('delta') or {}
+                if delta.get('content'):
+                    content_parts.append(delta['content'])
+                for call in delta.get('tool_calls') or []:
+                    merged = tool_calls.setdefault(call.get('index', len(tool_calls)), {
+                        "id": None,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""}
+                    })
+                    merged['id'] = call.get('id') or merged['id']
+                    function = call.get('function') or {}
+                    merged['function']['name'] += function.get('name') or ""
+                    merged['function']['arguments'] += function.get('arguments') or ""
+                finish_reason = choice.get('finish_reason') or finish_reason
+    if result:
+        return result
+    
+    content = "".join(content_parts)
+    message = {"role": "assistant", "content": content if content or not tool_calls else None}
+    if tool_calls:
+        message['tool_calls'] = [tool_calls[index] for index in sorted(tool_calls)]
+    if not usage:
+        completion_tokens = max(1, len(content) // 4) if content else 0
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    return {
+        "id": completion_id or f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason or ("tool_calls" if tool_calls else "stop")}],
+        "usage": usage
+    }
+
+def aggregated_response(completion):
+    """JSON response for an aggregated completion, with an error status if the stream failed"""
+    error = completion.get('error')
+    if not error:
+        return jsonify(completion)
+    if error.get('type') == 'timeout_error':
+        status = 504
+    elif error.get('code') == 'superseded':
+        status = 409
+    else:
+        status = 502
+    return jsonify({"error": error}), status
+
+def cached_completion_response(cached_response, model, stream=True):
+    """
+    Serve a cached completion the way the client asked for it
+    
+    Parameters:
+    cached_response (dict): {"content": ..., "finish_reason": ...} as stored by the chat route
+    model (str): Model name reported in the response
+    stream (bool): False to answer with one chat.completion instead of an SSE stream
+    """
+    events = cached_completion_stream(cached_response['content'], cached_response['finish_reason'], model)
+    if not stream:
+        return aggregated_response(aggregate_completion(events, model))
+    return app.response_class(
+        events,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'access-control-expose-headers': 'X-Request-ID',
+            'x-request-id': str(uuid.uuid4())
+        }
+    )
+
+# Repetition abort counters, reported on /debug
+repetition_stats = {"checked": 0, "aborted_loop": 0, "aborted_echo": 0, "tokens_saved": 0}
+repetition_lock = threading.Lock()
+
+def record_repetition_event(event, amount=1):
+    with repetition_lock:
+        repetition_stats[event] += amount
+
+class RollingNgramHash:
+    """Rolling polynomial hash of the last n words pushed"""
+    BASE = 1000003
+    MOD = (1 << 61) - 1
+
+    def __init__(self, n):
+        self.n = n
+        self.window = deque()
+        self.value = 0
+        self.power = pow(self.BASE, n - 1, self.MOD)
+
+    def push(self, word):
+        """Add a word; returns the hash of the last n words, or None until n words were pushed"""
+        word_hash = hash(word) % self.MOD
+        if len(self.window) == self.n:
+            self.value = (self.value - self.window.popleft() * self.power) % self.MOD
+        self.window.append(word_hash)
+        self.value = (self.value * self.BASE + word_hash) % self.MOD
+        return self.value if len(self.window) == self.n else None
+
+class RepetitionDetector:
+    """
+    Watches a streamed completion for runaway repetition
+    
+    The output's words are hashed as rolling n-grams. A run of loop_words
+    n-grams in a row that this response already produced means the model is
+    looping; a run of echo_words n-grams in a row taken from the
+    conversation's recent assistant messages means it is re-emitting an
+    earlier answer, such as the same edit again. Either one stops the stream.
+    """
+
+    def __init__(self, limits, messages, budget_tokens):
+        self.loop_words = limits.get("loop_words", 0)
+        self.echo_words = limits.get("echo_words", 0)
+        self.ngram = max(1, int(limits.get("ngram", 8)))
+        self.budget_tokens = budget_tokens
+        self.rolling = RollingNgramHash(self.ngram)
+        self.seen = set()
+        self.previous = set()
+        if self.echo_words:
+            history = [message_text(message) for message in messages if message.get('role') == 'assistant']
+            for text in history[-REPETITION_HISTORY_RESPONSES:]:
+                rolling = RollingNgramHash(self.ngram)
+                for word in text.split():
+                    ngram_hash = rolling.push(word)
+                    if ngram_hash is not None:
+                        self.previous.add(ngram_hash)
+        self.loop_run = 0
+        self.echo_run = 0
+        self.partial = ""
+        self.chars = 0
+        self.reason = None
+
+    def feed(self, text):
+        """
+        Add streamed content
+        
+        Returns:
+        str: "loop" or "echo" once the stream should be stopped, otherwise None
+        """
+        if self.reason:
+            return self.reason
+        self.chars += len(text)
+        text = self.partial + text
+        words = text.split()
+        # A word at the end of the chunk may continue in the next one
+        self.partial = words.pop() if words and not text[-1].isspace() else ""
+        for word in words:
+            ngram_hash = self.rolling.push(word)
+            if ngram_hash is None:
+                continue
+            self.loop_run = self.loop_run + 1 if ngram_hash in self.seen else 0
+            self.echo_run = self.echo_run + 1 if ngram_hash in self.previous else 0
+            self.seen.add(ngram_hash)
+            if self.loop_words and self.loop_run >= self.loop_words:
+                self.reason = "loop"
+            elif self.echo_words and self.echo_run >= self.echo_words:
+                self.reason = "echo"
+            if self.reason:
+                return self.reason
+        return None
+
+def repetition_abort_events(detector, model):
+    """
+    End a stream stopped by the repetition detector: an explanatory delta,
+    a clean finish chunk and [DONE]
+    """
+    emitted_tokens = detector.chars // 4
+    saved = max(0, detector.budget_tokens - emitted_tokens)
+    record_repetition_event(f"aborted_{detector.reason}")
+    record_repetition_event("tokens_saved", saved)
+    logger.warning(f"Stopped a repeating generation ({detector.reason}) after about {emitted_tokens} tokens, up to {saved} tokens saved")
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time())
+    for delta, reason in (({"content": REPETITION_ABORT_MESSAGES[detector.reason]}, None), ({}, "stop")):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": reason}]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+def repetition_snapshot():
+    with repetition_lock:
+        return {"enabled": REPETITION_ABORT_ENABLED, "limits": REPETITION_LIMITS, **repetition_stats}
+
+def repetition_detector_for(request_data, model):
+    """A RepetitionDetector with the model's limits, or None when repetition abort is off"""
+    if not REPETITION_ABORT_ENABLED:
+        return None
+    upstream_model = MODEL_MAPPING.get(model, model)
+    limits = REPETITION_LIMITS.get(model) or REPETITION_LIMITS.get(upstream_model) or REPETITION_LIMITS["default"]
+    budget = request_data.get('max_tokens') or (get_model_capabilities(model) or {}).get('max_output', 4096)
+    record_repetition_event("checked")
+    return RepetitionDetector(limits, request_data.get('messages') or [], budget)
+
+# Admission-to-first-token times and heartbeat counts, reported on /debug
+first_token_times = deque(maxlen=FIRST_TOKEN_SAMPLES)
+heartbeat_stats = {"streams": 0, "heartbeats": 0, "no_token": 0, "events": 0, "writes": 0}
+heartbeat_lock = threading.Lock()
+
+def record_heartbeat_event(event):
+    with heartbeat_lock:
+        heartbeat_stats[event] += 1
+
+def heartbeat_snapshot():
+    with heartbeat_lock:
+        times = sorted(first_token_times)
+        return {
+            "enabled": HEARTBEAT_ENABLED,
+            "interval": HEARTBEAT_INTERVAL,
+            "coalesce_window_ms": COALESCE_WINDOW_MS if COALESCE_ENABLED else 0,
+            **heartbeat_stats,
+            "events_per_write": round(heartbeat_stats["events"] / heartbeat_stats["writes"], 2) if heartbeat_stats["writes"] else 0,
+            "first_token_p50": round(times[len(times) // 2], 3) if times else 0,
+            "first_token_p95": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3) if times else 0
+        }
+
+def role_delta_event(model):
+    """SSE event opening an assistant message, sent before any upstream output"""
+    chunk = {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+class StreamCanceller:
+    """
+    Closes a request's upstream streaming response from another thread
+    
+    The thread reading a stream blocks inside iter_lines until the next chunk
+    arrives, so closing the response alone only takes effect then. cancel()
+    also shuts the socket down, which wakes the reader at once. Responses
+    attached after cancel() are closed straight away.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = set()
+        self.cancelled = False
+
+    def attach(self, response):
+        """Track a response being read, closing it at once if already cancelled"""
+        with self.lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self.responses.add(response)
+        if cancelled:
+            close_upstream_response(response)
+        return response
+
+    def detach(self, response):
+        """Stop tracking a response that has been read to the end or closed"""
+        with self.lock:
+            self.responses.discard(response)
+
+    def cancel(self):
+        """Close every tracked response and refuse later ones"""
+        with self.lock:
+            self.cancelled = True
+            responses = list(self.responses)
+            self.responses.clear()
+        for response in responses:
+            close_upstream_response(response)
+
+def close_upstream_response(response):
+    """Close a streaming response, waking any thread blocked reading from it"""
+    sock = getattr(getattr(getattr(response, 'raw', None), 'connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception as e:
+        logger.debug(f"Error closing upstream response: {str(e)}")
+
+def strip_role_delta(event):
+    """
+    Remove `role` from the delta of an SSE completion chunk
+    
+    Returns:
+    str: The event without a role (unchanged if it had none), or None if it is not a completion chunk
+    """
+    if not event.startswith('data: ') or event.strip() == 'data: [DONE]':
+        return None
+    try:
+        chunk = json.loads(event[6:])
+    except json.JSONDecodeError:
+        return None
+    choices = chunk.get('choices') if isinstance(chunk, dict) else None
+    if not choices:
+        return None
+    deltas = [choice.get('delta') for choice in choices if isinstance(choice.get('delta'), dict)]
+    if not any('role' in delta for delta in deltas):
+        return event
+    for delta in deltas:
+        delta.pop('role', None)
+    return f"data: {json.dumps(chunk)}\n\n"
+
+def stream_with_heartbeats(events, model, started, canceller=None, ticket=None):
+    """
+    Yield an SSE stream that opens with a role delta and stays alive while upstream is silent
+    
+    `events` runs in a worker thread, so blocking work before its first event
+    (the R1 stage, rate-limit waits, a slow first token) no longer holds back
+    the first byte. While it is silent an SSE comment is sent every
+    HEARTBEAT_INTERVAL seconds so tunnels don't drop the idle connection.
+    
+    After the first token, events that arrive together are joined into one
+    write: whatever is already queued is taken at once, and on a stream whose
+    events come faster than COALESCE_WINDOW_MS apart the batch waits up to
+    that long for more. The first token is always sent on its own.
+    
+    When the client disconnects the worker is told to stop, the upstream
+    response is closed through `canceller` and anything still buffered is
+    dropped, so generation does not carry on for nobody.
+    
+    Parameters:
+    events: Generator of SSE events for the completion
+    model (str): Model name reported in the role delta
+    started (float): Admission time the first real token is measured from
+    canceller (StreamCanceller): Closes the upstream response when the client goes away
+    ticket (AdmissionTicket): Admission slot the worker holds until the upstream request ends
+    """
+    if not HEARTBEAT_ENABLED and not COALESCE_ENABLED:
+        yield from events
+        return
+    buffer = queue.Queue()
+    stopped = threading.Event()
+
+    def pump():
+        # Runs in a worker thread and forwards the stream's events to the buffer
+        try:
+            for event in events:
+                if stopped.is_set():
+                    return
+                buffer.put(("event", event))
+            buffer.put(("end", None))
+        except Exception as e:
+            if not stopped.is_set():
+                buffer.put(("error", e))
+        finally:
+            events.close()
+            if ticket:
+                # The slot frees when the upstream request has ended, not when the client left
+                admission_scheduler.release(ticket)
+
+    record_heartbeat_event("streams")
+    if HEARTBEAT_ENABLED:
+        yield role_delta_event(model)
+    if ticket:
+        admission_scheduler.hold(ticket)
+    threading.Thread(target=pump, daemon=True).start()
+    window = COALESCE_WINDOW_MS / 1000
+    first_token = False
+    # Average gap between events, which decides whether waiting for more is worthwhile
+    event_gap = None
+    last_event = None
+    last_batch_size = 1
+    pending = None
+    # The synthetic role delta opened the message; upstream's own role is dropped
+    role_pending = HEARTBEAT_ENABLED
+    try:
+        while True:
+            if pending:
+                kind, payload = pending
+                pending = None
+            else:
+                try:
+                    kind, payload = buffer.get(timeout=HEARTBEAT_INTERVAL if HEARTBEAT_ENABLED else None)
+                except queue.Empty:
+                    record_heartbeat_event("heartbeats")
+                    yield ": keep-alive\n\n"
+                    continue
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            if role_pending:
+                stripped = strip_role_delta(payload)
+                if stripped is not None:
+                    payload = stripped
+                    role_pending = False
+            batch = [payload]
+            if not first_token:
+                delta = parse_stream_delta(payload.strip())
+                if delta and (delta[0] or delta[2]):
+                    first_token = True
+                    with heartbeat_lock:
+                        first_token_times.append(time.time() - started)
+            elif COALESCE_ENABLED:
+                now = time.time()
+                if last_event is not None:
+                    gap = (now - last_event) / last_batch_size
+                    event_gap = gap if event_gap is None else 0.8 * event_gap + 0.2 * gap
+                last_event = now
+                flush_at = now + window if event_gap is not None and event_gap < window else now
+                size = len(payload)
+                while size < COALESCE_MAX_BYTES and "[DONE]" not in batch[-1]:
+                    try:
+                        remaining = flush_at - time.time()
+                        kind, payload = buffer.get(timeout=remaining) if remaining > 0 else buffer.get_nowait()
+                    except queue.Empty:
+                        break
+                    if kind != "event":
+                        pending = (kind, payload)
+                        break
+                    batch.append(payload)
+                    size += len(payload)
+                last_batch_size = len(batch)
+            with heartbeat_lock:
+                heartbeat_stats["events"] += len(batch)
+                heartbeat_stats["writes"] += 1
+            yield "".join(batch)
+    finally:
+        # Stop the worker, drop the upstream request and whatever was buffered for the client
+        stopped.set()
+        if canceller:
+            canceller.cancel()
+        pending = None
+        while True:
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                break
+        if not first_token:
+            record_heartbeat_event("no_token")
+
+# Request canonicalization - normalize fields that do not affect the completion before building cache keys
+CANONICAL_DROPPED_FIELDS = ["stream", "stream_options", "user", "request_id", "id", "metadata"]
+PROVIDER_PARAM_DEFAULTS = {
+    "temperature": 1,
+    "top_p": 1,
+    "n": 1,
+    "presence_penalty": 0,
+    "frequency_penalty": 0
+}
+# One word of a date/time stamp: ISO or numeric dates, clock times, day and month names, time zones
+DATE_TIME_TOKEN = (
+    r"(?:\d{4}-\d{2}-\d{2}(?:[T ]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?"
+    r"|\d{1,2}[/.]\d{1,2}[/.]\d{2,4}"
+    r"|\d{1,2}:\d{2}(?::\d{2})?(?:\s*[ap]\.?m\.?)?"
+    r"|\d{1,4}(?:st|nd|rd|th)?"
+    r"|(?:mon|tues?|wed(?:nes)?|thu(?:rs)?|fri|sat(?:ur)?|sun)(?:day)?\.?"
+    r"|(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?"
+    r"|utc|gmt|[+-]\d{2}:?\d{2}|at)"
+)
+# A whole line that is only the current date or time, optionally labelled ("Current date: ...", "Today is ...")
+VOLATILE_LINE_PATTERN = re.compile(
+    r"(?:[-*]\s*)?"
+    r"(?P<label>(?:the\s+)?(?:current|today'?s)\s+(?:date|time|date\s+and\s+time|datetime)(?:\s+is)?|today\s+is|it\s+is\s+now)?"
+    rf"\s*:?\s*{DATE_TIME_TOKEN}(?:[\s,]+{DATE_TIME_TOKEN})*\s*\.?",
+    re.IGNORECASE
+)
+
+canonicalization_lock = threading.Lock()
+canonicalization_counts = {"requests": 0, "normalizations": {}}
+
+def is_volatile_line(line):
+    """Return True for system prompt lines that are nothing but the current date or time"""
+    match = VOLATILE_LINE_PATTERN.fullmatch(line.strip())
+    if not match or not any(char.isdigit() for char in line):
+        return False
+    # Without a "current date" style label the line must hold an actual date or clock time, not just numbers
+    return bool(match.group('label')) or any(pattern.search(line) for pattern in VOLATILE_TEXT_PATTERNS)
+
+def canonicalize_request(data):
+    """
+    Build the canonical form of a chat request for cache keys
+    
+    Drops transport and identity fields, parameters equal to the provider default,
+    trailing whitespace, and date/time lines in system prompts. The request sent
+    upstream is left untouched. Callers count the result once per request with
+    record_canonicalization().
+    
+    Parameters:
+    data (dict): The chat completion request
+    
+    Returns:
+    tuple: (canonical request, list of normalizations that fired)
+    """
+    canonical = {}
+    fired = []
+    for key, value in data.items():
+        if key in CANONICAL_DROPPED_FIELDS:
+            fired.append(f"drop:{key}")
+        elif value is None:
+            fired.append(f"null:{key}")
+        elif key in PROVIDER_PARAM_DEFAULTS and value == PROVIDER_PARAM_DEFAULTS[key]:
+            fired.append(f"default:{key}")
+        else:
+            canonical[key] = value
+    
+    if isinstance(canonical.get('messages'), list):
+        messages = []
+        volatile_lines = 0
+        trailing_whitespace = 0
+        for message in canonical['messages']:
+            content = message.get('content') if isinstance(message, dict) else None
+            if not isinstance(content, str):
+                messages.append(message)
+                continue
+            lines = content.split("\n")
+            if message.get('role') == 'system':
+                kept = [line for line in lines if not is_volatile_line(line)]
+                volatile_lines += len(lines) - len(kept)
+                lines = kept
+            joined = "\n".join(lines)
+            normalized = "\n".join(line.rstrip() for line in lines).strip()
+            if normalized != joined:
+                trailing_whitespace += 1
+            messages.append({**message, "content": normalized})
+        canonical['messages'] = messages
+        if volatile_lines:
+            fired.append("volatile_datetime_lines")
+        if trailing_whitespace:
+            fired.append("trailing_whitespace")
+    
+    return canonical, fired
+
+def record_canonicalization(fired):
+    """Count one canonicalized request and the normalizations that fired for it"""
+    with canonicalization_lock:
+        canonicalization_counts["requests"] += 1
+        for name in fired:
+            counts = canonicalization_counts["normalizations"]
+            counts[name] = counts.get(name, 0) + 1
+    if fired:
+        logger.info(f"Canonicalized request: {', '.join(fired)}")
+
+class ContextLengthExceeded(Exception):
+    """The prompt does not fit the context window of its model or any overflow model"""
+    code = "context_length_exceeded"
+
+# Context fitting counters, reported on /debug
+context_stats = {"clamped": 0, "rerouted": 0, "rejected": 0}
+context_stats_lock = threading.Lock()
+
+def record_context_event(event):
+    with context_stats_lock:
+        context_stats[event] += 1
+
+def get_model_capabilities(model_name):
+    """Capabilities of a model or mapped model name, or None if it is not in the registry"""
+    return MODEL_CAPABILITIES.get(MODEL_MAPPING.get(model_name, model_name))
+
+def request_context_tokens(request_data):
+    """Estimated prompt tokens of a request, tool definitions included"""
+    return estimate_prompt_tokens(request_data) + len(json.dumps(request_data.get('tools', []))) // 4
+
+def fits_context(model_name, prompt_tokens):
+    """Whether a model leaves room for output after the prompt (unknown models are assumed to)"""
+    capabilities = get_model_capabilities(model_name)
+    return capabilities is None or capabilities["context_window"] - prompt_tokens >= CONTEXT_MIN_OUTPUT_TOKENS
+
+def clamp_max_tokens(request_data, model_name):
+    """Return the request with max_tokens lowered to what the model can still produce"""
+    capabilities = get_model_capabilities(model_name)
+    if not CONTEXT_ROUTING_ENABLED or capabilities is None or not request_data.get('max_tokens'):
+        return request_data
+    room = max(1, min(capabilities["max_output"], capabilities["context_window"] - request_context_tokens(request_data)))
+    if request_data['max_tokens'] <= room:
+        return request_data
+    logger.info(f"Clamping max_tokens from {request_data['max_tokens']} to {room} for {model_name}")
+    record_context_event("clamped")
+    return {**request_data, 'max_tokens': room}
+
+def fit_request_to_context(request_data, model_name, candidates=None):
+    """
+    Make a request fit the context window of its model before it is sent to Groq
+    
+    Parameters:
+    request_data (dict): The request body
+    model_name (str): The model (or mapped model name) the request is for
+    candidates (list): Models to reroute to if the prompt does not fit
+    
+    Returns:
+    tuple: (request_data, model_name) - a copy with max_tokens clamped to the room
+    left, and the smallest candidate that fits if the model had to be replaced
+    
+    Raises ContextLengthExceeded if neither the model nor a candidate can hold the prompt.
+    """
+    capabilities = get_model_capabilities(model_name)
+    if not CONTEXT_ROUTING_ENABLED or capabilities is None:
+        return request_data, model_name
+    
+    prompt_tokens = request_context_tokens(request_data)
+    if not fits_context(model_name, prompt_tokens):
+        needs_tools = bool(request_data.get('tools'))
+        fitting = sorted(
+            (MODEL_CAPABILITIES[candidate]["context_window"], candidate) for candidate in (candidates or [])
+            if candidate in MODEL_CAPABILITIES and fits_context(candidate, prompt_tokens)
+            and (MODEL_CAPABILITIES[candidate]["tools"] or not needs_tools)
+            and (MODEL_CAPABILITIES[candidate]["streaming"] or not capabilities["streaming"])
+        )
+        if not fitting:
+            record_context_event("rejected")
+            raise ContextLengthExceeded(
+                f"This request needs about {prompt_tokens} tokens, which does not fit the "
+                f"{capabilities['context_window']} token context window of {MODEL_MAPPING.get(model_name, model_name)} or any overflow model"
+            )
+        logger.info(f"Prompt of about {prompt_tokens} tokens does not fit {model_name}, rerouting to {fitting[0][1]}")
+        record_context_event("rerouted")
+        model_name = fitting[0][1]
+    return clamp_max_tokens(request_data, model_name), model_name
+
+def context_length_error(error):
+    """OpenAI-style 400 response for a prompt that fits no model"""
+    return jsonify({
+        "error": {
+            "message": str(error),
+            "type": "invalid_request_error",
+            "param": "messages",
+            "code": error.code
+        }
+    }), 400
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+    code = "circuit_open"
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker for one upstream provider and model
+    
+    The breaker opens when the failure ratio over the last CIRCUIT_BREAKER_WINDOW
+    seconds reaches CIRCUIT_BREAKER_ERROR_RATE. Connection errors, 429s, 5xx
+    responses and calls slower than CIRCUIT_BREAKER_SLOW_CALL count as failures.
+    After CIRCUIT_BREAKER_COOLDOWN seconds a few trial calls are let through;
+    a successful trial closes the breaker and a failed one opens it again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed"
+        self.outcomes = deque()  # (timestamp, failed) pairs inside the window
+        self.opened_at = 0
+        self.half_open_at = 0
+        self.trial_calls = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def prune(self, now):
+        while self.outcomes and now - self.outcomes[0][0] > CIRCUIT_BREAKER_WINDOW:
+            self.outcomes.popleft()
+
+    def allow_request(self):
+        """Return True if a call may go upstream now"""
+        if not CIRCUIT_BREAKER_ENABLED:
+            return True
+        with self.lock:
+            now = time.time()
+            if self.state == "open" and now - self.opened_at >= CIRCUIT_BREAKER_COOLDOWN:
+                self.state = "half_open"
+                self.half_open_at = now
+                self.trial_calls = 0
+                logger.info(f"Circuit breaker for {self.name} is half-open, allowing trial calls")
+            if self.state == "half_open" and now - self.half_open_at >= CIRCUIT_BREAKER_COOLDOWN:
+                # Trial calls that never reported back should not block the breaker forever
+                self.half_open_at = now
+                self.trial_calls = 0
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and self.trial_calls < CIRCUIT_BREAKER_HALF_OPEN_CALLS:
+                self.trial_calls += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_result(self, started, status_code=None):
+        """
+        Record the outcome of an upstream call
+        
+        Parameters:
+        started (float): time.time() when the call was sent
+        status_code (int): HTTP status, or None if the call raised
+        """
+        failed = (status_code is None or status_code == 429 or status_code >= 500
+                  or time.time() - started > CIRCUIT_BREAKER_SLOW_CALL)
+        with self.lock:
+            now = time.time()
+            if self.state == "half_open":
+                if failed:
+                    self.open(now)
+                else:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    logger.info(f"Circuit breaker for {self.name} closed")
+                return
+            if self.state == "open":
+                # Late result from a call sent before the breaker opened
+                return
+            self.outcomes.append((now, failed))
+            self.prune(now)
+            failures = sum(1 for _, call_failed in self.outcomes if call_failed)
+            if len(self.outcomes) >= CIRCUIT_BREAKER_MIN_CALLS and failures / len(self.outcomes) >= CIRCUIT_BREAKER_ERROR_RATE:
+                self.open(now)
+
+    def open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.times_opened += 1
+        self.outcomes.clear()
+        logger.warning(f"Circuit breaker for {self.name} opened, failing fast for {CIRCUIT_BREAKER_COOLDOWN}s")
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            return {
+                "state": self.state,
+                "calls_in_window": len(self.outcomes),
+                "failures_in_window": sum(1 for _, call_failed in self.outcomes if call_failed),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "retry_in": max(0, round(self.opened_at + CIRCUIT_BREAKER_COOLDOWN - now, 1)) if self.state == "open" else 0
+            }
+
+# One breaker per provider/model pair, created on first use
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(provider, model):
+    name = f"{provider}/{model}"
+    with circuit_breakers_lock:
+        if name not in circuit_breakers:
+            circuit_breakers[name] = CircuitBreaker(name)
+        return circuit_breakers[name]
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of live traffic
+    
+    Over the last RETRY_BUDGET_WINDOW seconds, retries may not exceed
+    RETRY_BUDGET_RATIO times the number of first attempts, plus a small
+    floor so retries still work at low traffic.
+    """
+
+    def __init__(self):
+        self.requests = deque()
+        self.retries = deque()
+        self.denied = 0
+        self.lock = threading.Lock()
+
+    def prune(self, now):
+        for events in (self.requests, self.retries):
+            while events and now - events[0] > RETRY_BUDGET_WINDOW:
+                events.popleft()
+
+    def record_request(self):
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            self.requests.append(now)
+
+    def try_acquire(self):
+        """Return True and spend budget if a retry is allowed now"""
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            allowed = RETRY_BUDGET_RATIO * len(self.requests) + RETRY_BUDGET_MIN_PER_SECOND * RETRY_BUDGET_WINDOW
+            if len(self.retries) >= allowed:
+                self.denied += 1
+                return False
+            self.retries.append(now)
+            return True
+
+    def stats(self):
+        with self.lock:
+            self.prune(time.time())
+            return {
+                "requests_in_window": len(self.requests),
+                "retries_in_window": len(self.retries),
+                "denied": self.denied
+            }
+
+retry_budget = RetryBudget()
+
+def get_breaker_health():
+    """Breaker states and retry budget usage for /health"""
+    with circuit_breakers_lock:
+        breakers = list(circuit_breakers.values())
+    return {
+        "enabled": CIRCUIT_BREAKER_ENABLED,
+        "breakers": {breaker.name: breaker.snapshot() for breaker in breakers},
+        "retry_budget": retry_budget.stats()
+    }
+
+class RateLimitWaitExceeded(Exception):
+    """Raised when a request would have to queue longer than RATE_LIMIT_MAX_QUEUE_WAIT"""
+    code = "rate_limit_exceeded"
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_reset_duration(value):
+    """Parse Groq reset durations such as "7.66s", "2m59.56s" or "120ms" into seconds"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def estimate_prompt_tokens(request_data):
+    """Rough prompt size in tokens (about 4 characters per token)"""
+    return max(1, len(json.dumps(request_data.get('messages', []))) // 4)
+
+class TokenBucket:
+    """
+    Token bucket mirroring one Groq limit (requests or tokens)
+    
+    The bucket is reset from the remaining/limit/reset headers on every
+    response and refills in between at the rate those headers imply. Callers
+    reserve capacity up front, so the level can go negative; the deficit is
+    how long the next caller has to wait, which keeps waiting requests in
+    arrival order.
+    """
+
+    def __init__(self):
+        self.capacity = None  # Unknown until Groq reports a limit
+        self.level = None
+        self.rate = 0
+        self.pending = 0  # Reserved by requests still waiting to be sent
+        self.updated = time.time()
+
+    def refill(self, now):
+        if self.level is not None and self.rate > 0:
+            self.level = min(self.capacity, self.level + self.rate * (now - self.updated))
+        self.updated = now
+
+    def update(self, limit, remaining, reset_seconds, now):
+        if remaining is None:
+            return
+        if limit is not None:
+            self.capacity = limit
+        elif self.capacity is None:
+            self.capacity = remaining
+        self.level = remaining - self.pending
+        if reset_seconds:
+            self.rate = max(0, self.capacity - remaining) / reset_seconds
+        self.updated = now
+
+    def wait_time(self, cost, now):
+        """Seconds until `cost` units are available (0 if the limit is unknown)"""
+        self.refill(now)
+        if self.level is None:
+            return 0
+        cost = min(cost, self.capacity)
+        if self.level >= cost:
+            return 0
+        if self.rate <= 0:
+            return float("inf")
+        return (cost - self.level) / self.rate
+
+    def reserve(self, cost):
+        if self.level is not None:
+            cost = min(cost, self.capacity)
+            self.level -= cost
+            self.pending += cost
+        return cost
+
+    def release(self, cost):
+        self.pending = max(0, self.pending - cost)
+
+    def snapshot(self):
+        return {
+            "limit": self.capacity,
+            "available": None if self.level is None else round(self.level, 1),
+            "refill_per_second": round(self.rate, 3)
+        }
+
+class RateLimitState:
+    """
+    Admission control for one Groq API key and model
+    
+    Requests wait in arrival order for both the request and token buckets,
+    and for any retry-after period from a 429. A request that would wait
+    longer than RATE_LIMIT_MAX_QUEUE_WAIT is rejected instead of being sent
+    into a guaranteed 429.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.blocked_until = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, prompt_tokens, max_wait=RATE_LIMIT_MAX_QUEUE_WAIT):
+        """
+        Wait until the request fits within the rate limits
+        
+        Parameters:
+        prompt_tokens (int): Estimated prompt size of the request
+        max_wait (float): Longest acceptable wait; longer waits are rejected
+        
+        Returns:
+        float: Seconds spent waiting in the queue
+        """
+        if not RATE_LIMIT_ADMISSION_ENABLED:
+            return 0
+        with self.lock:
+            now = time.time()
+            wait = max(
+                self.blocked_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(prompt_tokens, now)
+            )
+            if wait > max_wait:
+                self.rejected += 1
+                raise RateLimitWaitExceeded(
+                    f"Rate limit for {self.name} would need a {wait:.1f}s wait, rejecting request",
+                    retry_after=wait if wait != float("inf") else RATE_LIMIT_MAX_QUEUE_WAIT
+                )
+            reserved_requests = self.requests.reserve(1)
+            reserved_tokens = self.tokens.reserve(prompt_tokens)
+            self.admitted += 1
+            if wait > 0:
+                self.queued += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        
+        if wait > 0:
+            logger.info(f"Rate limit queue: holding request for {self.name} for {wait:.2f}s")
+            time.sleep(wait)
+        with self.lock:
+            self.requests.release(reserved_requests)
+            self.tokens.release(reserved_tokens)
+        return max(0, wait)
+
+    def update_from_headers(self, headers, status_code):
+        """Resync the buckets from Groq's x-ratelimit-* and retry-after headers"""
+        def header_number(name):
+            try:
+                return float(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+        
+        with self.lock:
+            now = time.time()
+            self.requests.update(
+                header_number("x-ratelimit-limit-requests"),
+                header_number("x-ratelimit-remaining-requests"),
+                parse_reset_duration(headers.get("x-ratelimit-reset-requests")),
+                now
+            )
+            self.tokens.update(
+                header_number("x-ratelimit-limit-tokens"),
+                header_number("x-ratelimit-remaining-tokens"),
+                parse_reset_duration(headers.get("x-ratelimit-reset-tokens")),
+                now
+            )
+            if status_code == 429:
+                retry_after = parse_reset_duration(headers.get("retry-after"))
+                self.blocked_until = now + (retry_after if retry_after is not None else RATE_LIMIT_DEFAULT_RETRY_AFTER)
+                logger.warning(f"Groq rate limited {self.name}, holding requests for {self.blocked_until - now:.1f}s")
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "requests": self.requests.snapshot(),
+                "tokens": self.tokens.snapshot(),
+                "blocked_for": max(0, round(self.blocked_until - now, 1)),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "avg_queue_wait": round(self.total_wait / self.queued, 3) if self.queued else 0,
+                "max_queue_wait": round(self.max_wait, 3)
+            }
+
+# One admission state per API key and model, created on first use
+rate_limit_states = {}
+rate_limit_states_lock = threading.Lock()
+
+def api_key_label(api_key):
+    """Short, non-secret label for an API key"""
+    return f"...{api_key[-4:]}" if api_key else "none"
+
+def get_rate_limit_state(api_key, model):
+    name = f"{api_key_label(api_key)}/{model}"
+    with rate_limit_states_lock:
+        if name not in rate_limit_states:
+            rate_limit_states[name] = RateLimitState(name)
+        return rate_limit_states[name]
+
+class ApiKeyPool:
+    """
+    Spreads requests for one provider across several API keys
+    
+    Each request goes to the key with the most remaining token budget as
+    reported by the provider's rate-limit headers. Keys without a report yet
+    are tried first, and ties go to the key with the fewest requests in
+    flight. Keys answering 401 or 429 are ejected for a while.
+    """
+
+    def __init__(self, provider, keys):
+        self.provider = provider
+        self.keys = keys
+        self.usage = {
+            key: {
+                "requests": 0,
+                "in_flight": 0,
+                "errors": 0,
+                "ejections": 0,
+                "ejected_until": 0,
+                "remaining_tokens": None,
+                "remaining_requests": None,
+                "last_status": None
+            }
+            for key in keys
+        }
+        self.lock = threading.Lock()
+
+    def choose(self, estimated_tokens=0):
+        """Pick a key for the next request and count it as in flight"""
+        with self.lock:
+            now = time.time()
+            available = [key for key in self.keys if self.usage[key]["ejected_until"] <= now]
+            if not available:
+                # Every key is ejected; use the one that returns first rather than failing outright
+                available = [min(self.keys, key=lambda key: self.usage[key]["ejected_until"])]
+            
+            def score(key):
+                usage = self.usage[key]
+                remaining = usage["remaining_tokens"]
+                return (float("inf") if remaining is None else remaining, -usage["in_flight"], -usage["requests"])
+            
+            key = max(available, key=score)
+            usage = self.usage[key]
+            usage["requests"] += 1
+            usage["in_flight"] += 1
+            if usage["remaining_tokens"] is not None:
+                # Spend the estimate locally until the next response reports the real figure
+                usage["remaining_tokens"] -= estimated_tokens
+            return key
+
+    def record_response(self, key, status_code, headers):
+        """Update a key's budget from a response and eject it on 401 or 429"""
+        with self.lock:
+            usage = self.usage[key]
+            usage["in_flight"] = max(0, usage["in_flight"] - 1)
+            usage["last_status"] = status_code
+            for field, names in (("remaining_tokens", KEY_POOL_TOKEN_HEADERS), ("remaining_requests", KEY_POOL_REQUEST_HEADERS)):
+                for name in names:
+                    try:
+                        usage[field] = float(headers[name])
+                        break
+                    except (KeyError, TypeError, ValueError):
+                        continue
+            if status_code >= 400:
+                usage["errors"] += 1
+            if status_code in (401, 429):
+                eject_for = KEY_EJECT_AUTH_SECONDS if status_code == 401 else KEY_EJECT_RATE_LIMIT_SECONDS
+                try:
+                    eject_for = max(eject_for if status_code == 401 else 0, float(headers.get("retry-after")))
+                except (TypeError, ValueError):
+                    pass
+                usage["ejected_until"] = time.time() + eject_for
+                usage["ejections"] += 1
+                logger.warning(f"Ejecting {self.provider} key {api_key_label(key)} for {eject_for:.0f}s after HTTP {status_code}")
+
+    def available_count(self):
+        """Number of keys not currently ejected"""
+        with self.lock:
+            now = time.time()
+            return sum(1 for usage in self.usage.values() if usage["ejected_until"] <= now)
+
+    def release(self, key, failed=False):
+        """Finish a request that got no response (connection error or never sent)"""
+        with self.lock:
+            usage = self.usage[key]
+            usage["in_flight"] = max(0, usage["in_flight"] - 1)
+            if failed:
+                usage["errors"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            return {
+                api_key_label(key): {
+                    **{field: value for field, value in usage.items() if field != "ejected_until"},
+                    "ejected_for": max(0, round(usage["ejected_until"] - now, 1))
+                }
+                for key, usage in self.usage.items()
+            }
+
+groq_key_pool = ApiKeyPool("groq", GROQ_API_KEYS)
+
+class DeadlineExceeded(Exception):
+    """Raised instead of doing upstream work for a request whose deadline has passed"""
+    code = "deadline_exceeded"
+
+class Deadline:
+    """Absolute time by which a client request has to be answered"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.time() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(f"Request deadline of {self.seconds:g}s exceeded")
+
+    def timeout(self, cap=GROQ_TIMEOUT):
+        """(connect, read) timeouts for one upstream hop, bounded by the time left"""
+        self.check()
+        remaining = self.remaining()
+        return (min(UPSTREAM_CONNECT_TIMEOUT, remaining), min(cap, remaining))
+
+def request_deadline(route_class):
+    """
+    Deadline of the current request, created on first use
+    
+    Taken from the X-Request-Timeout header if the client sent one, otherwise
+    from ROUTE_DEADLINES for the requested model or the route.
+    """
+    if 'deadline' not in g:
+        try:
+            seconds = min(DEADLINE_MAX, max(1.0, float(request.headers[DEADLINE_HEADER])))
+        except (KeyError, ValueError):
+            data = request.get_json(silent=True) if request.is_json else None
+            model = (data or {}).get('model') if isinstance(data, dict) else None
+            seconds = ROUTE_DEADLINES.get(model, ROUTE_DEADLINES.get(route_class, GROQ_TIMEOUT))
+        g.deadline = Deadline(float(seconds))
+    return g.deadline
+
+def deadline_error(error):
+    """OpenAI-style 504 response for a request that ran out of time"""
+    return jsonify({
+        "error": {
+            "message": str(error),
+            "type": "timeout_error",
+            "param": None,
+            "code": error.code
+        }
+    }), 504
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot get an admission slot (queue full or waited too long)"""
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+class AdmissionTicket:
+    """One request's place in the admission scheduler"""
+    def __init__(self, priority_class, client="anonymous", cost=1.0):
+        self.priority_class = priority_class
+        self.client = client
+        self.cost = cost
+        self.enqueued = time.time()
+        self.granted = threading.Event()
+        # Holders of the slot (the response, plus a stream worker still reading upstream)
+        self.holds = 1
+        self.released = False
+
+class AdmissionScheduler:
+    """
+    Admits requests to a fixed number of upstream slots by priority class and client
+    
+    Each class keeps its reserved slots; the rest are shared. When a slot
+    frees, waiting classes are served by weighted fair queueing (the class
+    with the lowest virtual finish time goes next), so a burst in one class
+    delays the others by at most their weight share. Within a class, clients
+    are served by deficit round robin, one turn per round plus one for every
+    CLIENT_DRR_TOKENS_PER_TURN prompt tokens. If CLIENT_MAX_CONCURRENCY is set,
+    no client holds more slots than that.
+    """
+
+    def __init__(self, capacity, classes, client_limit=CLIENT_MAX_CONCURRENCY):
+        self.capacity = capacity
+        self.classes = classes
+        self.client_limit = client_limit
+        self.shared_capacity = max(0, capacity - sum(config["reserved"] for config in classes.values()))
+        # Per class: client -> queued tickets, and the round-robin order of clients with queued tickets
+        self.queues = {name: {} for name in classes}
+        self.rounds = {name: deque() for name in classes}
+        self.deficits = {name: {} for name in classes}
+        self.queued = {name: 0 for name in classes}
+        self.running = {name: 0 for name in classes}
+        self.client_running = {}
+        self.client_queued = {}
+        self.virtual_time = {name: 0.0 for name in classes}
+        self.stats = {name: {"admitted": 0, "rejected": 0, "timed_out": 0} for name in classes}
+        self.waits = {name: deque(maxlen=ADMISSION_WAIT_SAMPLES) for name in classes}
+        self.lock = threading.Lock()
+
+    def shared_in_use(self):
+        return sum(max(0, self.running[name] - self.classes[name]["reserved"]) for name in self.classes)
+
+    def can_run(self, name):
+        if sum(self.running.values()) >= self.capacity:
+            return False
+        return self.running[name] < self.classes[name]["reserved"] or self.shared_in_use() < self.shared_capacity
+
+    def client_can_run(self, client):
+        return not self.client_limit or self.client_running.get(client, 0) < self.client_limit
+
+    def has_runnable_client(self, name):
+        return any(self.client_can_run(client) for client in self.rounds[name])
+
+    def next_ticket(self, name):
+        """Pick the next ticket of a class by deficit round robin, skipping clients at their cap"""
+        clients = self.rounds[name]
+        deficits = self.deficits[name]
+        while clients:
+            client = clients[0]
+            if not self.client_can_run(client):
+                clients.rotate(-1)
+                if not self.has_runnable_client(name):
+                    return None
+                continue
+            ticket = self.queues[name][client][0]
+            if deficits.get(client, 0) < ticket.cost:
+                # Not enough credit this round; top up one turn and move to the back
+                deficits[client] = deficits.get(client, 0) + 1
+                clients.rotate(-1)
+                continue
+            deficits[client] -= ticket.cost
+            self.queues[name][client].popleft()
+            if not self.queues[name][client]:
+                del self.queues[name][client]
+                del deficits[client]
+                clients.popleft()
+            self.queued[name] -= 1
+            self.adjust(self.client_queued, client, -1)
+            return ticket
+        return None
+
+    def dispatch(self):
+        """Grant free slots to waiting requests; called with the lock held"""
+        while True:
+            eligible = [name for name in self.classes if self.queued[name] and self.can_run(name) and self.has_runnable_client(name)]
+            if not eligible:
+                return
+            name = min(eligible, key=lambda candidate: self.virtual_time[candidate])
+            self.grant(self.next_ticket(name))
+
+    def grant(self, ticket):
+        name = ticket.priority_class
+        # A class returning from idle starts at the current minimum so it cannot claim a backlog of turns
+        active = [self.virtual_time[other] for other in self.classes if other != name and (self.queued[other] or self.running[other])]
+        if active:
+            self.virtual_time[name] = max(self.virtual_time[name], min(active))
+        self.virtual_time[name] += 1.0 / max(self.classes[name]["weight"], 0.001)
+        self.running[name] += 1
+        self.adjust(self.client_running, ticket.client, 1)
+        self.stats[name]["admitted"] += 1
+        self.waits[name].append(time.time() - ticket.enqueued)
+        ticket.granted.set()
+
+    @staticmethod
+    def adjust(counts, client, amount):
+        counts[client] = counts.get(client, 0) + amount
+        if counts[client] <= 0:
+            del counts[client]
+
+    def acquire(self, priority_class, client="anonymous", cost=1.0, timeout=ADMISSION_MAX_WAIT):
+        """
+        Wait for a slot for a request of the given class and client
+        
+        Parameters:
+        priority_class (str): Name of the request's priority class
+        client (str): Client identity the request is fair-queued under
+        cost (float): Round-robin turns the request uses up
+        timeout (float): Longest time to wait in the queue
+        
+        Returns:
+        AdmissionTicket: Pass it to release() when the request finishes
+        
+        Raises AdmissionRejected if a queue is full or no slot frees within timeout.
+        """
+        ticket = AdmissionTicket(priority_class, client, cost)
+        with self.lock:
+            if not self.queued[priority_class] and self.can_run(priority_class) and self.client_can_run(client):
+                self.grant(ticket)
+                return ticket
+            if self.queued[priority_class] >= self.classes[priority_class]["max_queue"]:
+                self.stats[priority_class]["rejected"] += 1
+                raise AdmissionRejected(f"Too many queued {priority_class} requests, try again later", "queue_full")
+            if self.client_queued.get(client, 0) >= CLIENT_MAX_QUEUE:
+                self.stats[priority_class]["rejected"] += 1
+                raise AdmissionRejected("Too many queued requests from this client, try again later", "client_queue_full")
+            if client not in self.queues[priority_class]:
+                self.queues[priority_class][client] = deque()
+                self.rounds[priority_class].append(client)
+            self.queues[priority_class][client].append(ticket)
+            self.queued[priority_class] += 1
+            self.adjust(self.client_queued, client, 1)
+            self.dispatch()
+        
+        if not ticket.granted.wait(timeout):
+            with self.lock:
+                if not ticket.granted.is_set():
+                    self.remove(ticket)
+                    self.stats[priority_class]["timed_out"] += 1
+                    raise AdmissionRejected(
+                        f"No capacity for {priority_class} request after waiting {timeout:.0f}s, try again later", "queue_timeout")
+        return ticket
+
+    def remove(self, ticket):
+        """Take a ticket that gave up waiting out of its queue; called with the lock held"""
+        name, client = ticket.priority_class, ticket.client
+        self.queues[name][client].remove(ticket)
+        if not self.queues[name][client]:
+            del self.queues[name][client]
+            self.deficits[name].pop(client, None)
+            self.rounds[name].remove(client)
+        self.queued[name] -= 1
+        self.adjust(self.client_queued, client, -1)
+
+    def hold(self, ticket):
+        """Keep a granted slot until one more release(), e.g. while a worker still reads upstream"""
+        with self.lock:
+            if not ticket.released:
+                ticket.holds += 1
+
+    def release(self, ticket):
+        """Drop one hold on a slot; the slot frees once every holder has released it"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.holds -= 1
+            if ticket.holds > 0:
+                return
+            ticket.released = True
+            self.running[ticket.priority_class] -= 1
+            self.adjust(self.client_running, ticket.client, -1)
+            self.dispatch()
+
+    def snapshot(self):
+        with self.lock:
+            classes = {}
+            for name, config in self.classes.items():
+                waits = sorted(self.waits[name])
+                classes[name] = {
+                    **config,
+                    "running": self.running[name],
+                    "queued": self.queued[name],
+                    **self.stats[name],
+                    "wait_p50": round(waits[len(waits) // 2], 3) if waits else 0,
+                    "wait_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0
+                }
+            clients = {
+                client: {"in_flight": self.client_running.get(client, 0), "queued": self.client_queued.get(client, 0)}
+                for client in set(self.client_running) | set(self.client_queued)
+            }
+            return {
+                "capacity": self.capacity,
+                "shared_capacity": self.shared_capacity,
+                "client_limit": self.client_limit,
+                "classes": classes,
+                "clients": clients
+            }
+
+admission_scheduler = AdmissionScheduler(ADMISSION_MAX_CONCURRENCY, PRIORITY_CLASSES)
+
+def classify_priority(route_class):
+    """Pick the priority class for the current request from its header, model or route"""
+    header_class = request.headers.get(PRIORITY_HEADER, "").strip().lower()
+    if header_class in PRIORITY_CLASSES:
+        return header_class
+    data = request.get_json(silent=True) if request.is_json else None
+    model_class = PRIORITY_MODEL_CLASSES.get((data or {}).get('model'))
+    if model_class in PRIORITY_CLASSES:
+        return model_class
+    return PRIORITY_ROUTE_CLASSES.get(route_class, "interactive")
+
+def client_identity():
+    """
+    Identify the client for fair queueing: its IP, or a label of its bearer token
+    when CLIENT_IDENTITY is "auto"
+    
+    The token itself is never stored or logged, only a short hash of it.
+    """
+    auth = request.headers.get('Authorization', '')
+    if CLIENT_IDENTITY != "ip" and auth.lower().startswith("bearer ") and auth[7:].strip():
+        return "key-" + hashlib.sha256(auth[7:].strip().encode('utf-8')).hexdigest()[:12]
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.split(',')[0].strip() or request.remote_addr or "anonymous"
+
+class RequestSuperseded(Exception):
+    """Raised to stop work on a request replaced by a newer one from the same conversation"""
+    code = "superseded"
+
+class SupersedeToken:
+    """Cancellation flag for one in-flight request of a conversation"""
+    def __init__(self, scope, chain):
+        self.scope = scope
+        self.chain = chain
+        self.cancelled = threading.Event()
+
+class ConversationTracker:
+    """
+    Tracks in-flight requests per client and model
+    
+    A request supersedes an older in-flight one only when its messages start
+    with all of the older request's messages, i.e. it resends or continues
+    that conversation. Requests that merely share a system prompt or earlier
+    turns are independent. A superseded request stops before going upstream,
+    or closes its upstream stream at the next line.
+    """
+
+    def __init__(self):
+        self.active = {}
+        self.stats = {"tracked": 0, "superseded": 0, "cancelled_before_upstream": 0, "cancelled_streams": 0}
+        self.lock = threading.Lock()
+
+    def start(self, key):
+        scope, chain = key
+        token = SupersedeToken(scope, chain)
+        with self.lock:
+            in_flight = self.active.setdefault(scope, [])
+            superseded = [
+                other for other in in_flight
+                if len(other.chain) <= len(chain) and chain[len(other.chain) - 1] == other.chain[-1]
+            ]
+            for other in superseded:
+                in_flight.remove(other)
+            in_flight.append(token)
+            self.stats["tracked"] += 1
+            self.stats["superseded"] += len(superseded)
+        for other in superseded:
+            logger.info(f"Request in conversation {other.chain[-1][:12]} superseded by a newer one, cancelling it")
+            other.cancelled.set()
+        return token
+
+    def finish(self, token):
+        with self.lock:
+            in_flight = self.active.get(token.scope, [])
+            if token in in_flight:
+                in_flight.remove(token)
+            if not in_flight:
+                self.active.pop(token.scope, None)
+
+    def record(self, event):
+        with self.lock:
+            self.stats[event] += 1
+
+    def snapshot(self):
+        with self.lock:
+            in_flight = sum(len(tokens) for tokens in self.active.values())
+            return {"enabled": SUPERSEDE_ENABLED, "debounce": SUPERSEDE_DEBOUNCE, "in_flight": in_flight, **self.stats}
+
+conversation_tracker = ConversationTracker()
+
+def conversation_key(messages, model, client):
+    """
+    Identify the conversation of a request
+    
+    Returns:
+    tuple: (scope, chain) - scope is the client and model; chain[i] hashes
+    messages 0..i, so a request that extends another one carries the other's
+    last hash at the same position. None if there are no messages.
+    """
+    if not messages:
+        return None
+    digest = hashlib.sha256(json.dumps([client, model]).encode('utf-8'))
+    chain = []
+    for message in messages:
+        digest.update(json.dumps([message.get('role'), message_text(message)]).encode('utf-8'))
+        chain.append(digest.copy().hexdigest())
+    return (client, model), chain
+
+def run_admitted(handler, route_class, *args, **kwargs):
+    """
+    Run a route handler once the admission scheduler grants it a slot
+    
+    The slot is held until the response has been fully sent, and streams
+    started with stream_with_heartbeats hold it until their upstream request
+    has ended, so streamed completions count against the limit for as long
+    as Groq is generating them.
+    """
+    if not ADMISSION_ENABLED or request.method == 'OPTIONS':
+        return handler(*args, **kwargs)
+    priority_class = classify_priority(route_class)
+    client = client_identity()
+    deadline = request_deadline(route_class)
+    try:
+        cost = 1 + (len(request.get_data()) // 4) / CLIENT_DRR_TOKENS_PER_TURN
+        ticket = admission_scheduler.acquire(priority_class, client, cost, timeout=max(0, min(ADMISSION_MAX_WAIT, deadline.remaining())))
+    except AdmissionRejected as e:
+        logger.warning(str(e))
+        response = make_response(jsonify({
+            "error": {
+                "message": str(e),
+                "type": "server_error",
+                "param": None,
+                "code": e.code
+            }
+        }))
+        response.status_code = 503
+        response.headers['Retry-After'] = "1"
+        return response
+    
+    g.admitted_at = time.time()
+    g.admission_ticket = ticket
+    wait = g.admitted_at - ticket.enqueued
+    if wait > 0.05:
+        logger.info(f"Admitted {priority_class} request from {client} after {wait:.2f}s in queue")
+    try:
+        response = make_response(handler(*args, **kwargs))
+    except Exception:
+        admission_scheduler.release(ticket)
+        raise
+    response.call_on_close(lambda: admission_scheduler.release(ticket))
+    return response
+
+def admitted(route_class):
+    """Decorator that puts a route behind the admission scheduler"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            return run_admitted(handler, route_class, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def post_to_groq(request_data, headers, stream=False, retry=False, deadline=None, canceller=None):
+    """
+    Send a chat request to Groq through the circuit breaker for its model
+    
+    Parameters:
+    request_data (dict): The request body
+    headers (dict): Request headers; Authorization is replaced with a key from the pool
+    stream (bool): Whether to stream the response
+    retry (bool): True for retries, which are not counted as live traffic
+    deadline (Deadline): The client's deadline, which bounds queueing and the request timeouts
+    canceller (StreamCanceller): Tracks the response so it can be closed if the client goes away
+    
+    Returns:
+    Response: The requests response object
+    
+    Raises CircuitOpenError without calling Groq while the breaker is open,
+    RateLimitWaitExceeded if the rate limits would hold the request too long,
+    and DeadlineExceeded if the client's deadline has passed.
+    """
+    if deadline:
+        deadline.check()
+    if canceller and canceller.cancelled:
+        raise requests.exceptions.ConnectionError("Client disconnected, request not sent")
+    model = request_data.get('model', 'unknown')
+    breaker = get_circuit_breaker("groq", model)
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"Circuit breaker open for {breaker.name}, failing fast")
+    if not retry:
+        retry_budget.record_request()
+    
+    prompt_tokens = estimate_prompt_tokens(request_data)
+    for key_attempt in range(len(groq_key_pool.keys)):
+        # Use the pooled key with the most budget left
+        api_key = groq_key_pool.choose(prompt_tokens)
+        key_headers = {**headers, "Authorization": f"Bearer {api_key}"}
+        
+        # Wait for room under the key's rate limits rather than firing into a 429
+        rate_limit_state = get_rate_limit_state(api_key, model)
+        try:
+            rate_limit_state.acquire(prompt_tokens, max(0, min(RATE_LIMIT_MAX_QUEUE_WAIT, deadline.remaining())) if deadline else RATE_LIMIT_MAX_QUEUE_WAIT)
+        except RateLimitWaitExceeded:
+            groq_key_pool.release(api_key)
+            raise
+        
+        started = time.time()
+        try:
+            timeout = deadline.timeout() if deadline else GROQ_TIMEOUT
+        except DeadlineExceeded:
+            groq_key_pool.release(api_key)
+            raise
+        try:
+            response = requests.post(
+                f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
+                json=request_data,
+                headers=key_headers,
+                stream=stream,
+                timeout=timeout
+            )
+        except requests.exceptions.RequestException:
+            breaker.record_result(started)
+            groq_key_pool.release(api_key, failed=True)
+            raise
+        breaker.record_result(started, response.status_code)
+        rate_limit_state.update_from_headers(response.headers, response.status_code)
+        groq_key_pool.record_response(api_key, response.status_code, response.headers)
+        
+        if (response.status_code in (401, 429) and key_attempt < len(groq_key_pool.keys) - 1
+                and groq_key_pool.available_count()):
+            # The key was ejected; move the request to another pooled key
+            logger.info(f"Groq key {api_key_label(api_key)} returned {response.status_code}, switching keys")
+            response.close()
+            continue
+        return canceller.attach(response) if canceller else response
+
+# Mid-stream continuation counters, reported on /debug
+continuation_stats = {"attempts": 0, "spliced": 0, "failed": 0, "tokens_saved": 0}
+continuation_lock = threading.Lock()
 
-<preventing_recursion>
-You must NEVER get stuck in a loop of repeatedly trying to apply the same code edit. If you notice that you're attempting to make the same edit more than once:
-1. STOP immediately
-2. Explain to the user that you were unable to apply the edit
-3. Describe what you were trying to do
-4. Ask the user for guidance on how to proceed
-5. Wait for the user's response before taking any further action
-</preventing_recursion>
-"""
+def streamed_groq_completion(request_data, headers, deadline=None):
+    """
+    Get a complete chat.completion from Groq over a streaming call
+    
+    Streaming reaches the first token, and any upstream failure, sooner than a
+    blocking call, and a dropped connection is resumed from the partial output.
+    
+    Parameters:
+    request_data (dict): Request body for Groq (stream is forced on)
+    headers (dict): Request headers
+    deadline (Deadline): The client's deadline
+    
+    Returns:
+    tuple: (status_code, body) - the chat.completion dict on 200, otherwise the error text
+    """
+    request_data = dict(request_data, stream=True)
+    with post_to_groq(request_data, headers, stream=True, deadline=deadline) as groq_response:
+        if groq_response.status_code != 200:
+            return groq_response.status_code, groq_response.text
+        lines = iter_lines_with_continuation(groq_response, request_data, headers, deadline)
+        return 200, aggregate_completion(lines, request_data.get('model'), estimate_prompt_tokens(request_data))
 
-# Initialize a cache to track recent code edits (key: hash of edit, value: count)
-# TTL of 300 seconds (5 minutes) should be enough to prevent recursive edits in a single conversation
-code_edit_cache = TTLCache(maxsize=100, ttl=300)
+def record_continuation_event(event, amount=1):
+    with continuation_lock:
+        continuation_stats[event] += amount
 
-# Track consecutive edits to the same file
-file_edit_counter = TTLCache(maxsize=50, ttl=600)  # 10 minutes TTL
-MAX_CONSECUTIVE_EDITS = 3  # Maximum number of consecutive edits to the same file
+def continuation_request(request_data, emitted_text):
+    """
+    Build a request that resumes a completion from the text already streamed
+    
+    The partial output is appended as an assistant message, which the model
+    continues from instead of starting over.
+    """
+    continued = dict(request_data)
+    continued['messages'] = list(request_data.get('messages', [])) + [{"role": "assistant", "content": emitted_text}]
+    if continued.get('max_tokens'):
+        # Rough token estimate so the spliced response stays within the original limit
+        continued['max_tokens'] = max(1, continued['max_tokens'] - len(emitted_text) // 4)
+    return continued
+
+def iter_lines_with_continuation(groq_response, request_data, headers, deadline=None, canceller=None):
+    """
+    Yield decoded lines from a Groq stream, resuming it if the connection drops
+    
+    If the stream fails after content was sent but before a finish_reason
+    arrived, the request is reissued with the partial output as an assistant
+    prefix and the new stream is spliced in. Other failures are re-raised.
+    
+    Parameters:
+    groq_response: The open streaming response (status already checked)
+    request_data (dict): The request that produced the stream
+    headers (dict): Headers to reuse for the continuation request
+    deadline (Deadline): Stop reading, and do not continue, once it has passed
+    canceller (StreamCanceller): Do not continue once the client has gone away
+    """
+    emitted_parts = []
+    finished = False
+    attempts = 0
+    response = groq_response
+    try:
+        while True:
+            try:
+                for line in response.iter_lines():
+                    if deadline:
+                        # The client has given up; stop generating for it
+                        deadline.check()
+                    if not line:
+                        continue
+                    line = line.decode('utf-8')
+                    delta = parse_stream_delta(line)
+                    if delta:
+                        emitted_parts.append(delta[0])
+                        finished = finished or bool(delta[1])
+                    yield line
+                return
+            except requests.exceptions.RequestException as e:
+                emitted_text = "".join(emitted_parts)
+                if (not STREAM_CONTINUATION_ENABLED or finished or not emitted_text or (canceller and canceller.cancelled)
+                        or attempts >= STREAM_CONTINUATION_MAX_ATTEMPTS or not retry_budget.try_acquire()):
+                    raise
+                attempts += 1
+                record_continuation_event("attempts")
+                logger.warning(f"Stream dropped after {len(emitted_text)} characters ({str(e)[:100]}), continuing from partial output")
+                
+                if response is not groq_response:
+                    response.close()
+                    if canceller:
+                        canceller.detach(response)
+                try:
+                    response = post_to_groq(continuation_request(request_data, emitted_text), headers, stream=True, retry=True, deadline=deadline, canceller=canceller)
+                except (requests.exceptions.RequestException, CircuitOpenError, DeadlineExceeded):
+                    record_continuation_event("failed")
+                    raise e
+                if response.status_code != 200:
+                    logger.error(f"Continuation request failed: {response.status_code}")
+                    record_continuation_event("failed")
+                    raise e
+                
+                record_continuation_event("spliced")
+                record_continuation_event("tokens_saved", len(emitted_text) // 4)
+    finally:
+        if response is not groq_response:
+            response.close()
+            if canceller:
+                canceller.detach(response)
 
 @app.after_request
 def after_request(response):
@@ -239,6 +2885,29 @@ def debug():
                 "cache_size": len(r1_reasoning_cache),
                 "cache_ttl": "30 minutes"
             }
+        },
+        "cache_memory": get_cache_stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else {"enabled": False},
+        "canonicalization": canonicalization_counts,
+        "stream_continuation": {
+            "enabled": STREAM_CONTINUATION_ENABLED,
+            "max_attempts": STREAM_CONTINUATION_MAX_ATTEMPTS,
+            "stats": dict(continuation_stats)
+        },
+        "rate_limits": {
+            "admission_enabled": RATE_LIMIT_ADMISSION_ENABLED,
+            "max_queue_wait": RATE_LIMIT_MAX_QUEUE_WAIT,
+            "keys": {name: state.snapshot() for name, state in list(rate_limit_states.items())}
+        },
+        "api_keys": {"groq": groq_key_pool.snapshot()},
+        "admission": {"enabled": ADMISSION_ENABLED, **admission_scheduler.snapshot()},
+        "supersede": conversation_tracker.snapshot(),
+        "heartbeats": heartbeat_snapshot(),
+        "repetition": repetition_snapshot(),
+        "context_routing": {
+            "enabled": CONTEXT_ROUTING_ENABLED,
+            "capabilities": MODEL_CAPABILITIES,
+            "stats": dict(context_stats)
         }
     })
 
@@ -354,7 +3023,7 @@ def process_chat_request():
                 # Check if the model is r1sonqwen
                 if model == 'r1sonqwen':
                     logger.info("Processing r1sonqwen request")
-                    return process_r1sonqwen_request(data)
+                    return process_r1sonqwen_request(data, request_deadline("chat"))
                 
                 # Map to Groq model if needed
                 if model in MODEL_MAPPING:
@@ -372,42 +3041,79 @@ def process_chat_request():
                 logger.error("Failed to parse request data")
                 data = {}
         
-        # Check cache for this exact request
+        # Check cache for this exact request, after removing fields that don't affect the output
         cache_key = None
+        canonical_data = data
         if request.is_json:
             try:
-                cache_key = json.dumps(data, sort_keys=True)
+                canonical_data, fired = canonicalize_request(data)
+                record_canonicalization(fired)
+                cache_key = json.dumps(canonical_data, sort_keys=True)
                 if cache_key in request_cache:
                     logger.info("Using cached response for duplicate request")
-                    return request_cache[cache_key]
+                    return cached_completion_response(request_cache[cache_key], data.get('model', groq_model), data.get('stream') is not False)
             except Exception as e:
                 logger.error(f"Error checking cache: {str(e)}")
         
-        # Always enable streaming for better reliability
+        # Serve near-duplicate requests from the semantic cache
+        semantic_messages = None
+        if semantic_cache is not None and request.is_json and data.get('messages'):
+            semantic_messages = canonical_data.get('messages') or data['messages']
+            cached = semantic_cache.lookup(groq_model, semantic_messages, canonical_data)
+            if cached:
+                cached_response, similarity = cached
+                logger.info(f"Semantic cache hit (similarity: {similarity:.3f})")
+                return cached_completion_response(cached_response, data.get('model', groq_model), data.get('stream') is not False)
+        
+        # Always stream from Groq; non-streaming clients get the stream aggregated
         request_data = data.copy()
         request_data['stream'] = True
         
+        # Clamp max_tokens or move to a larger-context model before calling Groq
+        requested_model = request_data.get('model') or MODEL_MAPPING["default"]
+        request_data, fitted_model = fit_request_to_context(request_data, requested_model, list(MODEL_CAPABILITIES))
+        if fitted_model != requested_model:
+            request_data['model'] = fitted_model
+        
         # Forward the request to Groq
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {GROQ_API_KEY}"
         }
         
-        logger.info(f"Sending streaming request to Groq with {len(request_data.get('messages', []))} messages")
+        deadline = request_deadline("chat")
+        logger.info(f"Sending streaming request to Groq with {len(request_data.get('messages', []))} messages ({deadline.remaining():.0f}s left)")
         log_raw_data("GROQ REQUEST", request_data)
         
+        # A newer request from the same conversation cancels this one
+        supersede_token = None
+        if SUPERSEDE_ENABLED:
+            key = conversation_key(canonical_data.get('messages') or data.get('messages'), request_data.get('model'), client_identity())
+            if key:
+                supersede_token = conversation_tracker.start(key)
+        
+        # Closes the upstream response if the client disconnects
+        canceller = StreamCanceller()
+        
         def generate():
             try:
+                if supersede_token and supersede_token.cancelled.wait(SUPERSEDE_DEBOUNCE):
+                    conversation_tracker.record("cancelled_before_upstream")
+                    raise RequestSuperseded("Superseded by a newer request in the same conversation")
+                
+
                 # Create a list to collect streaming chunks for logging
                 collected_chunks = []
                 
-                with requests.post(
-                    f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-                    json=request_data,
-                    headers=headers,
-                    stream=True,
-                    timeout=GROQ_TIMEOUT
-                ) as groq_response:
+                # Collect the completion text so it can be stored in the request and semantic caches
+                completion_parts = []
+                completion_finish_reason = None
+                cacheable = cache_key is not None or semantic_messages is not None
+                
+                # Stops the stream early if the model starts repeating itself
+                repetition = repetition_detector_for(request_data, requested_model)
+                
+                with post_to_groq(request_data, headers, stream=True, deadline=deadline, canceller=canceller) as groq_response:
                     
                     # Check for error status
                     if groq_response.status_code != 200:
@@ -425,24 +3131,84 @@ def process_chat_request():
                         yield "data: [DONE]\n\n"
                         return
 
-                    # Process the streaming response
-                    for line in groq_response.iter_lines():
-                        if line:
-                            line = line.decode('utf-8')
-                            # Collect the chunk for logging instead of logging each one
-                            collected_chunks.append(line)
-                            
-                            if line.startswith('data: '):
-                                # Pass through the streaming data
-                                yield f"{line}\n\n"
-                            elif line.strip() == 'data: [DONE]':
-                                yield "data: [DONE]\n\n"
+                    # Process the streaming response, resuming it if the connection drops
+                    for line in iter_lines_with_continuation(groq_response, request_data, headers, deadline, canceller):
+                        if supersede_token and supersede_token.cancelled.is_set():
+                            # Stop reading so the upstream generation is dropped
+                            conversation_tracker.record("cancelled_streams")
+                            raise RequestSuperseded("Superseded by a newer request in the same conversation")
+                        
+                        # Collect the chunk for logging instead of logging each one
+                        collected_chunks.append(line)
+                        
+                        delta = parse_stream_delta(line) if cacheable or repetition else None
+                        if cacheable and delta:
+                            content, finish_reason, has_tool_calls = delta
+                            completion_parts.append(content)
+                            completion_finish_reason = finish_reason or completion_finish_reason
+                            # Tool calls are not replayable from text, so don't cache them
+                            cacheable = not has_tool_calls
+                        
+                        if line.startswith('data: '):
+                            # Pass through the streaming data
+                            yield f"{line}\n\n"
+                        elif line.strip() == 'data: [DONE]':
+                            yield "data: [DONE]\n\n"
+                        
+                        if repetition and delta and delta[0] and repetition.feed(delta[0]):
+                            # Leaving the loop closes the upstream stream; a stopped response is not cached
+                            cacheable = False
+                            yield from repetition_abort_events(repetition, requested_model)
+                            break
                 
                 # Log all collected chunks at once
                 if collected_chunks:
                     log_raw_data("GROQ STREAMING RESPONSE (COMPLETE)", 
                                  collect_streaming_chunks(collected_chunks))
+                
+                # Only complete streams are cached
+                if cacheable and completion_finish_reason and completion_parts:
+                    completion = {
+                        "content": "".join(completion_parts),
+                        "finish_reason": completion_finish_reason
+                    }
+                    if cache_key is not None:
+                        request_cache[cache_key] = completion
+                    if semantic_messages is not None:
+                        semantic_cache.store(groq_model, semantic_messages, canonical_data, completion)
 
+            except (CircuitOpenError, RateLimitWaitExceeded) as e:
+                logger.warning(str(e))
+                error_response = {
+                    "error": {
+                        "message": str(e),
+                        "type": "server_error",
+                        "code": e.code
+                    }
+                }
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
+            except DeadlineExceeded as e:
+                logger.warning(f"{str(e)}, abandoning upstream work")
+                error_response = {
+                    "error": {
+                        "message": str(e),
+                        "type": "timeout_error",
+                        "code": e.code
+                    }
+                }
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
+            except RequestSuperseded as e:
+                error_response = {
+                    "error": {
+                        "message": str(e),
+                        "type": "server_error",
+                        "code": e.code
+                    }
+                }
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
             except requests.exceptions.Timeout:
                 logger.error("Groq API timeout")
                 error_response = {
@@ -467,15 +3233,18 @@ def process_chat_request():
                 log_raw_data("STREAMING ERROR", {"error": str(e), "traceback": traceback.format_exc()})
                 yield f"data: {json.dumps(error_response)}\n\n"
                 yield "data: [DONE]\n\n"
-            finally:
-                # Clear the cache after processing the request
-                if cache_key in request_cache:
-                    del request_cache[cache_key]
-                    logger.info("Cache cleared for request")
 
+        # Clients that asked for stream: false get the upstream stream assembled into one completion
+        if data.get('stream') is False:
+            try:
+                return aggregated_response(aggregate_completion(generate(), requested_model, estimate_prompt_tokens(request_data)))
+            finally:
+                if supersede_token:
+                    conversation_tracker.finish(supersede_token)
+        
         # Return a streaming response
         response = app.response_class(
-            generate(),
+            stream_with_heartbeats(generate(), requested_model, g.get('admitted_at', time.time()), canceller, g.get('admission_ticket')),
             mimetype='text/event-stream',
             headers={
                 'Cache-Control': 'no-cache',
@@ -484,10 +3253,15 @@ def process_chat_request():
                 'x-request-id': str(uuid.uuid4())
             }
         )
+        if supersede_token:
+            response.call_on_close(lambda: conversation_tracker.finish(supersede_token))
         
         logger.info("Started streaming response")
         return response
             
+    except ContextLengthExceeded as e:
+        logger.warning(str(e))
+        return context_length_error(e)
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         logger.error(traceback.format_exc())
@@ -510,18 +3284,21 @@ def process_chat_request():
 
 # Route for standard OpenAI endpoint
 @app.route(OPENAI_CHAT_ENDPOINT, methods=['POST', 'OPTIONS'])
+@admitted("chat")
 def openai_chat_completions():
     logger.info(f"Request to standard OpenAI endpoint")
     return process_chat_request()
 
 # Route for Cursor's custom endpoint
 @app.route(CURSOR_CHAT_ENDPOINT, methods=['POST', 'OPTIONS'])
+@admitted("chat")
 def cursor_chat_completions():
     logger.info(f"Request to Cursor endpoint")
     return process_chat_request()
 
 # Catch-all route for any other chat completions endpoint
 @app.route('/<path:path>/chat/completions', methods=['POST', 'OPTIONS'])
+@admitted("chat")
 def any_chat_completions(path):
     logger.info(f"Request to custom path: /{path}/chat/completions")
     return process_chat_request()
@@ -580,10 +3357,14 @@ def list_models():
 def health_check():
     """Return health status of the proxy server"""
     logger.info("Health check request")
+    breaker_health = get_breaker_health()
+    any_open = any(breaker["state"] != "closed" for breaker in breaker_health["breakers"].values())
     return jsonify({
-        "status": "healthy",
+        "status": "degraded" if any_open else "healthy",
         "timestamp": time.time(),
-        "uptime": time.time() - start_time
+        "uptime": time.time() - start_time,
+        "circuit_breakers": breaker_health,
+        "cache_memory": get_cache_stats()
     })
 
 @app.route('/', methods=['GET'])
@@ -774,6 +3555,7 @@ start_time = time.time()
 
 # Add a new direct endpoint for simple message passing
 @app.route('/direct', methods=['POST', 'OPTIONS'])
+@admitted("direct")
 def direct_completion():
     """Simple endpoint that takes a single message and returns a response"""
     logger.info("Request to direct endpoint")
@@ -803,9 +3585,18 @@ def direct_completion():
             "messages": [
                 {"role": "user", "content": message}
             ],
-            "stream": False  # No streaming for direct endpoint
+            "stream": True  # Streamed from Groq and aggregated into one response
         }
         
+        # Serve near-duplicate messages from the semantic cache, keyed on the request's other params
+        cache_params = {k: v for k, v in data.items() if k != 'message'}
+        if semantic_cache is not None:
+            cached = semantic_cache.lookup(model, groq_request['messages'], cache_params)
+            if cached:
+                cached_response, similarity = cached
+                logger.info(f"Semantic cache hit for direct request (similarity: {similarity:.3f})")
+                return jsonify({"response": cached_response['content']})
+        
         # Forward the request to Groq
         headers = {
             "Content-Type": "application/json",
@@ -815,24 +3606,18 @@ def direct_completion():
         logger.info(f"Sending direct request to Groq")
         log_raw_data("DIRECT REQUEST", groq_request)
         
-        response = requests.post(
-            f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-            json=groq_request,
-            headers=headers,
-            timeout=GROQ_TIMEOUT
-        )
+        status_code, groq_response = streamed_groq_completion(groq_request, headers, deadline=request_deadline("direct"))
         
-        if response.status_code != 200:
-            logger.error(f"Groq API error: {response.status_code} - {response.text[:200]}")
-            log_raw_data("DIRECT ERROR RESPONSE", response.text)
+        if status_code != 200:
+            logger.error(f"Groq API error: {status_code} - {groq_response[:200]}")
+            log_raw_data("DIRECT ERROR RESPONSE", groq_response)
             return jsonify({
-                "error": f"Groq API error: {response.status_code}",
+                "error": f"Groq API error: {status_code}",
                 "message": "Failed to get response from Groq"
-            }), response.status_code
+            }), status_code
+        if "error" in groq_response:
+            return aggregated_response(groq_response)
         
-        # Parse the response
-        log_raw_data("DIRECT RAW RESPONSE", response.text)
-        groq_response = response.json()
         log_raw_data("DIRECT PARSED RESPONSE", groq_response)
         
         # Extract just the content from the response
@@ -840,8 +3625,17 @@ def direct_completion():
             content = groq_response["choices"][0]["message"]["content"]
             result = {"response": content}
             log_raw_data("DIRECT FINAL RESPONSE", result)
+            if semantic_cache is not None and content:
+                semantic_cache.store(model, groq_request['messages'], cache_params, {
+                    "content": content,
+                    "finish_reason": groq_response["choices"][0].get("finish_reason"),
+                    "usage": groq_response.get("usage", {})
+                })
             return jsonify(result)
             
+    except DeadlineExceeded as e:
+        logger.warning(str(e))
+        return deadline_error(e)
     except Exception as e:
         logger.error(f"Error processing direct request: {str(e)}")
         logger.error(traceback.format_exc())
@@ -849,6 +3643,7 @@ def direct_completion():
 
 # Add a simple non-streaming endpoint for Cursor
 @app.route('/simple', methods=['POST', 'OPTIONS'])
+@admitted("simple")
 def simple_completion():
     """Simple non-streaming endpoint for Cursor"""
     logger.info("Request to simple endpoint")
@@ -901,10 +3696,30 @@ def simple_completion():
             logger.error("Failed to parse request data")
             return jsonify({"error": "Invalid request format"}), 400
         
+        # Serve near-duplicate requests from the semantic cache
+        if semantic_cache is not None and data.get('messages'):
+            cached = semantic_cache.lookup(groq_model, data['messages'], data)
+            if cached:
+                cached_response, similarity = cached
+                logger.info(f"Semantic cache hit for simple request (similarity: {similarity:.3f})")
+                return jsonify({
+                    "id": f"chatcmpl-{uuid.uuid4()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": cached_response['content']},
+                        "finish_reason": cached_response['finish_reason'] or "stop"
+                    }],
+                    "usage": cached_response.get('usage', {})
+                })
+        
         # Create request for Groq
         groq_request = data.copy()
         groq_request['model'] = groq_model
-        groq_request['stream'] = False  # Explicitly disable streaming
+        groq_request['stream'] = True  # Streamed from Groq and aggregated into one response
+        groq_request, groq_request['model'] = fit_request_to_context(groq_request, groq_model, list(MODEL_CAPABILITIES))
         
         # Forward the request to Groq
         headers = {
@@ -915,27 +3730,21 @@ def simple_completion():
         logger.info(f"Sending non-streaming request to Groq")
         log_raw_data("SIMPLE REQUEST", groq_request)
         
-        response = requests.post(
-            f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-            json=groq_request,
-            headers=headers,
-            timeout=GROQ_TIMEOUT
-        )
+        status_code, groq_response = streamed_groq_completion(groq_request, headers, deadline=request_deadline("simple"))
         
-        if response.status_code != 200:
-            logger.error(f"Groq API error: {response.status_code} - {response.text[:200]}")
-            log_raw_data("SIMPLE ERROR RESPONSE", response.text)
+        if status_code != 200:
+            logger.error(f"Groq API error: {status_code} - {groq_response[:200]}")
+            log_raw_data("SIMPLE ERROR RESPONSE", groq_response)
             return jsonify({
                 "error": {
-                    "message": f"Groq API error: {response.status_code}",
+                    "message": f"Groq API error: {status_code}",
                     "type": "server_error",
                     "code": "groq_error"
                 }
-            }), response.status_code
+            }), status_code
+        if "error" in groq_response:
+            return aggregated_response(groq_response)
         
-        # Parse the response
-        log_raw_data("SIMPLE RAW RESPONSE", response.text)
-        groq_response = response.json()
         log_raw_data("SIMPLE PARSED RESPONSE", groq_response)
         
         # Format as OpenAI response
@@ -949,9 +3758,26 @@ def simple_completion():
         }
         
         log_raw_data("SIMPLE FORMATTED RESPONSE", openai_response)
+        
+        # Store plain text completions in the semantic cache
+        if semantic_cache is not None and data.get('messages') and openai_response["choices"]:
+            message = openai_response["choices"][0].get("message", {})
+            if message.get("content") and not message.get("tool_calls"):
+                semantic_cache.store(groq_model, data['messages'], data, {
+                    "content": message["content"],
+                    "finish_reason": openai_response["choices"][0].get("finish_reason"),
+                    "usage": openai_response["usage"]
+                })
+        
         logger.info(f"Successfully processed simple request")
         return jsonify(openai_response)
             
+    except ContextLengthExceeded as e:
+        logger.warning(str(e))
+        return context_length_error(e)
+    except DeadlineExceeded as e:
+        logger.warning(str(e))
+        return deadline_error(e)
     except Exception as e:
         logger.error(f"Error processing simple request: {str(e)}")
         logger.error(traceback.format_exc())
@@ -1067,12 +3893,13 @@ def handle_tool_usage(tool_name, parameters):
     
     return response
 
-def send_request_to_groq(request_data):
+def send_request_to_groq(request_data, deadline=None):
     """
     Send a request to Groq API and return the response
     
     Parameters:
     request_data (dict): The request data to send to Groq
+    deadline (Deadline): Retries stop once the client's deadline has passed
     
     Returns:
     dict: The response from Groq
@@ -1085,31 +3912,42 @@ def send_request_to_groq(request_data):
     # Log the request
     logger.info(f"Sending request to Groq for model: {request_data.get('model', 'unknown')}")
     
-    # Try up to MAX_RETRIES times
+    # Try up to MAX_RETRIES times, as long as the retry budget allows
+    last_error = None
+    rate_limited = False
     for attempt in range(MAX_RETRIES):
+        if attempt > 0:
+            if not retry_budget.try_acquire():
+                logger.warning("Retry budget exhausted, not retrying Groq request")
+                raise last_error
+            if not rate_limited:
+                # After a 429 the admission queue already waits for retry-after
+                backoff = 2 ** (attempt - 1)  # Exponential backoff
+                if deadline and backoff >= deadline.remaining():
+                    logger.warning("Not enough time left before the deadline to retry the Groq request")
+                    raise last_error
+                time.sleep(backoff)
         try:
-            response = requests.post(
-                f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-                json=request_data,
-                headers=headers,
-                timeout=GROQ_TIMEOUT
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"Groq API error (attempt {attempt+1}/{MAX_RETRIES}): {response.status_code} - {response.text[:200]}")
-                if attempt == MAX_RETRIES - 1:
-                    raise Exception(f"Groq API error: {response.status_code} - {response.text[:200]}")
-                time.sleep(2 ** attempt)  # Exponential backoff
+            response = post_to_groq(request_data, headers, retry=attempt > 0, deadline=deadline)
+        except (CircuitOpenError, RateLimitWaitExceeded, DeadlineExceeded):
+            # Groq is known to be failing or saturated, retrying would only add load
+            raise
         except Exception as e:
             logger.error(f"Error sending request to Groq (attempt {attempt+1}/{MAX_RETRIES}): {str(e)}")
-            if attempt == MAX_RETRIES - 1:
-                raise
-            time.sleep(2 ** attempt)  # Exponential backoff
+            last_error = e
+            rate_limited = False
+            continue
+        
+        rate_limited = response.status_code == 429
+        if response.status_code == 200:
+            return response.json()
+        logger.error(f"Groq API error (attempt {attempt+1}/{MAX_RETRIES}): {response.status_code} - {response.text[:200]}")
+        last_error = Exception(f"Groq API error: {response.status_code} - {response.text[:200]}")
+        if response.status_code != 429 and response.status_code < 500:
+            # Client errors will not succeed on a retry
+            break
     
-    # This should never be reached due to the exception in the loop
-    raise Exception("Failed to send request to Groq after multiple attempts")
+    raise last_error
 
 def extract_content_from_response(response):
     """
@@ -1126,12 +3964,16 @@ def extract_content_from_response(response):
     
     return response['choices'][0]['message']['content']
 
-def process_r1sonqwen_request(data):
+def process_r1sonqwen_request(data, deadline):
     """
     Process a request using the R1sonQwen chain:
     1. Use R1 to create a reasoning chain based on Cursor system prompts
     2. Pass the reasoning and original system prompts to Qwen
     3. Return Qwen's response with minimal transformation to match Cursor expectations
+    
+    Both stages share the request deadline. R1 only gets the time left after
+    R1_STAGE_RESERVE seconds are kept for Qwen, and is skipped when that is
+    less than R1_MIN_SECONDS.
     """
     try:
         logger.info("Starting r1sonqwen chain processing")
@@ -1144,116 +3986,123 @@ def process_r1sonqwen_request(data):
         stream_mode = data.get('stream', False)
         logger.info(f"Stream mode: {stream_mode}")
         
-        # Try to get reasoning from R1 or cache
-        r1_reasoning = None
-        try:
-            cache_key = json.dumps(data, sort_keys=True)
-            if cache_key in r1_reasoning_cache:
-                logger.info("Using cached R1 reasoning")
-                r1_reasoning = r1_reasoning_cache[cache_key]
-                logger.info(f"Retrieved cached reasoning of length: {len(r1_reasoning)}")
-            else:
-                logger.info("No cached reasoning found, proceeding with R1 call")
+        # The reasoning doesn't depend on stream, user or other volatile fields
+        canonical_data, fired = canonicalize_request(data)
+        record_canonicalization(fired)
+        cache_key = json.dumps(canonical_data, sort_keys=True)
+        
+        def build_qwen_request():
+            """Run the R1 stage (or use its cached reasoning) and build the Qwen request"""
+            # Try to get reasoning from R1 or cache
+            r1_reasoning = None
+            try:
+                if cache_key in r1_reasoning_cache:
+                    logger.info("Using cached R1 reasoning")
+                    r1_reasoning = r1_reasoning_cache[cache_key]
+                    logger.info(f"Retrieved cached reasoning of length: {len(r1_reasoning)}")
+                elif deadline.remaining() - R1_STAGE_RESERVE < R1_MIN_SECONDS:
+                    logger.info(f"Only {deadline.remaining():.0f}s left before the deadline, skipping R1 reasoning")
+                else:
+                    logger.info("No cached reasoning found, proceeding with R1 call")
                 
-                # Create R1 request with focus on reasoning chain
-                r1_request = {
-                    "model": "deepseek-r1-distill-qwen-32b",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": """You are a reasoning chain generator. Your task is to analyze the user's request and create a structured reasoning chain that follows this format:
-
-<reasoning_chain>
-1. CONTEXT ANALYSIS
-- Available files and their purposes
-- Current state and issues
-- User's specific request
-
-2. IMPLEMENTATION APPROACH
-- Required changes
-- Potential challenges
-- Dependencies and considerations
-
-3. EXECUTION PLAN
-- Step-by-step implementation
-- Testing requirements
-- Success criteria
-
-4. VALIDATION STRATEGY
-- Error handling
-- Edge cases
-- Quality assurance steps
-</reasoning_chain>
-
-Focus ONLY on creating this reasoning chain. DO NOT provide any implementation details or code."""
-                        }
-                    ],
-                    "temperature": 0.3,  # Lower temperature for more deterministic reasoning
-                    "max_tokens": 1000,
-                    "stream": False  # Never stream the R1 request
-                }
+                    # Create R1 request with focus on reasoning chain
+                    r1_request = {
+                        "model": "deepseek-r1-distill-qwen-32b",
+                        "messages": [
+                            {
+                                "role": "system",
+                                "content": """You are a reasoning chain generator. Your task is to analyze the user's request and create a structured reasoning chain that follows this format:
+
+    <reasoning_chain>
+    1. CONTEXT ANALYSIS
+    - Available files and their purposes
+    - Current state and issues
+    - User's specific request
+
+    2. IMPLEMENTATION APPROACH
+    - Required changes
+    - Potential challenges
+    - Dependencies and considerations
+
+    3. EXECUTION PLAN
+    - Step-by-step implementation
+    - Testing requirements
+    - Success criteria
+
+    4. VALIDATION STRATEGY
+    - Error handling
+    - Edge cases
+    - Quality assurance steps
+    </reasoning_chain>
+
+    Focus ONLY on creating this reasoning chain. DO NOT provide any implementation details or code."""
+                            }
+                        ],
+                        "temperature": 0.3,  # Lower temperature for more deterministic reasoning
+                        "max_tokens": 1000,
+                        "stream": False  # Never stream the R1 request
+                    }
                 
-                # Add user messages but filter out assistant messages
-                user_messages = [msg for msg in original_messages if msg['role'] in ['user', 'system']]
-                r1_request['messages'].extend(user_messages)
+                    # Add user messages but filter out assistant messages
+                    user_messages = [msg for msg in original_messages if msg['role'] in ['user', 'system']]
+                    r1_request['messages'].extend(user_messages)
                 
-                # Send request to R1
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {GROQ_API_KEY}"
-                }
+                    # Send request to R1
+                    headers = {
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {GROQ_API_KEY}"
+                    }
                 
-                log_raw_data("R1 REQUEST", r1_request)
+                    log_raw_data("R1 REQUEST", r1_request)
                 
-                r1_response_raw = requests.post(
-                    f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-                    json=r1_request,
-                    headers=headers,
-                    timeout=GROQ_TIMEOUT
-                )
+                    r1_response_raw = post_to_groq(r1_request, headers, deadline=Deadline(deadline.remaining() - R1_STAGE_RESERVE))
                 
-                logger.info(f"R1 response status: {r1_response_raw.status_code}")
-                log_raw_data("R1 RAW RESPONSE", r1_response_raw.text)
+                    logger.info(f"R1 response status: {r1_response_raw.status_code}")
+                    log_raw_data("R1 RAW RESPONSE", r1_response_raw.text)
                 
-                if r1_response_raw.status_code == 200:
-                    r1_response = r1_response_raw.json()
-                    log_raw_data("R1 PARSED RESPONSE", r1_response)
+                    if r1_response_raw.status_code == 200:
+                        r1_response = r1_response_raw.json()
+                        log_raw_data("R1 PARSED RESPONSE", r1_response)
                     
-                    if 'choices' in r1_response and len(r1_response['choices']) > 0:
-                        r1_reasoning = r1_response['choices'][0]['message']['content']
-                        logger.info(f"Successfully extracted reasoning chain (length: {len(r1_reasoning)})")
-                        r1_reasoning_cache[cache_key] = r1_reasoning
-        except Exception as e:
-            logger.error(f"Error getting reasoning from R1: {str(e)}")
-            logger.error(traceback.format_exc())
-            # Continue without reasoning
-            r1_reasoning = None
+                        if 'choices' in r1_response and len(r1_response['choices']) > 0:
+                            r1_reasoning = r1_response['choices'][0]['message']['content']
+                            logger.info(f"Successfully extracted reasoning chain (length: {len(r1_reasoning)})")
+                            r1_reasoning_cache[cache_key] = r1_reasoning
+            except Exception as e:
+                logger.error(f"Error getting reasoning from R1: {str(e)}")
+                logger.error(traceback.format_exc())
+                # Continue without reasoning
+                r1_reasoning = None
         
-        # Create Qwen request
-        qwen_request = {
-            "model": "qwen-2.5-coder-32b",
-            "messages": original_messages.copy(),
-            "temperature": data.get('temperature', 0.7),
-            "max_tokens": data.get('max_tokens', 1000),
-            "stream": stream_mode
-        }
+            # Create Qwen request
+            qwen_request = {
+                "model": "qwen-2.5-coder-32b",
+                "messages": original_messages.copy(),
+                "temperature": data.get('temperature', 0.7),
+                "max_tokens": data.get('max_tokens', 1000),
+                "stream": stream_mode
+            }
         
-        # Add the reasoning as a system message if there isn't already one and if we have reasoning
-        if r1_reasoning:
-            has_system = False
-            for msg in qwen_request["messages"]:
-                if msg.get("role") == "system":
-                    has_system = True
-                    # Append reasoning to existing system message
-                    msg["content"] += f"\n\nReasoning chain:\n{r1_reasoning}"
-                    break
+            # Add the reasoning as a system message if there isn't already one and if we have reasoning
+            if r1_reasoning:
+                has_system = False
+                for msg in qwen_request["messages"]:
+                    if msg.get("role") == "system":
+                        has_system = True
+                        # Append reasoning to existing system message
+                        msg["content"] += f"\n\nReasoning chain:\n{r1_reasoning}"
+                        break
             
-            if not has_system:
-                # Insert a system message with the reasoning at the beginning
-                qwen_request["messages"].insert(0, {
-                    "role": "system",
-                    "content": f"Reasoning chain:\n{r1_reasoning}"
-                })
+                if not has_system:
+                    # Insert a system message with the reasoning at the beginning
+                    qwen_request["messages"].insert(0, {
+                        "role": "system",
+                        "content": f"Reasoning chain:\n{r1_reasoning}"
+                    })
+            
+            logger.info(f"Sending request to Qwen with stream={stream_mode}")
+            log_raw_data("QWEN REQUEST", qwen_request)
+            return qwen_request
         
         # Forward to Qwen
         headers = {
@@ -1261,15 +4110,12 @@ Focus ONLY on creating this reasoning chain. DO NOT provide any implementation d
             "Authorization": f"Bearer {GROQ_API_KEY}"
         }
         
-        logger.info(f"Sending request to Qwen with stream={stream_mode}")
-        log_raw_data("QWEN REQUEST", qwen_request)
-        
         if stream_mode:
-            # Handle streaming response
-            return handle_qwen_streaming(qwen_request, headers)
+            # Handle streaming response; R1 runs inside the stream so the client gets bytes at once
+            return handle_qwen_streaming(build_qwen_request, headers, deadline)
         else:
             # Handle non-streaming response
-            return handle_qwen_non_streaming(qwen_request, headers)
+            return handle_qwen_non_streaming(build_qwen_request(), headers, deadline)
     
     except Exception as e:
         logger.error(f"Error in R1sonQwen chain: {str(e)}")
@@ -1295,10 +4141,21 @@ Focus ONLY on creating this reasoning chain. DO NOT provide any implementation d
         return jsonify(error_response)
 
 # Helper function for Qwen streaming
-def handle_qwen_streaming(qwen_request, headers):
-    """Handle streaming response from Qwen - with special handling for code blocks"""
+def handle_qwen_streaming(build_request, headers, deadline=None):
+    """
+    Handle streaming response from Qwen - with special handling for code blocks
+    
+    build_request() runs the R1 stage and returns the Qwen request. It is
+    called inside the stream, so the client gets the role delta and
+    heartbeats while R1 is reasoning.
+    """
+    # Closes the upstream response if the client disconnects
+    canceller = StreamCanceller()
+    
     def generate():
         try:
+            qwen_request = build_request()
+            
             # Create a list to collect streaming chunks for logging
             collected_chunks = []
             
@@ -1307,13 +4164,7 @@ def handle_qwen_streaming(qwen_request, headers):
             code_block_count = 0
             last_chunk_time = time.time()
             
-            with requests.post(
-                f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-                json=qwen_request,
-                headers=headers,
-                stream=True,
-                timeout=GROQ_TIMEOUT
-            ) as groq_response:
+            with post_to_groq(qwen_request, headers, stream=True, deadline=deadline, canceller=canceller) as groq_response:
                 
                 # Check for error status
                 if groq_response.status_code != 200:
@@ -1331,32 +4182,30 @@ def handle_qwen_streaming(qwen_request, headers):
                     yield "data: [DONE]\n\n"
                     return
 
-                # Process the streaming response
-                for line in groq_response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        last_chunk_time = time.time()
-                        
-                        # Collect the chunk for logging
-                        collected_chunks.append(line)
-                        
-                        # Check if we're entering or exiting a code block
-                        if line.startswith('data: ') and '"content":"```' in line:
-                            in_code_block = True
-                            code_block_count += 1
-                            logger.info(f"Entering code block #{code_block_count}")
-                        elif line.startswith('data: ') and '"content":"```' in line and in_code_block:
-                            in_code_block = False
-                            logger.info(f"Exiting code block #{code_block_count}")
-                        
-                        if line.startswith('data: '):
-                            # Only modify the model name, nothing else
-                            if '"model":"qwen-2.5-coder-32b"' in line:
-                                line = line.replace('"model":"qwen-2.5-coder-32b"', '"model":"r1sonqwen"')
-                            # Pass through the streaming data
-                            yield f"{line}\n\n"
-                        elif line.strip() == 'data: [DONE]':
-                            yield "data: [DONE]\n\n"
+                # Process the streaming response, resuming it if the connection drops
+                for line in iter_lines_with_continuation(groq_response, qwen_request, headers, deadline, canceller):
+                    last_chunk_time = time.time()
+                    
+                    # Collect the chunk for logging
+                    collected_chunks.append(line)
+                    
+                    # Check if we're entering or exiting a code block
+                    if line.startswith('data: ') and '"content":"```' in line:
+                        in_code_block = True
+                        code_block_count += 1
+                        logger.info(f"Entering code block #{code_block_count}")
+                    elif line.startswith('data: ') and '"content":"```' in line and in_code_block:
+                        in_code_block = False
+                        logger.info(f"Exiting code block #{code_block_count}")
+                    
+                    if line.startswith('data: '):
+                        # Only modify the model name, nothing else
+                        if '"model":"qwen-2.5-coder-32b"' in line:
+                            line = line.replace('"model":"qwen-2.5-coder-32b"', '"model":"r1sonqwen"')
+                        # Pass through the streaming data
+                        yield f"{line}\n\n"
+                    elif line.strip() == 'data: [DONE]':
+                        yield "data: [DONE]\n\n"
                 
                 # Log all collected chunks at once
                 if collected_chunks:
@@ -1386,6 +4235,28 @@ def handle_qwen_streaming(qwen_request, headers):
                 # Wait a moment before closing to ensure all data is processed
                 time.sleep(0.5)
 
+        except (CircuitOpenError, RateLimitWaitExceeded) as e:
+            logger.warning(str(e))
+            error_response = {
+                "error": {
+                    "message": str(e),
+                    "type": "server_error",
+                    "code": e.code
+                }
+            }
+            yield f"data: {json.dumps(error_response)}\n\n"
+            yield "data: [DONE]\n\n"
+        except DeadlineExceeded as e:
+            logger.warning(f"{str(e)}, abandoning upstream work")
+            error_response = {
+                "error": {
+                    "message": str(e),
+                    "type": "timeout_error",
+                    "code": e.code
+                }
+            }
+            yield f"data: {json.dumps(error_response)}\n\n"
+            yield "data: [DONE]\n\n"
         except requests.exceptions.Timeout:
             logger.error("Groq API timeout")
             error_response = {
@@ -1413,7 +4284,7 @@ def handle_qwen_streaming(qwen_request, headers):
 
     # Return a streaming response with keep-alive headers
     response = app.response_class(
-        generate(),
+        stream_with_heartbeats(generate(), "r1sonqwen", g.get('admitted_at', time.time()), canceller, g.get('admission_ticket')),
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
@@ -1428,40 +4299,161 @@ def handle_qwen_streaming(qwen_request, headers):
     return response
 
 # Helper function for Qwen non-streaming
-def handle_qwen_non_streaming(qwen_request, headers):
-    """Handle non-streaming response from Qwen"""
-    qwen_response_raw = requests.post(
-        f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-        json=qwen_request,
-        headers=headers,
-        timeout=GROQ_TIMEOUT
-    )
+def handle_qwen_non_streaming(qwen_request, headers, deadline=None):
+    """Handle non-streaming response from Qwen, streamed from Groq and aggregated"""
+    status_code, qwen_response = streamed_groq_completion(qwen_request, headers, deadline)
     
-    if qwen_response_raw.status_code != 200:
-        logger.error(f"Qwen API error: {qwen_response_raw.status_code} - {qwen_response_raw.text[:200]}")
-        log_raw_data("QWEN ERROR RESPONSE", qwen_response_raw.text)
-        raise Exception(f"Qwen API error: {qwen_response_raw.status_code}")
+    if status_code != 200:
+        logger.error(f"Qwen API error: {status_code} - {qwen_response[:200]}")
+        log_raw_data("QWEN ERROR RESPONSE", qwen_response)
+        raise Exception(f"Qwen API error: {status_code}")
+    if "error" in qwen_response:
+        raise Exception(f"Qwen stream error: {qwen_response['error'].get('message')}")
     
-    # Log the raw response text for debugging
-    logger.info(f"Qwen raw response text (first 500 chars): {qwen_response_raw.text[:500]}...")
-    log_raw_data("QWEN RAW RESPONSE", qwen_response_raw.text)
+    # Only change the model name
+    qwen_response['model'] = 'r1sonqwen'
     
-    try:
-        # Get the raw response and only change the model name
-        qwen_response = qwen_response_raw.json()
-        qwen_response['model'] = 'r1sonqwen'
-        
-        log_raw_data("QWEN MODIFIED RESPONSE", qwen_response)
+    log_raw_data("QWEN MODIFIED RESPONSE", qwen_response)
+    
+    logger.info("Successfully processed r1sonqwen chain")
+    logger.info(f"Response structure: {json.dumps(qwen_response)[:500]}...")
+    return jsonify(qwen_response)
+
+def stream_agent_response(groq_request, headers, model, deadline):
+    """
+    Stream an agent-mode response, watching it for recursive edit attempts
+    
+    The content is scanned chunk by chunk with scan_stream_text. When a
+    pattern fires, AGENT_RECURSION_WARNING is sent as one more content delta
+    after the last content and before the finish chunk (or before [DONE] if
+    none arrives). A chunk carrying both content and the finish_reason is
+    split so the warning can go between them.
+    """
+    def warning_event():
+        chunk = {
+            "id": f"chatcmpl-{uuid.uuid4()}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": AGENT_RECURSION_WARNING}, "finish_reason": None}]
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    # Closes the upstream response if the client disconnects
+    canceller = StreamCanceller()
+
+    def generate():
+        scan_tail = ""
+        detected = False
+        warned = False
+        repetition = repetition_detector_for(groq_request, model)
+        try:
+            collected_chunks = []
+            
+            with post_to_groq(groq_request, headers, stream=True, deadline=deadline, canceller=canceller) as groq_response:
+                if groq_response.status_code != 200:
+                    logger.error(f"Groq API error: {groq_response.status_code} - {groq_response.text[:200]}")
+                    log_raw_data("AGENT MODE ERROR RESPONSE", groq_response.text)
+                    error_response = {
+                        "error": {
+                            "message": f"Groq API error: {groq_response.status_code}",
+                            "type": "server_error",
+                            "code": "groq_error"
+                        }
+                    }
+                    yield f"data: {json.dumps(error_response)}\n\n"
+                    yield "data: [DONE]\n\n"
+                    return
+                
+                for line in iter_lines_with_continuation(groq_response, groq_request, headers, deadline, canceller):
+                    collected_chunks.append(line)
+                    if line.strip() == 'data: [DONE]':
+                        break
+                    if not line.startswith('data: '):
+                        continue
+                    delta = parse_stream_delta(line)
+                    if delta:
+                        content, finish_reason, has_tool_calls = delta
+                        if content and not detected:
+                            scan_tail, found = scan_stream_text(scan_tail, content, AGENT_RECURSIVE_RESPONSE_INDICATORS)
+                            if found:
+                                detected = True
+                                logger.warning(f"Detected recursive behavior in streamed model response: {found[0]!r}")
+                        if finish_reason and detected and not warned:
+                            warned = True
+                            if content or has_tool_calls:
+                                # Send this chunk's content first, then the warning, then its finish_reason on its own
+                                chunk = json.loads(line[6:])
+                                finish_chunk = {**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}
+                                content_chunk = {key: value for key, value in chunk.items() if key not in ("usage", "x_groq")}
+                                content_chunk["choices"][0]["finish_reason"] = None
+                                yield f"data: {json.dumps(content_chunk)}\n\n"
+                                line = f"data: {json.dumps(finish_chunk)}"
+                            yield warning_event()
+                    yield f"{line}\n\n"
+                    if repetition and delta and delta[0] and repetition.feed(delta[0]):
+                        break
+            
+            if collected_chunks:
+                log_raw_data("AGENT MODE STREAMING RESPONSE (COMPLETE)", collect_streaming_chunks(collected_chunks))
+            if detected and not warned:
+                yield warning_event()
+            if repetition and repetition.reason:
+                # The upstream stream was stopped early; finish the response cleanly
+                yield from repetition_abort_events(repetition, model)
+                return
+            yield "data: [DONE]\n\n"
         
-        logger.info("Successfully processed r1sonqwen chain")
-        logger.info(f"Response structure: {json.dumps(qwen_response)[:500]}...")
-        return jsonify(qwen_response)
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error for Qwen response: {str(e)}")
-        logger.error(f"Raw response: {qwen_response_raw.text}")
-        raise Exception(f"Failed to parse Qwen response: {str(e)}")
+        except (CircuitOpenError, RateLimitWaitExceeded) as e:
+            logger.warning(str(e))
+            error_response = {
+                "error": {
+                    "message": str(e),
+                    "type": "server_error",
+                    "code": e.code
+                }
+            }
+            yield f"data: {json.dumps(error_response)}\n\n"
+            yield "data: [DONE]\n\n"
+        except DeadlineExceeded as e:
+            logger.warning(f"{str(e)}, abandoning upstream work")
+            error_response = {
+                "error": {
+                    "message": str(e),
+                    "type": "timeout_error",
+                    "code": e.code
+                }
+            }
+            yield f"data: {json.dumps(error_response)}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            logger.error(f"Error during agent mode streaming: {str(e)}")
+            error_response = {
+                "error": {
+                    "message": str(e),
+                    "type": "server_error",
+                    "code": "stream_error"
+                }
+            }
+            log_raw_data("STREAMING ERROR", {"error": str(e), "traceback": traceback.format_exc()})
+            yield f"data: {json.dumps(error_response)}\n\n"
+            yield "data: [DONE]\n\n"
+
+    response = app.response_class(
+        stream_with_heartbeats(generate(), model, g.get('admitted_at', time.time()), canceller, g.get('admission_ticket')),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'access-control-expose-headers': 'X-Request-ID',
+            'x-request-id': str(uuid.uuid4())
+        }
+    )
+    logger.info("Started streaming agent mode response")
+    return response
 
 @app.route('/agent', methods=['POST', 'OPTIONS'])
+@admitted("agent")
 def agent_mode():
     """Special agent mode endpoint that includes agent instructions in the system prompt"""
     logger.info("Request to agent mode endpoint")
@@ -1597,7 +4589,8 @@ def agent_mode():
         # Create request for Groq
         groq_request = data.copy()
         groq_request['model'] = groq_model
-        groq_request['stream'] = False  # Explicitly disable streaming for agent mode
+        groq_request['stream'] = True  # Always streamed from Groq; aggregated for non-streaming clients
+        groq_request, groq_request['model'] = fit_request_to_context(groq_request, groq_model, list(MODEL_CAPABILITIES))
         
         # Forward the request to Groq
         headers = {
@@ -1608,46 +4601,36 @@ def agent_mode():
         logger.info(f"Sending agent mode request to Groq")
         log_raw_data("AGENT MODE REQUEST", groq_request)
         
-        response = requests.post(
-            f"{GROQ_BASE_URL}{GROQ_CHAT_ENDPOINT}",
-            json=groq_request,
-            headers=headers,
-            timeout=GROQ_TIMEOUT
-        )
+        # Streaming clients get tokens as they arrive, checked for recursive edits on the way
+        if data.get('stream'):
+            return stream_agent_response(groq_request, headers, data.get('model', groq_model), request_deadline("agent"))
+        
+        status_code, groq_response = streamed_groq_completion(groq_request, headers, deadline=request_deadline("agent"))
         
-        if response.status_code != 200:
-            logger.error(f"Groq API error: {response.status_code} - {response.text[:200]}")
-            log_raw_data("AGENT MODE ERROR RESPONSE", response.text)
+        if status_code != 200:
+            logger.error(f"Groq API error: {status_code} - {groq_response[:200]}")
+            log_raw_data("AGENT MODE ERROR RESPONSE", groq_response)
             return jsonify({
                 "error": {
-                    "message": f"Groq API error: {response.status_code}",
+                    "message": f"Groq API error: {status_code}",
                     "type": "server_error",
                     "code": "groq_error"
                 }
-            }), response.status_code
+            }), status_code
+        if "error" in groq_response:
+            return aggregated_response(groq_response)
         
-        # Parse the response
-        log_raw_data("AGENT MODE RAW RESPONSE", response.text)
-        groq_response = response.json()
         log_raw_data("AGENT MODE PARSED RESPONSE", groq_response)
         
         # Check if there's a message about recursive code edits
         if groq_response.get("choices") and len(groq_response["choices"]) > 0:
-            content = groq_response["choices"][0].get("message", {}).get("content", "")
+            content = groq_response["choices"][0].get("message", {}).get("content") or ""
             
             # If the response contains indicators of recursive behavior, add a warning
-            recursive_indicators = [
-                "I'll try again with the edit",
-                "Let me try again with the same edit",
-                "Let's try the edit again",
-                "I'll reapply the same edit"
-            ]
-            
-            if any(indicator in content for indicator in recursive_indicators):
+            if any(indicator in content for indicator in AGENT_RECURSIVE_RESPONSE_INDICATORS):
                 logger.warning("Detected recursive behavior in model response")
                 # Modify the response to include a warning
-                warning_message = "\n\n**WARNING: Potential recursive behavior detected. Please try a different approach instead of repeating the same edit.**"
-                groq_response["choices"][0]["message"]["content"] = content + warning_message
+                groq_response["choices"][0]["message"]["content"] = content + AGENT_RECURSION_WARNING
                 log_raw_data("AGENT MODE MODIFIED RESPONSE (with warning)", groq_response)
         
         # Format as OpenAI response
@@ -1663,6 +4646,12 @@ def agent_mode():
         logger.info(f"Successfully processed agent mode request")
         return jsonify(openai_response)
             
+    except ContextLengthExceeded as e:
+        logger.warning(str(e))
+        return context_length_error(e)
+    except DeadlineExceeded as e:
+        logger.warning(str(e))
+        return deadline_error(e)
     except Exception as e:
         logger.error(f"Error processing agent mode request: {str(e)}")
         logger.error(traceback.format_exc())
@@ -1691,7 +4680,7 @@ if __name__ == "__main__":
     logger.info(f"Server starting on port {port}")
     
     try:
-        serve(app, host="0.0.0.0", port=port)
+        serve(app, host="0.0.0.0", port=port, threads=WAITRESS_THREADS)
     except Exception as e:
         logger.critical(f"Server failed to start: {str(e)}")
         print(f"Server failed to start: {str(e)}")
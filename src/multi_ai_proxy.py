@@ -1,7 +1,8 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, make_response, g
 import requests
 import os
 import json
+import re
 import logging
 from waitress import serve
 import subprocess
@@ -12,7 +13,17 @@ import time
 import uuid
 import random
 import traceback
-from cachetools import TTLCache
+import threading
+import queue
+import hashlib
+import functools
+import itertools
+import zlib
+import atexit
+import sqlite3
+import socket
+from collections import deque
+from cachetools import Cache, TLRUCache
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -27,13 +38,14 @@ LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 LOG_RAW_DATA = os.environ.get("LOG_RAW_DATA", "1") == "1"  # Set to "0" to disable raw data logging
 MAX_CHUNKS_TO_LOG = int(os.environ.get("MAX_CHUNKS_TO_LOG", "20"))  # Maximum number of chunks to log
 LOG_TRUNCATE_LENGTH = int(os.environ.get("LOG_TRUNCATE_LENGTH", "1000"))  # Length to truncate logs
+LOG_FILE = os.environ.get("LOG_FILE", "proxy.log")  # File the log is written to, besides the console
 
 # Configure logging
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler("proxy.log"),
+        logging.FileHandler(LOG_FILE),
         logging.StreamHandler()
     ]
 )
@@ -150,22 +162,717 @@ try:
 except json.JSONDecodeError:
     logger.warning("Failed to parse CUSTOM_MODEL_MAPPINGS environment variable. Using default mappings.")
 
+# Model capabilities per upstream model - context window and output limits are checked locally before a request is sent
+MODEL_CAPABILITIES = {
+    "claude-3-opus-20240229": {"context_window": 200000, "max_output": 4096, "streaming": True, "tools": True},
+    "claude-3-5-sonnet-20240620": {"context_window": 200000, "max_output": 8192, "streaming": True, "tools": True},
+    "claude-3-haiku-20240307": {"context_window": 200000, "max_output": 4096, "streaming": True, "tools": True},
+    "gemini-1.5-pro-latest": {"context_window": 2097152, "max_output": 8192, "streaming": False, "tools": True},
+    "gemini-1.5-flash-latest": {"context_window": 1048576, "max_output": 8192, "streaming": False, "tools": True},
+    "llama3-70b-8192": {"context_window": 8192, "max_output": 8192, "streaming": True, "tools": True},
+    "llama3-8b-8192": {"context_window": 8192, "max_output": 8192, "streaming": True, "tools": True},
+    "mixtral-8x7b-32768": {"context_window": 32768, "max_output": 32768, "streaming": True, "tools": True},
+    "grok-3": {"context_window": 131072, "max_output": 16384, "streaming": True, "tools": True},
+    "llama3": {"context_window": 8192, "max_output": 8192, "streaming": True, "tools": False},
+    "mistral": {"context_window": 32768, "max_output": 8192, "streaming": True, "tools": False}
+}
+# Override or add capabilities (JSON format), e.g. {"your-best-model": {"context_window": 65536, "max_output": 4096}}
+try:
+    for capability_model, capability_overrides in json.loads(os.environ.get("MODEL_CAPABILITIES", "{}")).items():
+        MODEL_CAPABILITIES[capability_model] = {
+            **MODEL_CAPABILITIES.get(capability_model, {"context_window": 8192, "max_output": 4096, "streaming": True, "tools": False}),
+            **capability_overrides
+        }
+except (json.JSONDecodeError, AttributeError):
+    logger.warning("Failed to parse MODEL_CAPABILITIES environment variable. Using built-in capabilities.")
+
+# Route individual model names to a provider regardless of AI_PROVIDER (JSON format)
+# Values are "provider" or "provider/upstream-model", e.g. {"claude": "anthropic/claude-3-opus-20240229"}
+try:
+    MODEL_ROUTES = json.loads(os.environ.get("MODEL_ROUTES", "{}"))
+except json.JSONDecodeError:
+    logger.warning("Failed to parse MODEL_ROUTES environment variable. Ignoring it.")
+    MODEL_ROUTES = {}
+
+# Upstream endpoint pools (JSON format) - spread a provider's traffic over several base URLs
+# Entries are URLs or {"url": ..., "max_concurrency": N}, e.g. {"ollama": ["http://gpu1:11434", "http://gpu2:11434"]}
+try:
+    PROVIDER_ENDPOINTS = json.loads(os.environ.get("PROVIDER_ENDPOINTS", "{}"))
+except json.JSONDecodeError:
+    logger.warning("Failed to parse PROVIDER_ENDPOINTS environment variable. Using one endpoint per provider.")
+    PROVIDER_ENDPOINTS = {}
+
+# Concurrent generation limits (JSON format) - keys are "provider" or "provider/upstream-model"
+# e.g. {"ollama": 2, "custom/your-best-model": 1}; requests over the limit wait in a bounded queue
+try:
+    PROVIDER_CONCURRENCY = json.loads(os.environ.get("PROVIDER_CONCURRENCY", "{}"))
+except json.JSONDecodeError:
+    logger.warning("Failed to parse PROVIDER_CONCURRENCY environment variable. Concurrency is unlimited.")
+    PROVIDER_CONCURRENCY = {}
+
+# Ordered failover chains per model name (JSON format); "default" applies to models without their own chain
+# Entries are "provider" or "provider/upstream-model", e.g. {"gpt-4o": ["ollama", "anthropic"], "default": ["ollama"]}
+try:
+    FAILOVER_CHAINS = json.loads(os.environ.get("FAILOVER_CHAINS", "{}"))
+except json.JSONDecodeError:
+    logger.warning("Failed to parse FAILOVER_CHAINS environment variable. Failover is disabled.")
+    FAILOVER_CHAINS = {}
+
 # ============================================================================
 # PERFORMANCE SETTINGS
 # ============================================================================
 
-# Create a TTL cache for request deduplication (5 second TTL)
-request_cache = TTLCache(maxsize=1000, ttl=5)
+# Cache memory configuration - caches are bounded by bytes rather than item count
+CACHE_MEMORY_BUDGET_MB = int(os.environ.get("CACHE_MEMORY_BUDGET_MB", "64"))  # Global budget shared by all caches
+CACHE_COMPRESS_THRESHOLD = int(os.environ.get("CACHE_COMPRESS_THRESHOLD", "1024"))  # Compress values larger than this (bytes)
+CACHE_KEY_HASH_THRESHOLD = int(os.environ.get("CACHE_KEY_HASH_THRESHOLD", "256"))  # Hash keys longer than this (chars)
+CACHE_ENTRY_OVERHEAD = 64  # Approximate bookkeeping bytes per cache entry
+CACHE_DISK_PATH = os.environ.get("CACHE_DISK_PATH", "")  # SQLite file for the persistent cache tier (empty disables it)
+CACHE_DISK_MAX_MB = int(os.environ.get("CACHE_DISK_MAX_MB", "256"))  # Maximum size of the persistent cache tier
+CACHE_DISK_COMPACT_INTERVAL = int(os.environ.get("CACHE_DISK_COMPACT_INTERVAL", "300"))  # Seconds between compactions
+CACHE_DISK_FLUSH_INTERVAL = float(os.environ.get("CACHE_DISK_FLUSH_INTERVAL", "1"))  # Seconds between batched writes to the persistent tier
+
+class CacheEntry:
+    """A cached value in its stored (possibly compressed) form"""
+    __slots__ = ("encoding", "payload", "size", "raw_size", "expires")
+
+    def __init__(self, encoding, payload, size, raw_size, expires=None):
+        self.encoding = encoding
+        self.payload = payload
+        self.size = size
+        self.raw_size = raw_size
+        self.expires = expires  # Explicit expiry (cache timer) for entries restored from disk
+
+class CacheMemoryBudget:
+    """Global byte budget shared by every ByteBudgetCache registered with it"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.caches = []
+        self.lock = threading.Lock()
+
+    def register(self, cache):
+        self.caches.append(cache)
+
+    def used_bytes(self):
+        return sum(cache.used_bytes() for cache in self.caches)
+
+    def enforce(self):
+        """Evict least recently used entries from the largest caches until usage fits the budget"""
+        with self.lock:
+            while self.used_bytes() > self.max_bytes:
+                largest = max(self.caches, key=lambda cache: cache.used_bytes())
+                if not largest.evict_one():
+                    break
+
+class DiskCacheTier:
+    """
+    Optional SQLite-backed second tier behind the in-memory caches
+
+    Entries are written through in their stored (compressed) form with an
+    absolute expiry time, so they survive restarts. Writes, deletes and
+    access times are queued and committed in one transaction every
+    CACHE_DISK_FLUSH_INTERVAL seconds by a background thread, so setting a
+    cache entry never waits on SQLite; reads see queued writes. Values are
+    stored as text, bytes or JSON and nothing read back is unpickled.
+    Compaction drops expired rows and trims the least recently accessed rows
+    once the store grows beyond its byte limit.
+    """
+
+    def __init__(self, path, max_bytes, compact_interval, flush_interval=CACHE_DISK_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compact_interval = compact_interval
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # (cache, key) -> row to write, or None to delete; guarded by pending_lock
+        self.pending = {}
+        self.pending_access = {}
+        self.pending_lock = threading.Lock()
+        # Persistent caches by name, told which keys compaction removed
+        self.caches = {}
+        self.last_compaction = 0
+        self.compactions = 0
+        self.flushes = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    cache TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    encoding TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    raw_size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (cache, key)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed)")
+            # Older versions pickled some values; drop those rows rather than ever unpickling them
+            self.conn.execute("DELETE FROM cache_entries WHERE encoding IN ('pickle', 'zlib-pickle')")
+            self.conn.commit()
+        self.compact()
+        threading.Thread(target=self.writer, daemon=True).start()
+        atexit.register(self.flush)
+
+    def register(self, cache):
+        self.caches[cache.name] = cache
+
+    def put(self, cache_name, key, entry, ttl):
+        """
+        Queue an entry to be written to disk with an absolute expiry time
+
+        Returns:
+        bool: False if the value has no text, bytes or JSON form and stays in memory only
+        """
+        encoding, payload = entry.encoding, entry.payload
+        if encoding == "raw":
+            # Raw in-memory values are converted to bytes for storage
+            if isinstance(payload, str):
+                encoding, payload = "str", payload.encode("utf-8")
+            else:
+                try:
+                    encoding, payload = "json", json.dumps(payload).encode("utf-8")
+                except (TypeError, ValueError):
+                    return False
+        now = time.time()
+        with self.pending_lock:
+            self.pending[(cache_name, key)] = (cache_name, key, encoding, payload, entry.size, entry.raw_size, now + ttl, now)
+        return True
+
+    def get(self, cache_name, key):
+        """Return (entry, remaining_ttl) for a live entry, or None"""
+        now = time.time()
+        with self.pending_lock:
+            queued = (cache_name, key) in self.pending
+            row = self.pending.get((cache_name, key))
+        if row is not None:
+            encoding, payload, size, raw_size, expires = row[2:7]
+        elif not queued:
+            try:
+                with self.lock:
+                    row = self.conn.execute(
+                        "SELECT encoding, payload, size, raw_size, expires FROM cache_entries "
+                        "WHERE cache = ? AND key = ?",
+                        (cache_name, key)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                logger.error(f"Disk cache read failed for '{cache_name}': {str(e)}")
+                return None
+            if row is not None:
+                encoding, payload, size, raw_size, expires = row
+        with self.pending_lock:
+            if row is None or expires <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pending_access[(cache_name, key)] = now
+        return CacheEntry(encoding, payload, size, raw_size), expires - now
+
+    def delete(self, cache_name, key):
+        """Queue an entry's removal from disk"""
+        with self.pending_lock:
+            self.pending[(cache_name, key)] = None
+            self.pending_access.pop((cache_name, key), None)
+
+    def writer(self):
+        # Background thread that commits queued writes in batches and runs compaction
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            self.maybe_compact()
+
+    def flush(self):
+        """Commit queued writes, deletes and access times in one transaction"""
+        # Taking the queue and writing it under one lock keeps a later delete from being overwritten
+        with self.lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, {}
+                accessed, self.pending_access = self.pending_access, {}
+            if not pending and not accessed:
+                return
+            try:
+                self.conn.executemany(
+                    "DELETE FROM cache_entries WHERE cache = ? AND key = ?",
+                    [entry_key for entry_key, row in pending.items() if row is None]
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [row for row in pending.values() if row is not None]
+                )
+                self.conn.executemany(
+                    "UPDATE cache_entries SET accessed = ? WHERE cache = ? AND key = ?",
+                    [(when, cache_name, key) for (cache_name, key), when in accessed.items()]
+                )
+                self.conn.commit()
+                self.flushes += 1
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logger.error(f"Disk cache write of {len(pending)} entries failed: {str(e)}")
+
+    def load(self, cache_name):
+        """Return live (key, entry, remaining_ttl) rows, least recently accessed first"""
+        self.flush()
+        now = time.time()
+        try:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT key, encoding, payload, size, raw_size, expires FROM cache_entries "
+                    "WHERE cache = ? AND expires > ? ORDER BY accessed",
+                    (cache_name, now)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Disk cache load failed for '{cache_name}': {str(e)}")
+            return []
+        return [(key, CacheEntry(encoding, payload, size, raw_size), expires - now)
+                for key, encoding, payload, size, raw_size, expires in rows]
+
+    def maybe_compact(self):
+        if time.time() - self.last_compaction >= self.compact_interval:
+            self.compact()
+
+    def compact(self):
+        """Drop expired rows, then the least recently accessed rows until the store fits max_bytes"""
+        self.flush()
+        try:
+            with self.lock:
+                now = time.time()
+                self.last_compaction = now
+                removed = self.conn.execute("SELECT cache, key FROM cache_entries WHERE expires <= ?", (now,)).fetchall()
+                expired = len(removed)
+                self.conn.execute("DELETE FROM cache_entries WHERE expires <= ?", (now,))
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+                trimmed = 0
+                if total > self.max_bytes:
+                    rows = self.conn.execute("SELECT cache, key, size FROM cache_entries ORDER BY accessed").fetchall()
+                    victims = []
+                    for cache_name, key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        victims.append((cache_name, key))
+                        total -= size
+                    self.conn.executemany("DELETE FROM cache_entries WHERE cache = ? AND key = ?", victims)
+                    trimmed = len(victims)
+                    removed.extend(victims)
+                self.conn.commit()
+                self.conn.execute("PRAGMA incremental_vacuum")
+                self.compactions += 1
+            self.forget(removed)
+            if expired or trimmed:
+                logger.info(f"Disk cache compaction removed {expired} expired and {trimmed} least recently used entries")
+        except sqlite3.Error as e:
+            logger.error(f"Disk cache compaction failed: {str(e)}")
+
+    def forget(self, removed):
+        """Drop compacted rows from their caches' disk key sets, unless they were written again since"""
+        with self.pending_lock:
+            removed = [entry_key for entry_key in removed if entry_key not in self.pending]
+        for cache_name, key in removed:
+            cache = self.caches.get(cache_name)
+            if cache is not None:
+                cache.disk_keys.discard(key)
+
+    def stats(self):
+        try:
+            with self.lock:
+                entries, size = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+                ).fetchone()
+        except sqlite3.Error as e:
+            return {"path": self.path, "error": str(e)}
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "pending_writes": len(self.pending),
+            "flushes": self.flushes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "compactions": self.compactions
+        }
+
+# Persistent second cache tier, enabled by setting CACHE_DISK_PATH
+disk_cache_tier = None
+if CACHE_DISK_PATH:
+    try:
+        disk_cache_tier = DiskCacheTier(CACHE_DISK_PATH, CACHE_DISK_MAX_MB * 1024 * 1024, CACHE_DISK_COMPACT_INTERVAL)
+        logger.info(f"Persistent cache tier enabled at {CACHE_DISK_PATH}")
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open persistent cache tier at {CACHE_DISK_PATH}: {str(e)}")
+
+class ByteBudgetCache(TLRUCache):
+    """
+    TTL cache bounded by bytes instead of item count
+
+    Eviction is least-recently-used weighted by entry size. Keys longer than
+    CACHE_KEY_HASH_THRESHOLD are replaced by a SHA-256 digest and values larger
+    than CACHE_COMPRESS_THRESHOLD are stored zlib-compressed, so multi-megabyte
+    Cursor payloads cost a fraction of their raw size. Persistent caches write
+    through to the disk tier, fall back to it on a miss and are warmed from it
+    at startup. Keys known to be on disk are tracked in memory, so a miss on
+    any other key never touches SQLite.
+    """
+
+    def __init__(self, name, max_bytes, ttl, budget=None, persistent=False):
+        super().__init__(maxsize=max_bytes, ttu=self.entry_expiry, getsizeof=lambda entry: entry.size)
+        self.name = name
+        self.ttl = ttl
+        self.budget = budget
+        self.disk = disk_cache_tier if persistent else None
+        self.lock = threading.RLock()
+        self.evicting = False
+        self.evictions = 0
+        self.rejected = 0
+        # Keys written to or loaded from the disk tier, pruned when compaction removes their rows;
+        # anything else is a miss without a disk lookup
+        self.disk_keys = set()
+        if budget is not None:
+            budget.register(self)
+        if self.disk is not None:
+            self.disk.register(self)
+            self.warm_from_disk()
+
+    def entry_expiry(self, key, entry, now):
+        return entry.expires if entry.expires is not None else now + self.ttl
+
+    @staticmethod
+    def storage_key(key):
+        """Replace oversized string keys with a fixed-size digest"""
+        if isinstance(key, str) and len(key) > CACHE_KEY_HASH_THRESHOLD:
+            return "sha256:" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return key
+
+    @staticmethod
+    def encode_value(value):
+        """Convert a value to a CacheEntry, compressing it if it is large"""
+        if isinstance(value, str):
+            encoding, data = "str", value.encode("utf-8")
+        elif isinstance(value, bytes):
+            encoding, data = "bytes", value
+        elif value is None or isinstance(value, (bool, int, float)):
+            return CacheEntry("raw", value, sys.getsizeof(value), sys.getsizeof(value))
+        else:
+            try:
+                encoding, data = "json", json.dumps(value).encode("utf-8")
+            except (TypeError, ValueError):
+                # Objects without a JSON form are stored as-is with an estimated size
+                return CacheEntry("raw", value, sys.getsizeof(value), sys.getsizeof(value))
+
+        if len(data) >= CACHE_COMPRESS_THRESHOLD:
+            compressed = zlib.compress(data, 6)
+            if len(compressed) < len(data):
+                return CacheEntry("zlib-" + encoding, compressed, len(compressed), len(data))
+        if encoding == "str":
+            return CacheEntry("raw", value, len(data), len(data))
+        return CacheEntry(encoding, data, len(data), len(data))
 
-# Initialize a cache for storing reasoning results, if enabled
-r1_reasoning_cache = TTLCache(maxsize=100, ttl=1800)  # 30 minute TTL
+    @staticmethod
+    def decode_value(entry):
+        """Restore the original value from a CacheEntry"""
+        encoding, payload = entry.encoding, entry.payload
+        if encoding == "raw":
+            return payload
+        if encoding.startswith("zlib-"):
+            payload = zlib.decompress(payload)
+            encoding = encoding[len("zlib-"):]
+        if encoding == "str":
+            return payload.decode("utf-8")
+        if encoding == "json":
+            return json.loads(payload)
+        return payload
+
+    def __getitem__(self, key):
+        storage_key = self.storage_key(key)
+        try:
+            with self.lock:
+                entry = super().__getitem__(storage_key)
+                if self.evicting:
+                    # popitem() reads the entry it evicts; decoding it would be thrown away
+                    return entry
+        except KeyError:
+            if not self.promote(storage_key):
+                raise
+            with self.lock:
+                entry = super().__getitem__(storage_key)
+        return self.decode_value(entry)
+
+    def __setitem__(self, key, value):
+        storage_key = self.storage_key(key)
+        entry = self.encode_value(value)
+        key_size = len(storage_key) if isinstance(storage_key, str) else sys.getsizeof(storage_key)
+        entry.size += key_size + CACHE_ENTRY_OVERHEAD
+        try:
+            with self.lock:
+                super().__setitem__(storage_key, entry)
+        except ValueError:
+            # Entry is larger than the whole cache; skip it rather than flushing everything
+            self.rejected += 1
+            logger.warning(f"Cache '{self.name}': entry of {entry.size} bytes exceeds cache size, not cached")
+        else:
+            if self.budget is not None:
+                self.budget.enforce()
+        if self.disk is not None and isinstance(storage_key, str):
+            if self.disk.put(self.name, storage_key, entry, self.ttl):
+                self.disk_keys.add(storage_key)
+
+    def __delitem__(self, key):
+        storage_key = self.storage_key(key)
+        with self.lock:
+            # Memory evictions keep the disk copy; explicit deletes remove both
+            if self.disk is not None and not self.evicting and isinstance(storage_key, str):
+                self.disk.delete(self.name, storage_key)
+                self.disk_keys.discard(storage_key)
+                if not super().__contains__(storage_key):
+                    return
+            super().__delitem__(storage_key)
+
+    def __contains__(self, key):
+        storage_key = self.storage_key(key)
+        with self.lock:
+            if super().__contains__(storage_key):
+                return True
+        return self.promote(storage_key)
+
+    def popitem(self):
+        """Evict the least recently used entry, returning its stored (undecoded) CacheEntry"""
+        with self.lock:
+            self.evicting = True
+            try:
+                key, value = super().popitem()
+            finally:
+                self.evicting = False
+            self.evictions += 1
+            return key, value
+
+    def promote(self, storage_key):
+        """Load an entry from the disk tier into memory, returning True if found"""
+        if self.disk is None or storage_key not in self.disk_keys:
+            return False
+        found = self.disk.get(self.name, storage_key)
+        if found is None:
+            # Expired or compacted away
+            self.disk_keys.discard(storage_key)
+            return False
+        entry, remaining = found
+        self.insert_restored(storage_key, entry, remaining)
+        return True
+
+    def insert_restored(self, storage_key, entry, remaining):
+        """Insert a disk entry into memory, keeping its remaining TTL"""
+        try:
+            with self.lock:
+                entry.expires = self.timer() + remaining
+                super().__setitem__(storage_key, entry)
+        except ValueError:
+            self.rejected += 1
+            return
+        if self.budget is not None:
+            self.budget.enforce()
+
+    def warm_from_disk(self):
+        """Fill the memory tier from disk at startup so a restart does not start cold"""
+        rows = self.disk.load(self.name)
+        for storage_key, entry, remaining in rows:
+            self.disk_keys.add(storage_key)
+            self.insert_restored(storage_key, entry, remaining)
+        if rows:
+            logger.info(f"Cache '{self.name}': warmed {len(rows)} entries from disk")
+
+    def evict_one(self):
+        """Evict the least recently used entry, returning False if the cache is empty"""
+        try:
+            self.popitem()
+            return True
+        except KeyError:
+            return False
+
+    def used_bytes(self):
+        with self.lock:
+            return self.currsize
+
+    def stats(self):
+        """Return entry count and byte usage for reporting on /debug and /health"""
+        with self.lock:
+            self.expire()
+            entries = [Cache.__getitem__(self, key) for key in list(Cache.__iter__(self))]
+            return {
+                "entries": len(entries),
+                "bytes": self.currsize,
+                "max_bytes": self.maxsize,
+                "raw_bytes": sum(entry.raw_size for entry in entries),
+                "compressed_entries": sum(1 for entry in entries if entry.encoding.startswith("zlib-")),
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+                "ttl": self.ttl
+            }
+
+# One memory budget shared by every cache in the process
+cache_memory_budget = CacheMemoryBudget(CACHE_MEMORY_BUDGET_MB * 1024 * 1024)
+
+def get_cache_stats():
+    """Collect byte usage for every cache sharing the global budget"""
+    return {
+        "budget_bytes": cache_memory_budget.max_bytes,
+        "used_bytes": cache_memory_budget.used_bytes(),
+        "caches": {cache.name: cache.stats() for cache in cache_memory_budget.caches},
+        "disk": disk_cache_tier.stats() if disk_cache_tier is not None else None
+    }
 
 # Add a streaming tracker to prevent multiple streaming for the same request
-streaming_tracker = TTLCache(maxsize=100, ttl=10)  # 10 second TTL
+streaming_tracker = ByteBudgetCache("streaming_tracker", max_bytes=256 * 1024, ttl=10, budget=cache_memory_budget)  # 10 second TTL
 
 # API request settings
 API_TIMEOUT = int(os.environ.get("API_TIMEOUT", "120"))  # 120 seconds timeout for API calls
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "3"))    # Maximum number of retries for failed requests
+# Request deadlines - the time a client will wait bounds every upstream hop, retry and failover made for it
+DEADLINE_HEADER = "X-Request-Timeout"  # Seconds the client is willing to wait
+DEADLINE_MAX = float(os.environ.get("DEADLINE_MAX", "600"))  # Upper bound on a client-supplied deadline
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10"))  # Connect timeout per upstream hop
+# Default deadline in seconds per route ("chat", "agent", "direct") or model name
+ROUTE_DEADLINES = {"chat": API_TIMEOUT, "agent": 180, "direct": 60}
+try:
+    ROUTE_DEADLINES.update(json.loads(os.environ.get("ROUTE_DEADLINES", "{}")))
+except (json.JSONDecodeError, TypeError, ValueError):
+    logger.warning("Failed to parse ROUTE_DEADLINES environment variable. Using default deadlines.")
+FAILOVER_BACKOFF_BASE = float(os.environ.get("FAILOVER_BACKOFF_BASE", "0.25"))  # Base delay in seconds before retrying a failover chain
+FAILOVER_BACKOFF_MAX = float(os.environ.get("FAILOVER_BACKOFF_MAX", "4"))  # Cap on a single backoff delay in seconds
+STREAM_CONTINUATION_ENABLED = os.environ.get("STREAM_CONTINUATION_ENABLED", "1") == "1"  # Resume streams that drop mid-response
+STREAM_CONTINUATION_MAX_ATTEMPTS = int(os.environ.get("STREAM_CONTINUATION_MAX_ATTEMPTS", "2"))  # Continuations per response
+
+# Circuit breakers and retry budget for upstream calls
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "1") == "1"  # Fail fast while an upstream is degraded
+CIRCUIT_BREAKER_WINDOW = int(os.environ.get("CIRCUIT_BREAKER_WINDOW", "60"))  # Seconds of call outcomes used for the error rate
+CIRCUIT_BREAKER_MIN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_MIN_CALLS", "5"))  # Calls in the window before a breaker can open
+CIRCUIT_BREAKER_ERROR_RATE = float(os.environ.get("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))  # Failure ratio that opens a breaker
+CIRCUIT_BREAKER_SLOW_CALL = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL", "30"))  # Seconds to first byte counted as a failure
+CIRCUIT_BREAKER_COOLDOWN = int(os.environ.get("CIRCUIT_BREAKER_COOLDOWN", "30"))  # Seconds a breaker stays open before trial calls
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_HALF_OPEN_CALLS", "1"))  # Trial calls allowed while half-open
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", "0.2"))  # Retries allowed as a fraction of live requests
+RETRY_BUDGET_MIN_PER_SECOND = float(os.environ.get("RETRY_BUDGET_MIN_PER_SECOND", "0.5"))  # Retries always allowed at low traffic
+RETRY_BUDGET_WINDOW = 10  # Seconds of traffic the retry budget is computed over
+
+# API key pools - extra keys are read from <PROVIDER>_API_KEYS as a comma-separated list
+KEY_EJECT_AUTH_SECONDS = int(os.environ.get("KEY_EJECT_AUTH_SECONDS", "300"))  # How long a key answering 401 is left out
+KEY_EJECT_RATE_LIMIT_SECONDS = int(os.environ.get("KEY_EJECT_RATE_LIMIT_SECONDS", "30"))  # Default ejection after a 429 without retry-after
+# Rate-limit headers that report a key's remaining budget (OpenAI/Groq style, then Anthropic)
+KEY_POOL_TOKEN_HEADERS = ["x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining"]
+KEY_POOL_REQUEST_HEADERS = ["x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining"]
+
+# Endpoint pool balancing and passive health checks
+ENDPOINT_BALANCER = os.environ.get("ENDPOINT_BALANCER", "least_outstanding")  # "least_outstanding" or "p2c" (power of two choices)
+ENDPOINT_MAX_CONCURRENCY = int(os.environ.get("ENDPOINT_MAX_CONCURRENCY", "0"))  # Default in-flight cap per endpoint (0 = unlimited)
+ENDPOINT_EJECT_AFTER_FAILURES = int(os.environ.get("ENDPOINT_EJECT_AFTER_FAILURES", "3"))  # Consecutive failures before ejection
+ENDPOINT_EJECT_SECONDS = int(os.environ.get("ENDPOINT_EJECT_SECONDS", "30"))  # How long an ejected endpoint is left out
+
+# Concurrency limiter queue for providers and models listed in PROVIDER_CONCURRENCY
+CONCURRENCY_MAX_QUEUE = int(os.environ.get("CONCURRENCY_MAX_QUEUE", "32"))  # Requests that may wait for one limiter
+CONCURRENCY_QUEUE_TIMEOUT = float(os.environ.get("CONCURRENCY_QUEUE_TIMEOUT", "30"))  # Longest wait for a slot in seconds
+
+# Hedged requests (opt-in) - race a second request when the first token is slow to arrive
+HEDGE_MODELS = [model.strip() for model in os.environ.get("HEDGE_MODELS", "").split(",") if model.strip()]  # Model names to hedge, "*" for all
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))  # TTFT percentile after which the hedge fires
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.25"))  # Lower bound on the hedge delay in seconds
+HEDGE_MAX_DELAY = float(os.environ.get("HEDGE_MAX_DELAY", "5"))  # Upper bound on the hedge delay in seconds
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "2"))  # Delay used until enough TTFT samples exist
+HEDGE_BUDGET_RATIO = float(os.environ.get("HEDGE_BUDGET_RATIO", "0.1"))  # Hedges allowed as a fraction of hedge-eligible requests
+TTFT_SAMPLE_SIZE = 200  # Recent time-to-first-token samples kept per provider/model
+TTFT_MIN_SAMPLES = 20  # Samples needed before percentiles are trusted
+
+# Latency-aware routing - order each model's eligible backends by measured speed and health
+LATENCY_ROUTING_ENABLED = os.environ.get("LATENCY_ROUTING_ENABLED", "0") == "1"
+LATENCY_PROBE_INTERVAL = int(os.environ.get("LATENCY_PROBE_INTERVAL", "120"))  # Seconds between active probe rounds (0 = passive only)
+LATENCY_EWMA_ALPHA = float(os.environ.get("LATENCY_EWMA_ALPHA", "0.3"))  # Weight of the newest measurement
+LATENCY_PROBE_PROMPT = "Reply with the single word OK."
+LATENCY_PROBE_MAX_TOKENS = 8
+
+# Auto model - classify each request locally and send it to a fast or a strong model
+AUTO_ROUTER_ENABLED = os.environ.get("AUTO_ROUTER_ENABLED", "0") == "1"
+AUTO_MODEL_NAME = os.environ.get("AUTO_MODEL_NAME", "auto")  # Model name clients select to get automatic routing
+AUTO_FAST_MODEL = os.environ.get("AUTO_FAST_MODEL", "default")  # Model name used for simple requests
+AUTO_STRONG_MODEL = os.environ.get("AUTO_STRONG_MODEL", "gpt-4o")  # Model name used for complex requests
+AUTO_ROUTER_THRESHOLD = int(os.environ.get("AUTO_ROUTER_THRESHOLD", "2"))  # Complexity score at which the strong model is used
+AUTO_ROUTER_LONG_PROMPT_TOKENS = int(os.environ.get("AUTO_ROUTER_LONG_PROMPT_TOKENS", "2000"))  # Prompt size counted as long
+AUTO_ROUTER_HISTORY_SIZE = 200  # Recent routing decisions kept for /debug
+
+# Priority lanes - admission scheduler shared by all completion routes
+# Off by default: before enabling, set ADMISSION_MAX_CONCURRENCY to the generations the proxy should run
+# at once across all providers; per-backend limits are PROVIDER_CONCURRENCY
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "0") == "1"
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "8"))  # Requests in flight upstream at once
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "30"))  # Longest a request waits for a slot before being rejected
+WAITRESS_THREADS = int(os.environ.get("WAITRESS_THREADS", "32"))  # Server threads; must exceed ADMISSION_MAX_CONCURRENCY so requests can queue
+# Per class: weight for fair dequeueing, slots reserved for the class, and queue length limit
+PRIORITY_CLASSES = {
+    "interactive": {"weight": 6, "reserved": 2, "max_queue": 64},
+    "agent": {"weight": 3, "reserved": 1, "max_queue": 64},
+    "bulk": {"weight": 1, "reserved": 0, "max_queue": 128}
+}
+try:
+    for class_name, class_overrides in json.loads(os.environ.get("PRIORITY_CLASSES", "{}")).items():
+        PRIORITY_CLASSES[class_name] = {**PRIORITY_CLASSES.get(class_name, {"weight": 1, "reserved": 0, "max_queue": 64}), **class_overrides}
+except (json.JSONDecodeError, AttributeError):
+    logger.warning("Failed to parse PRIORITY_CLASSES environment variable. Using default priority classes.")
+# Class per route, overridden by a model entry in PRIORITY_MODEL_CLASSES, overridden by the X-Priority header
+PRIORITY_ROUTE_CLASSES = {"chat": "interactive", "agent": "agent", "direct": "bulk"}
+try:
+    PRIORITY_MODEL_CLASSES = json.loads(os.environ.get("PRIORITY_MODEL_CLASSES", "{}"))  # e.g. {"gpt-4o": "bulk"}
+except json.JSONDecodeError:
+    logger.warning("Failed to parse PRIORITY_MODEL_CLASSES environment variable. Ignoring it.")
+    PRIORITY_MODEL_CLASSES = {}
+PRIORITY_HEADER = "X-Priority"
+# Per-client fairness - clients are identified by IP ("ip"), or by bearer token ("auto") when every
+# user has a key of their own; a token shared by several users would make them one client
+CLIENT_IDENTITY = os.environ.get("CLIENT_IDENTITY", "ip")
+CLIENT_MAX_CONCURRENCY = int(os.environ.get("CLIENT_MAX_CONCURRENCY", "0"))  # Slots one client may hold at once (0 = unlimited)
+CLIENT_MAX_QUEUE = int(os.environ.get("CLIENT_MAX_QUEUE", "16"))  # Requests one client may have waiting
+CLIENT_DRR_TOKENS_PER_TURN = int(os.environ.get("CLIENT_DRR_TOKENS_PER_TURN", "4000"))  # Prompt tokens that cost one extra round-robin turn
+ADMISSION_WAIT_SAMPLES = 500  # Recent queue wait times kept per class
+
+# Supersede-and-cancel - a newer request in the same conversation cancels the older in-flight stream
+SUPERSEDE_ENABLED = os.environ.get("SUPERSEDE_ENABLED", "1") == "1"
+SUPERSEDE_DEBOUNCE = float(os.environ.get("SUPERSEDE_DEBOUNCE", "0"))  # Seconds to hold a request in case a newer one replaces it
+
+# SSE heartbeats - send the role delta at once and comment lines while upstream is silent
+HEARTBEAT_ENABLED = os.environ.get("HEARTBEAT_ENABLED", "1") == "1"
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "5"))  # Seconds of silence before a keep-alive comment is sent
+# SSE coalescing - events arriving together after the first token are sent in one write
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "1") == "1"
+COALESCE_WINDOW_MS = float(os.environ.get("COALESCE_WINDOW_MS", "15"))  # Longest wait for more events on a fast stream
+COALESCE_MAX_BYTES = int(os.environ.get("COALESCE_MAX_BYTES", "4096"))  # Batch size that is flushed without waiting
+FIRST_TOKEN_SAMPLES = 500  # Recent request-to-first-token times kept for /debug
+
+# Upstream statuses worth retrying on another provider (rate limits and server errors)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Context fitting - clamp max_tokens or move oversized prompts to a larger-context model
+CONTEXT_ROUTING_ENABLED = os.environ.get("CONTEXT_ROUTING_ENABLED", "1") == "1"
+CONTEXT_MIN_OUTPUT_TOKENS = int(os.environ.get("CONTEXT_MIN_OUTPUT_TOKENS", "256"))  # Room for output a model must have left
+
+# Repetition abort - stop streams that loop on their own output or re-emit an earlier response
+REPETITION_ABORT_ENABLED = os.environ.get("REPETITION_ABORT_ENABLED", "1") == "1"
+REPETITION_HISTORY_RESPONSES = 3  # Recent assistant messages of the conversation compared against
+# Per model: n-gram size in words, and how many words in a row may repeat this response (loop_words)
+# or an earlier one (echo_words) before the stream is stopped; 0 turns a check off. The echo check
+# is off by default: re-emitting a whole file after a small edit is a normal answer
+REPETITION_LIMITS = {
+    "default": {"ngram": 8, "loop_words": 150, "echo_words": 0}
+}
+try:
+    for repetition_model, repetition_overrides in json.loads(os.environ.get("REPETITION_LIMITS", "{}")).items():
+        REPETITION_LIMITS[repetition_model] = {**REPETITION_LIMITS.get(repetition_model, REPETITION_LIMITS["default"]), **repetition_overrides}
+except (json.JSONDecodeError, AttributeError):
+    logger.warning("Failed to parse REPETITION_LIMITS environment variable. Using default limits.")
+REPETITION_ABORT_MESSAGES = {
+    "loop": "\n\n[Response stopped: the model started repeating itself.]",
+    "echo": "\n\n[Response stopped: the model was repeating an earlier response from this conversation.]"
+}
 
 # ============================================================================
 # SYSTEM PROMPT CONFIGURATION
@@ -234,10 +941,10 @@ if CUSTOM_AGENT_INSTRUCTIONS:
 # ============================================================================
 
 # Initialize a cache to track recent code edits (key: hash of edit, value: count)
-code_edit_cache = TTLCache(maxsize=100, ttl=300)  # 5 minute TTL
+code_edit_cache = ByteBudgetCache("code_edit_cache", max_bytes=1024 * 1024, ttl=300, budget=cache_memory_budget)  # 5 minute TTL
 
 # Track consecutive edits to the same file
-file_edit_counter = TTLCache(maxsize=50, ttl=600)  # 10 minutes TTL
+file_edit_counter = ByteBudgetCache("file_edit_counter", max_bytes=256 * 1024, ttl=600, budget=cache_memory_budget)  # 10 minutes TTL
 MAX_CONSECUTIVE_EDITS = int(os.environ.get("MAX_CONSECUTIVE_EDITS", "3"))  # Maximum consecutive edits to the same file
 
 # ============================================================================
@@ -292,33 +999,41 @@ def collect_streaming_chunks(chunks, max_chunks=MAX_CHUNKS_TO_LOG):
     
     return "\n\n".join(formatted_chunks) + truncated_message
 
-def get_provider_api_key():
-    """Get the API key for the currently selected provider"""
-    if AI_PROVIDER == "anthropic":
+def get_provider_api_key(provider=None):
+    """Get the API key for a provider (defaults to the configured AI_PROVIDER)"""
+    provider = provider or AI_PROVIDER
+    if provider == "anthropic":
         return ANTHROPIC_API_KEY
-    elif AI_PROVIDER == "google":
+    elif provider == "google":
         return GOOGLE_API_KEY
-    elif AI_PROVIDER == "groq":
+    elif provider == "groq":
         return GROQ_API_KEY
-    elif AI_PROVIDER == "grok":
+    elif provider == "grok":
         return GROK_API_KEY
-    elif AI_PROVIDER == "ollama":
+    elif provider == "ollama":
         return ""  # Ollama doesn't typically need an API key for local deployments
-    elif AI_PROVIDER == "custom":
+    elif provider == "custom":
         return CUSTOM_API_KEY
     else:
         return None
 
-def get_provider_url_and_endpoint():
-    """Get the base URL and endpoint for the current provider"""
-    base_url = PROVIDER_URLS.get(AI_PROVIDER, "")
-    endpoint = PROVIDER_CHAT_ENDPOINTS.get(AI_PROVIDER, "")
+def get_provider_api_keys(provider=None):
+    """Get every API key for a provider: the main key plus any listed in <PROVIDER>_API_KEYS"""
+    provider = provider or AI_PROVIDER
+    extra_keys = os.environ.get(f"{provider.upper()}_API_KEYS", "").split(",")
+    return list(dict.fromkeys(key.strip() for key in [get_provider_api_key(provider) or ""] + extra_keys if key.strip()))
+
+def get_provider_url_and_endpoint(provider=None):
+    """Get the base URL and endpoint for a provider (defaults to the configured AI_PROVIDER)"""
+    provider = provider or AI_PROVIDER
+    base_url = PROVIDER_URLS.get(provider, "")
+    endpoint = PROVIDER_CHAT_ENDPOINTS.get(provider, "")
     return base_url, endpoint
 
-def get_provider_auth_headers():
-    """Get the authentication headers for the current provider"""
-    provider = AI_PROVIDER
-    api_key = get_provider_api_key()
+def get_provider_auth_headers(provider=None, api_key=None):
+    """Get the authentication headers for a provider (defaults to the configured AI_PROVIDER and its main key)"""
+    provider = provider or AI_PROVIDER
+    api_key = api_key or get_provider_api_key(provider)
     
     if provider == "anthropic":
         return {
@@ -350,18 +1065,22 @@ def get_provider_auth_headers():
 # FORMAT CONVERSION FUNCTIONS
 # ============================================================================
 
-def format_request_for_provider(request_data):
+def format_request_for_provider(request_data, provider=None, upstream_model=None):
     """
     Format the request data for the specific provider
     
     This function converts from OpenAI-compatible format to provider-specific formats.
     Modify this function if you need to support additional providers or custom formats.
+    If upstream_model is given (from the routing table) it is used as-is instead of
+    mapping the requested model name.
     """
-    provider = AI_PROVIDER
+    provider = provider or AI_PROVIDER
     formatted_data = request_data.copy()
     
     # Map the model name to the provider-specific model
-    if 'model' in formatted_data and formatted_data['model'] in MODEL_MAPPINGS[provider]:
+    if upstream_model:
+        formatted_data['model'] = upstream_model
+    elif 'model' in formatted_data and formatted_data['model'] in MODEL_MAPPINGS[provider]:
         formatted_data['model'] = MODEL_MAPPINGS[provider][formatted_data['model']]
     else:
         formatted_data['model'] = MODEL_MAPPINGS[provider]["default"]
@@ -407,167 +1126,2395 @@ def format_request_for_provider(request_data):
                 }
             }
     
-    elif provider == "ollama":
-        # Transform to Ollama format
-        if 'messages' in formatted_data:
-            # Ollama has a format similar to OpenAI but with slight differences
-            ollama_request = {
-                "model": formatted_data['model'],
-                "messages": formatted_data['messages'],
-                "stream": formatted_data.get('stream', True),
-                "options": {
-                    "temperature": formatted_data.get('temperature', 0.7),
-                    "top_p": formatted_data.get('top_p', 0.95)
-                }
+    elif provider == "ollama":
+        # Transform to Ollama format
+        if 'messages' in formatted_data:
+            # Ollama has a format similar to OpenAI but with slight differences
+            ollama_request = {
+                "model": formatted_data['model'],
+                "messages": formatted_data['messages'],
+                "stream": formatted_data.get('stream', True),
+                "options": {
+                    "temperature": formatted_data.get('temperature', 0.7),
+                    "top_p": formatted_data.get('top_p', 0.95)
+                }
+            }
+            formatted_data = ollama_request
+    
+    # For Groq, Grok, and other OpenAI-compatible APIs, the format is already compatible
+    
+    return formatted_data
+
+def format_response_for_openai(provider_response, original_model, provider=None):
+    """
+    Format provider response to match OpenAI format
+    
+    This function converts from provider-specific response formats to OpenAI-compatible format.
+    Modify this function if you need to support additional providers or custom formats.
+    """
+    provider = provider or AI_PROVIDER
+    
+    try:
+        if provider == "anthropic":
+            # Convert Anthropic response to OpenAI format
+            content = provider_response.get("content", [])
+            content_text = ""
+            for item in content:
+                if item.get("type") == "text":
+                    content_text += item.get("text", "")
+            
+            return {
+                "id": f"chatcmpl-{uuid.uuid4()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": original_model,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": content_text
+                    },
+                    "finish_reason": "stop"
+                }],
+                "usage": provider_response.get("usage", {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                })
+            }
+            
+        elif provider == "google":
+            # Convert Google response to OpenAI format
+            content = ""
+            if "candidates" in provider_response:
+                candidate = provider_response["candidates"][0]
+                if "content" in candidate and "parts" in candidate["content"]:
+                    for part in candidate["content"]["parts"]:
+                        if "text" in part:
+                            content += part["text"]
+            
+            return {
+                "id": f"chatcmpl-{uuid.uuid4()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": original_model,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": content
+                    },
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                }
+            }
+            
+        elif provider == "ollama":
+            # Convert Ollama response to OpenAI format
+            message = provider_response.get("message", {})
+            content = message.get("content", "")
+            
+            return {
+                "id": f"chatcmpl-{uuid.uuid4()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": original_model,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": content
+                    },
+                    "finish_reason": "stop"
+                }],
+                "usage": provider_response.get("usage", {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                })
+            }
+            
+        elif provider in ["groq", "grok", "custom"]:
+            # Groq, Grok, and other OpenAI-compatible APIs already return OpenAI-compatible format
+            response = provider_response.copy()
+            response["model"] = original_model
+            return response
+        
+        else:
+            # Default case - create a basic response
+            logger.warning(f"Unknown provider: {provider}, using default response format")
+            return {
+                "id": f"chatcmpl-{uuid.uuid4()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": original_model,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": "Response from unknown provider"
+                    },
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                }
+            }
+            
+    except Exception as e:
+        logger.error(f"Error formatting response: {str(e)}")
+        logger.error(traceback.format_exc())
+        
+        # Return a basic response structure
+        return {
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": original_model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": f"Error formatting response: {str(e)}"
+                    },
+                    "finish_reason": "stop"
+                }
+            ]
+        }
+
+# ============================================================================
+# PROVIDER ROUTING
+# ============================================================================
+
+# Providers whose chat endpoint can stream responses
+STREAMING_PROVIDERS = ["groq", "grok", "anthropic", "ollama"]
+
+def api_key_label(api_key):
+    """Short, non-secret label for an API key"""
+    return f"...{api_key[-4:]}" if api_key else "none"
+
+def estimate_prompt_tokens(request_data):
+    """Rough prompt size in tokens (about 4 characters per token)"""
+    return max(1, len(json.dumps(request_data.get('messages', request_data.get('contents', [])))) // 4)
+
+class ApiKeyPool:
+    """
+    Spreads requests for one provider across several API keys
+    
+    Each request goes to the key with the most remaining token budget as
+    reported by the provider's rate-limit headers. Keys without a report yet
+    are tried first, and ties go to the key with the fewest requests in
+    flight; a request stays in flight until its stream has been read to the
+    end. Keys answering 401 or 429 are ejected for a while.
+    """
+
+    def __init__(self, provider, keys):
+        self.provider = provider
+        self.keys = keys
+        self.usage = {
+            key: {
+                "requests": 0,
+                "in_flight": 0,
+                "errors": 0,
+                "ejections": 0,
+                "ejected_until": 0,
+                "remaining_tokens": None,
+                "remaining_requests": None,
+                "last_status": None
+            }
+            for key in keys
+        }
+        self.lock = threading.Lock()
+
+    def choose(self, estimated_tokens=0):
+        """Pick a key for the next request and count it as in flight"""
+        with self.lock:
+            now = time.time()
+            available = [key for key in self.keys if self.usage[key]["ejected_until"] <= now]
+            if not available:
+                # Every key is ejected; use the one that returns first rather than failing outright
+                available = [min(self.keys, key=lambda key: self.usage[key]["ejected_until"])]
+            
+            def score(key):
+                usage = self.usage[key]
+                remaining = usage["remaining_tokens"]
+                return (float("inf") if remaining is None else remaining, -usage["in_flight"], -usage["requests"])
+            
+            key = max(available, key=score)
+            usage = self.usage[key]
+            usage["requests"] += 1
+            usage["in_flight"] += 1
+            if usage["remaining_tokens"] is not None:
+                # Spend the estimate locally until the next response reports the real figure
+                usage["remaining_tokens"] -= estimated_tokens
+            return key
+
+    def record_response(self, key, status_code, headers):
+        """Update a key's budget from a response's headers and eject it on 401 or 429; release() ends the request"""
+        with self.lock:
+            usage = self.usage[key]
+            usage["last_status"] = status_code
+            for field, names in (("remaining_tokens", KEY_POOL_TOKEN_HEADERS), ("remaining_requests", KEY_POOL_REQUEST_HEADERS)):
+                for name in names:
+                    try:
+                        usage[field] = float(headers[name])
+                        break
+                    except (KeyError, TypeError, ValueError):
+                        continue
+            if status_code >= 400:
+                usage["errors"] += 1
+            if status_code in (401, 429):
+                eject_for = KEY_EJECT_AUTH_SECONDS if status_code == 401 else KEY_EJECT_RATE_LIMIT_SECONDS
+                try:
+                    eject_for = max(eject_for if status_code == 401 else 0, float(headers.get("retry-after")))
+                except (TypeError, ValueError):
+                    pass
+                usage["ejected_until"] = time.time() + eject_for
+                usage["ejections"] += 1
+                logger.warning(f"Ejecting {self.provider} key {api_key_label(key)} for {eject_for:.0f}s after HTTP {status_code}")
+
+    def available_count(self):
+        """Number of keys not currently ejected"""
+        with self.lock:
+            now = time.time()
+            return sum(1 for usage in self.usage.values() if usage["ejected_until"] <= now)
+
+    def release(self, key, failed=False):
+        """Finish a request once its response has been read, or failed=True if it got no response"""
+        with self.lock:
+            usage = self.usage[key]
+            usage["in_flight"] = max(0, usage["in_flight"] - 1)
+            if failed:
+                usage["errors"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            return {
+                api_key_label(key): {
+                    **{field: value for field, value in usage.items() if field != "ejected_until"},
+                    "ejected_for": max(0, round(usage["ejected_until"] - now, 1))
+                }
+                for key, usage in self.usage.items()
+            }
+
+class UpstreamEndpoint:
+    """One base URL in a provider's endpoint pool"""
+
+    def __init__(self, url, max_concurrency=0):
+        self.url = url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+
+    def load(self):
+        """Outstanding requests, relative to the cap when there is one"""
+        return self.outstanding / self.max_concurrency if self.max_concurrency else self.outstanding
+
+class EndpointPool:
+    """
+    Balances one provider's requests over its endpoints
+    
+    Endpoints are chosen by least outstanding requests, or by the better of
+    two random picks with ENDPOINT_BALANCER=p2c. Endpoints at their
+    concurrency cap are skipped. An endpoint is ejected for
+    ENDPOINT_EJECT_SECONDS after ENDPOINT_EJECT_AFTER_FAILURES consecutive
+    connection errors or 5xx responses.
+    """
+
+    def __init__(self, provider, entries):
+        self.provider = provider
+        self.endpoints = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                self.endpoints.append(UpstreamEndpoint(entry["url"], int(entry.get("max_concurrency", ENDPOINT_MAX_CONCURRENCY))))
+            else:
+                self.endpoints.append(UpstreamEndpoint(entry, ENDPOINT_MAX_CONCURRENCY))
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Reserve an endpoint for a request
+        
+        Returns:
+        UpstreamEndpoint: The chosen endpoint, or None if all are at capacity
+        """
+        with self.lock:
+            now = time.time()
+            open_endpoints = [e for e in self.endpoints if not e.max_concurrency or e.outstanding < e.max_concurrency]
+            candidates = [e for e in open_endpoints if e.ejected_until <= now]
+            if not candidates and open_endpoints:
+                # Every endpoint with room is ejected; try the one that returns first rather than failing outright
+                candidates = [min(open_endpoints, key=lambda e: e.ejected_until)]
+            if not candidates:
+                return None
+            if ENDPOINT_BALANCER == "p2c" and len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            # Prefer the least loaded endpoint, then the one with the fewest recent failures
+            lowest = min((e.load(), e.consecutive_failures) for e in candidates)
+            endpoint = random.choice([e for e in candidates if (e.load(), e.consecutive_failures) == lowest])
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, failed):
+        """Finish a request on an endpoint and update its passive health"""
+        with self.lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            if not failed:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if len(self.endpoints) > 1 and endpoint.consecutive_failures >= ENDPOINT_EJECT_AFTER_FAILURES:
+                endpoint.ejected_until = time.time() + ENDPOINT_EJECT_SECONDS
+                endpoint.ejections += 1
+                endpoint.consecutive_failures = 0
+                logger.warning(f"Ejecting {self.provider} endpoint {endpoint.url} for {ENDPOINT_EJECT_SECONDS}s after repeated failures")
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            return [
+                {
+                    "url": e.url,
+                    "outstanding": e.outstanding,
+                    "max_concurrency": e.max_concurrency,
+                    "requests": e.requests,
+                    "failures": e.failures,
+                    "ejections": e.ejections,
+                    "ejected_for": max(0, round(e.ejected_until - now, 1))
+                }
+                for e in self.endpoints
+            ]
+
+class ProviderAdapter:
+    """
+    Request/response adapter for one provider
+
+    One adapter is created per provider at startup. It captures the provider's
+    URL, endpoint and auth headers and converts requests, responses and
+    streaming chunks between the provider's format and OpenAI's.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.base_url, self.endpoint = get_provider_url_and_endpoint(provider)
+        self.endpoint_pool = EndpointPool(provider, PROVIDER_ENDPOINTS.get(provider) or [self.base_url])
+        # The first pooled endpoint doubles as the provider's base URL for single-endpoint callers
+        self.base_url = self.endpoint_pool.endpoints[0].url
+        self.headers = get_provider_auth_headers(provider)
+        self.supports_streaming = provider in STREAMING_PROVIDERS
+        api_keys = get_provider_api_keys(provider)
+        # Ollama runs without keys; every other provider draws its key from the pool
+        self.key_pool = ApiKeyPool(provider, api_keys) if api_keys and provider != "ollama" else None
+        self.configured = bool(self.base_url) and (provider == "ollama" or bool(api_keys))
+
+    def chat_url(self, api_key=None, base_url=None):
+        """Full chat URL, including the query-string key Google expects"""
+        url = f"{base_url or self.base_url}{self.endpoint}"
+        if self.provider == "google":
+            url += f"?key={api_key or GOOGLE_API_KEY}"
+        return url
+
+    def request_headers(self, api_key=None):
+        """Auth headers for one request, using a pooled key when given"""
+        return get_provider_auth_headers(self.provider, api_key) if api_key else self.headers
+
+    def format_request(self, request_data, upstream_model):
+        return format_request_for_provider(request_data, self.provider, upstream_model)
+
+    def format_response(self, provider_response, original_model):
+        return format_response_for_openai(provider_response, original_model, self.provider)
+
+    def convert_stream_line(self, line, original_model):
+        """
+        Convert one upstream streaming line into OpenAI-style SSE events
+        
+        Returns:
+        list: SSE event strings to forward (may be empty)
+        """
+        if self.provider not in ["anthropic", "ollama"]:
+            # Groq, Grok, and custom already stream OpenAI-format SSE
+            return [f"{line}\n\n"] if line.startswith('data: ') else []
+        
+        # Ollama streams bare JSON lines; Anthropic uses "data: " SSE events
+        payload = line[6:] if line.startswith('data: ') else line
+        if not payload.strip():
+            return []
+        try:
+            event = json.loads(payload)
+        except json.JSONDecodeError:
+            # If it's not JSON, just pass it through
+            return [f"{line}\n\n"] if line.startswith('data: ') else []
+        
+        content = None
+        finish_reason = None
+        if self.provider == "anthropic" and event.get('type') == 'content_block_delta':
+            content = event.get('delta', {}).get('text', '')
+        elif self.provider == "anthropic" and event.get('type') == 'message_delta' and event.get('delta', {}).get('stop_reason'):
+            # Sent once, just before message_stop, with the reason the answer ended
+            finish_reason = STOP_REASONS.get(event['delta']['stop_reason'], "stop")
+        elif self.provider == "ollama" and event.get('done'):
+            finish_reason = STOP_REASONS.get(event.get('done_reason'), "stop")
+            content = event.get('message', {}).get('content') or None
+        elif self.provider == "ollama" and 'content' in event.get('message', {}):
+            content = event['message']['content']
+        if content is None and finish_reason is None:
+            return []
+        
+        def openai_chunk(delta, reason=None):
+            chunk = {
+                "id": f"chatcmpl-{uuid.uuid4()}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": original_model,
+                "choices": [{
+                    "index": 0,
+                    "delta": delta,
+                    "finish_reason": reason
+                }]
+            }
+            return f"data: {json.dumps(chunk)}\n\n"
+        
+        events = []
+        if content is not None:
+            events.append(openai_chunk({"content": content}))
+        if finish_reason:
+            # A separate final chunk, so a finished answer is never mistaken for a dropped stream
+            events.append(openai_chunk({}, finish_reason))
+        return events
+
+# Anthropic stop_reason and Ollama done_reason values mapped to OpenAI finish_reason
+STOP_REASONS = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "stop": "stop",
+    "max_tokens": "length",
+    "length": "length",
+    "tool_use": "tool_calls"
+}
+
+# One adapter per provider, created once at startup
+PROVIDER_ADAPTERS = {provider: ProviderAdapter(provider) for provider in PROVIDER_URLS}
+
+def build_routing_table():
+    """
+    Build the model name -> (provider, upstream model) routing table from MODEL_MAPPINGS
+    
+    Resolution order (later entries win):
+    1. Upstream model names on their own, e.g. "claude-3-opus-20240229"
+    2. "provider/name" for every mapping and upstream model, e.g. "anthropic/gpt-4o"
+    3. Logical names (gpt-4o, default, ...) of the default AI_PROVIDER
+    4. Explicit MODEL_ROUTES overrides
+    """
+    table = {}
+    for provider, mappings in MODEL_MAPPINGS.items():
+        for upstream_model in mappings.values():
+            table.setdefault(upstream_model, (provider, upstream_model))
+    for provider, mappings in MODEL_MAPPINGS.items():
+        for logical_model, upstream_model in mappings.items():
+            table[f"{provider}/{logical_model}"] = (provider, upstream_model)
+            table[f"{provider}/{upstream_model}"] = (provider, upstream_model)
+    for logical_model, upstream_model in MODEL_MAPPINGS.get(AI_PROVIDER, {}).items():
+        table[logical_model] = (AI_PROVIDER, upstream_model)
+    for model_name, target in MODEL_ROUTES.items():
+        provider, _, upstream_model = target.partition("/")
+        if provider not in MODEL_MAPPINGS:
+            logger.warning(f"Ignoring MODEL_ROUTES entry for {model_name}: unknown provider {provider}")
+            continue
+        if not upstream_model:
+            upstream_model = MODEL_MAPPINGS[provider].get(model_name, MODEL_MAPPINGS[provider]["default"])
+        table[model_name] = (provider, upstream_model)
+    return table
+
+ROUTING_TABLE = build_routing_table()
+
+def resolve_model_route(model_name):
+    """
+    Resolve a requested model name to (provider, upstream model)
+    
+    Unknown names fall back to the default model of the default provider. A
+    "provider/model" name with an unmapped model is passed through to that provider.
+    """
+    if model_name in ROUTING_TABLE:
+        return ROUTING_TABLE[model_name]
+    provider, _, upstream_model = (model_name or "").partition("/")
+    if upstream_model and provider in PROVIDER_ADAPTERS:
+        return provider, upstream_model
+    return AI_PROVIDER, MODEL_MAPPINGS[AI_PROVIDER]["default"]
+
+# Edit verbs only count as an instruction at the start of a sentence ("Fix the loop", "Please add
+# tests", "Can you rename it?"), not inside a question such as "How do I add a key to a dict?"
+AUTO_EDIT_PATTERN = re.compile(
+    r"(^|[.!?]\s+)((now|also|then)\s+)?(please\s+|(can|could|would)\s+you\s+(please\s+)?)?"
+    r"(refactor|implement|rewrite|fix|edit|modify|change|add|remove|rename|migrate|optimi[sz]e|debug)\b",
+    re.IGNORECASE | re.MULTILINE
+)
+AUTO_QUESTION_PATTERN = re.compile(r"^\s*(what|why|how|when|where|which|who|is|are|can|does|do|explain)\b|\?\s*$", re.IGNORECASE)
+# Code-shaped lines rather than keywords, so prose such as "let me know" or "return it" is not code
+AUTO_CODE_PATTERN = re.compile(
+    r"```|^\s*(def|class)\s+\w+\s*[(:]|^\s*(import\s+[\w.]+|from\s+[\w.]+\s+import)\b"
+    r"|\bfunction\s*\w*\s*\(|\b(const|let|var)\s+\w+\s*=|[{}]\s*$",
+    re.MULTILINE
+)
+
+def message_text(message):
+    """Plain text of a chat message whose content is a string or a list of parts"""
+    content = message.get('content') or ''
+    if isinstance(content, list):
+        return "\n".join(part.get('text', '') for part in content if isinstance(part, dict))
+    return str(content)
+
+def classify_request(data):
+    """
+    Score how demanding a chat request is, without calling any model
+    
+    Parameters:
+    data (dict): The OpenAI-format request body
+    
+    Returns:
+    tuple: (tier, score, signals) where tier is "fast" or "strong" and signals
+    lists the features that contributed to the score
+    """
+    messages = data.get('messages', [])
+    last_user = next((message_text(m) for m in reversed(messages) if m.get('role') == 'user'), '')
+    signals = {}
+    prompt_tokens = estimate_prompt_tokens(data)
+    if prompt_tokens >= AUTO_ROUTER_LONG_PROMPT_TOKENS:
+        signals["long_prompt"] = 2
+    if any(AUTO_CODE_PATTERN.search(message_text(m)) for m in messages if m.get('role') != 'system'):
+        signals["code"] = 1
+    if data.get('tools') or data.get('functions') or any(m.get('role') == 'tool' or m.get('tool_calls') for m in messages):
+        signals["tools"] = 2
+    if AUTO_EDIT_PATTERN.search(last_user):
+        # An edit alone stays below the threshold; it needs code, tools or a long prompt with it
+        signals["edit"] = 1
+    elif AUTO_QUESTION_PATTERN.search(last_user):
+        signals["question"] = -1
+    if len([m for m in messages if m.get('role') != 'system']) > 6:
+        signals["long_conversation"] = 1
+    score = sum(signals.values())
+    tier = "strong" if score >= AUTO_ROUTER_THRESHOLD else "fast"
+    return tier, score, sorted(signals)
+
+# Recent auto routing decisions and their outcomes, reported on /debug
+auto_router_history = deque(maxlen=AUTO_ROUTER_HISTORY_SIZE)
+auto_router_stats = {"fast": 0, "strong": 0, "errors": 0}
+auto_router_lock = threading.Lock()
+
+def route_auto_model(data, request_id):
+    """Pick the model name for an "auto" request and record the decision"""
+    tier, score, signals = classify_request(data)
+    model_name = AUTO_STRONG_MODEL if tier == "strong" else AUTO_FAST_MODEL
+    decision = {
+        "request_id": request_id,
+        "time": int(time.time()),
+        "tier": tier,
+        "score": score,
+        "signals": signals,
+        "model": model_name,
+        "prompt_tokens": estimate_prompt_tokens(data),
+        "outcome": None
+    }
+    with auto_router_lock:
+        auto_router_stats[tier] += 1
+        auto_router_history.append(decision)
+    logger.info(f"Auto router: score {score} {signals} -> {tier} ({model_name})")
+    return model_name, decision
+
+def record_auto_outcome(decision, status, started, output_chars):
+    """Attach the result of an auto-routed request to its decision"""
+    outcome = {"status": status, "duration": round(time.time() - started, 3), "output_chars": output_chars}
+    with auto_router_lock:
+        decision["outcome"] = outcome
+        # A superseded request was cancelled by the client, not failed by the model
+        if status not in ("ok", "superseded"):
+            auto_router_stats["errors"] += 1
+    logger.info(f"Auto router outcome for {decision['request_id']}: {decision['tier']} ({decision['model']}) {outcome}")
+
+class ContextLengthExceeded(Exception):
+    """The prompt does not fit the context window of its model or any overflow model"""
+    code = "context_length_exceeded"
+
+# Context fitting counters, reported on /debug
+context_stats = {"clamped": 0, "rerouted": 0, "rejected": 0, "skipped_failover": 0}
+context_stats_lock = threading.Lock()
+
+def record_context_event(event):
+    with context_stats_lock:
+        context_stats[event] += 1
+
+def request_context_tokens(request_data):
+    """Estimated prompt tokens of an OpenAI-format request, tool definitions included"""
+    return estimate_prompt_tokens(request_data) + len(json.dumps(request_data.get('tools', []))) // 4
+
+def fits_context(model_name, prompt_tokens):
+    """Whether a model leaves room for output after the prompt (unknown models are assumed to)"""
+    capabilities = MODEL_CAPABILITIES.get(model_name)
+    return capabilities is None or capabilities["context_window"] - prompt_tokens >= CONTEXT_MIN_OUTPUT_TOKENS
+
+def clamp_max_tokens(request_data, model_name):
+    """Return the request with max_tokens lowered to what the model can still produce"""
+    capabilities = MODEL_CAPABILITIES.get(model_name)
+    if not CONTEXT_ROUTING_ENABLED or capabilities is None or not request_data.get('max_tokens'):
+        return request_data
+    room = max(1, min(capabilities["max_output"], capabilities["context_window"] - request_context_tokens(request_data)))
+    if request_data['max_tokens'] <= room:
+        return request_data
+    logger.info(f"Clamping max_tokens from {request_data['max_tokens']} to {room} for {model_name}")
+    record_context_event("clamped")
+    return {**request_data, 'max_tokens': room}
+
+def fit_request_to_context(request_data, model_name, candidates=None):
+    """
+    Make a request fit the context window of its model before any upstream call
+    
+    Parameters:
+    request_data (dict): The OpenAI-format request body
+    model_name (str): The upstream model the request is routed to
+    candidates (list): Upstream models to reroute to if the prompt does not fit
+    
+    Returns:
+    tuple: (request_data, model_name) - a copy with max_tokens clamped to the room
+    left, and the smallest candidate that fits if the model had to be replaced
+    
+    Raises ContextLengthExceeded if neither the model nor a candidate can hold the prompt.
+    """
+    capabilities = MODEL_CAPABILITIES.get(model_name)
+    if not CONTEXT_ROUTING_ENABLED or capabilities is None:
+        return request_data, model_name
+    
+    prompt_tokens = request_context_tokens(request_data)
+    if not fits_context(model_name, prompt_tokens):
+        needs_tools = bool(request_data.get('tools'))
+        fitting = sorted(
+            (MODEL_CAPABILITIES[candidate]["context_window"], candidate) for candidate in (candidates or [])
+            if candidate in MODEL_CAPABILITIES and fits_context(candidate, prompt_tokens)
+            and (MODEL_CAPABILITIES[candidate]["tools"] or not needs_tools)
+            and (MODEL_CAPABILITIES[candidate]["streaming"] or not capabilities["streaming"])
+        )
+        if not fitting:
+            record_context_event("rejected")
+            raise ContextLengthExceeded(
+                f"This request needs about {prompt_tokens} tokens, which does not fit the "
+                f"{capabilities['context_window']} token context window of {model_name} or any overflow model"
+            )
+        logger.info(f"Prompt of about {prompt_tokens} tokens does not fit {model_name}, rerouting to {fitting[0][1]}")
+        record_context_event("rerouted")
+        model_name = fitting[0][1]
+    return clamp_max_tokens(request_data, model_name), model_name
+
+def context_length_error(error):
+    """OpenAI-style 400 response for a prompt that fits no model"""
+    return jsonify({
+        "error": {
+            "message": str(error),
+            "type": "invalid_request_error",
+            "param": "messages",
+            "code": error.code
+        }
+    }), 400
+
+class UpstreamError(Exception):
+    """An upstream provider failed before any output was sent to the client"""
+
+    def __init__(self, message, status_code=None, retryable=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+class CircuitOpenError(UpstreamError):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+    def __init__(self, message):
+        super().__init__(message, retryable=True)
+
+class DeadlineExceeded(UpstreamError):
+    """Raised instead of doing upstream work for a request whose deadline has passed"""
+    code = "deadline_exceeded"
+
+    def __init__(self, message):
+        super().__init__(message, retryable=False)
+
+class Deadline:
+    """Absolute time by which a client request has to be answered"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.time() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(f"Request deadline of {self.seconds:g}s exceeded")
+
+    def timeout(self, cap=API_TIMEOUT):
+        """(connect, read) timeouts for one upstream hop, bounded by the time left"""
+        self.check()
+        remaining = self.remaining()
+        return (min(UPSTREAM_CONNECT_TIMEOUT, remaining), min(cap, remaining))
+
+def request_deadline(route_class):
+    """
+    Deadline of the current request, created on first use
+    
+    Taken from the X-Request-Timeout header if the client sent one, otherwise
+    from ROUTE_DEADLINES for the requested model or the route.
+    """
+    if 'deadline' not in g:
+        try:
+            seconds = min(DEADLINE_MAX, max(1.0, float(request.headers[DEADLINE_HEADER])))
+        except (KeyError, ValueError):
+            data = request.get_json(silent=True) if request.is_json else None
+            model = (data or {}).get('model') if isinstance(data, dict) else None
+            seconds = ROUTE_DEADLINES.get(model, ROUTE_DEADLINES.get(route_class, API_TIMEOUT))
+        g.deadline = Deadline(float(seconds))
+    return g.deadline
+
+class ConcurrencyLimitExceeded(UpstreamError):
+    """Raised when a provider or model stays at its concurrency limit (queue full or wait timed out)"""
+
+    def __init__(self, message, code):
+        super().__init__(message, retryable=True)
+        self.code = code
+
+class ConcurrencyLimiter:
+    """
+    Semaphore with a bounded FIFO wait queue for one provider or provider/model
+    
+    A finishing request hands its slot straight to the oldest waiter, so
+    waiters are admitted in arrival order and the backend never sees more
+    than the configured number of generations.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.waiters = deque()
+        self.stats = {"admitted": 0, "waited": 0, "rejected": 0, "timed_out": 0}
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout=CONCURRENCY_QUEUE_TIMEOUT):
+        """Take a slot, waiting up to timeout; raises ConcurrencyLimitExceeded otherwise"""
+        with self.lock:
+            if self.in_flight < self.limit and not self.waiters:
+                self.in_flight += 1
+                self.stats["admitted"] += 1
+                return
+            if len(self.waiters) >= CONCURRENCY_MAX_QUEUE:
+                self.stats["rejected"] += 1
+                raise ConcurrencyLimitExceeded(f"{self.name} is at its concurrency limit and its queue is full", "queue_full")
+            waiter = threading.Event()
+            self.waiters.append(waiter)
+            self.stats["waited"] += 1
+        
+        if waiter.wait(timeout):
+            return
+        with self.lock:
+            if waiter.is_set():
+                return
+            self.waiters.remove(waiter)
+            self.stats["timed_out"] += 1
+        raise ConcurrencyLimitExceeded(f"Timed out after {timeout:.0f}s waiting for a free {self.name} slot", "queue_timeout")
+
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                # Hand the slot to the oldest waiter; in_flight stays the same
+                self.waiters.popleft().set()
+                self.stats["admitted"] += 1
+            else:
+                self.in_flight = max(0, self.in_flight - 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {"limit": self.limit, "in_flight": self.in_flight, "queued": len(self.waiters), **self.stats}
+
+concurrency_limiters = {
+    name: ConcurrencyLimiter(name, int(limit)) for name, limit in PROVIDER_CONCURRENCY.items() if int(limit) > 0
+}
+
+def acquire_concurrency(provider, model, timeout=CONCURRENCY_QUEUE_TIMEOUT):
+    """
+    Take the provider-wide and per-model slots configured for a request, waiting up to timeout
+    
+    Returns:
+    list: The limiters that were acquired, to be passed to release_concurrency
+    """
+    acquired = []
+    try:
+        for name in (provider, f"{provider}/{model}"):
+            if name in concurrency_limiters:
+                concurrency_limiters[name].acquire(timeout)
+                acquired.append(concurrency_limiters[name])
+    except ConcurrencyLimitExceeded:
+        release_concurrency(acquired)
+        raise
+    return acquired
+
+def release_concurrency(limiters):
+    for limiter in reversed(limiters):
+        limiter.release()
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker for one upstream provider and model
+    
+    The breaker opens when the failure ratio over the last CIRCUIT_BREAKER_WINDOW
+    seconds reaches CIRCUIT_BREAKER_ERROR_RATE. Connection errors, 429s, 5xx
+    responses and calls slower than CIRCUIT_BREAKER_SLOW_CALL count as failures.
+    After CIRCUIT_BREAKER_COOLDOWN seconds a few trial calls are let through;
+    a successful trial closes the breaker and a failed one opens it again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed"
+        self.outcomes = deque()  # (timestamp, failed) pairs inside the window
+        self.opened_at = 0
+        self.half_open_at = 0
+        self.trial_calls = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def prune(self, now):
+        while self.outcomes and now - self.outcomes[0][0] > CIRCUIT_BREAKER_WINDOW:
+            self.outcomes.popleft()
+
+    def allow_request(self):
+        """Return True if a call may go upstream now"""
+        if not CIRCUIT_BREAKER_ENABLED:
+            return True
+        with self.lock:
+            now = time.time()
+            if self.state == "open" and now - self.opened_at >= CIRCUIT_BREAKER_COOLDOWN:
+                self.state = "half_open"
+                self.half_open_at = now
+                self.trial_calls = 0
+                logger.info(f"Circuit breaker for {self.name} is half-open, allowing trial calls")
+            if self.state == "half_open" and now - self.half_open_at >= CIRCUIT_BREAKER_COOLDOWN:
+                # Trial calls that never reported back should not block the breaker forever
+                self.half_open_at = now
+                self.trial_calls = 0
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and self.trial_calls < CIRCUIT_BREAKER_HALF_OPEN_CALLS:
+                self.trial_calls += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_result(self, started, status_code=None):
+        """
+        Record the outcome of an upstream call
+        
+        Parameters:
+        started (float): time.time() when the call was sent
+        status_code (int): HTTP status, or None if the call raised
+        """
+        failed = (status_code is None or status_code == 429 or status_code >= 500
+                  or time.time() - started > CIRCUIT_BREAKER_SLOW_CALL)
+        with self.lock:
+            now = time.time()
+            if self.state == "half_open":
+                if failed:
+                    self.open(now)
+                else:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    logger.info(f"Circuit breaker for {self.name} closed")
+                return
+            if self.state == "open":
+                # Late result from a call sent before the breaker opened
+                return
+            self.outcomes.append((now, failed))
+            self.prune(now)
+            failures = sum(1 for _, call_failed in self.outcomes if call_failed)
+            if len(self.outcomes) >= CIRCUIT_BREAKER_MIN_CALLS and failures / len(self.outcomes) >= CIRCUIT_BREAKER_ERROR_RATE:
+                self.open(now)
+
+    def open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.times_opened += 1
+        self.outcomes.clear()
+        logger.warning(f"Circuit breaker for {self.name} opened, failing fast for {CIRCUIT_BREAKER_COOLDOWN}s")
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            return {
+                "state": self.state,
+                "calls_in_window": len(self.outcomes),
+                "failures_in_window": sum(1 for _, call_failed in self.outcomes if call_failed),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "retry_in": max(0, round(self.opened_at + CIRCUIT_BREAKER_COOLDOWN - now, 1)) if self.state == "open" else 0
+            }
+
+# One breaker per provider/model pair, created on first use
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(provider, model):
+    name = f"{provider}/{model}"
+    with circuit_breakers_lock:
+        if name not in circuit_breakers:
+            circuit_breakers[name] = CircuitBreaker(name)
+        return circuit_breakers[name]
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of live traffic
+    
+    Over the last RETRY_BUDGET_WINDOW seconds, retries may not exceed
+    `ratio` times the number of first attempts, plus a floor of
+    `min_per_second` so retries still work at low traffic.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.requests = deque()
+        self.retries = deque()
+        self.denied = 0
+        self.lock = threading.Lock()
+
+    def prune(self, now):
+        for events in (self.requests, self.retries):
+            while events and now - events[0] > RETRY_BUDGET_WINDOW:
+                events.popleft()
+
+    def record_request(self):
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            self.requests.append(now)
+
+    def try_acquire(self):
+        """Return True and spend budget if a retry is allowed now"""
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            allowed = self.ratio * len(self.requests) + self.min_per_second * RETRY_BUDGET_WINDOW
+            if len(self.retries) >= allowed:
+                self.denied += 1
+                return False
+            self.retries.append(now)
+            return True
+
+    def stats(self):
+        with self.lock:
+            self.prune(time.time())
+            return {
+                "requests_in_window": len(self.requests),
+                "retries_in_window": len(self.retries),
+                "denied": self.denied
+            }
+
+retry_budget = RetryBudget()
+
+def get_breaker_health():
+    """Breaker states and retry budget usage for /health"""
+    with circuit_breakers_lock:
+        breakers = list(circuit_breakers.values())
+    return {
+        "enabled": CIRCUIT_BREAKER_ENABLED,
+        "breakers": {breaker.name: breaker.snapshot() for breaker in breakers},
+        "retry_budget": retry_budget.stats()
+    }
+
+def build_failover_chain(model_name, provider, upstream_model):
+    """
+    Build the ordered list of (provider, upstream model) candidates for a request
+    
+    The routed provider always comes first, followed by the FAILOVER_CHAINS entries
+    for the model (or the "default" chain). A chain entry naming only a provider
+    uses that provider's mapping for the requested model. Unconfigured providers
+    and duplicates are skipped.
+    """
+    chain = [(provider, upstream_model)]
+    entries = FAILOVER_CHAINS.get(model_name, FAILOVER_CHAINS.get("default", []))
+    logical_model = model_name.split("/", 1)[1] if "/" in (model_name or "") else model_name
+    for entry in entries:
+        candidate_provider, _, candidate_model = entry.partition("/")
+        if candidate_provider not in PROVIDER_ADAPTERS or not PROVIDER_ADAPTERS[candidate_provider].configured:
+            continue
+        if not candidate_model:
+            mappings = MODEL_MAPPINGS[candidate_provider]
+            candidate_model = mappings.get(logical_model, mappings["default"])
+        if (candidate_provider, candidate_model) not in chain:
+            chain.append((candidate_provider, candidate_model))
+    return chain
+
+def failover_backoff(attempt):
+    """Full-jitter exponential backoff delay in seconds for a retry pass"""
+    return random.uniform(0, min(FAILOVER_BACKOFF_MAX, FAILOVER_BACKOFF_BASE * (2 ** attempt)))
+
+# Failover counters, reported on /debug
+failover_stats = {"attempts": 0, "failovers": 0, "recovered": 0, "exhausted": 0}
+failover_stats_lock = threading.Lock()
+
+def record_failover_event(event):
+    with failover_stats_lock:
+        failover_stats[event] += 1
+
+# Mid-stream continuation counters, reported on /debug
+continuation_stats = {"attempts": 0, "spliced": 0, "failed": 0, "tokens_saved": 0}
+continuation_lock = threading.Lock()
+
+def record_continuation_event(event, amount=1):
+    with continuation_lock:
+        continuation_stats[event] += amount
+
+def parse_stream_delta(line):
+    """
+    Extract the delta from an OpenAI-style SSE data line
+    
+    Returns:
+    tuple: (content, finish_reason, has_tool_calls), or None if the line carries no choice
+    """
+    if not line.startswith('data: ') or line.strip() == 'data: [DONE]':
+        return None
+    try:
+        chunk = json.loads(line[6:])
+    except json.JSONDecodeError:
+        return None
+    choices = chunk.get('choices') or []
+    if not choices:
+        return None
+    delta = choices[0].get('delta') or {}
+    return delta.get('content') or "", choices[0].get('finish_reason'), bool(delta.get('tool_calls'))
+
+def aggregate_completion(events, model, prompt_tokens=0):
+    """
+    Assemble a chat.completion object from a stream of OpenAI-style SSE events
+    
+    Content and tool call fragments are joined and the last finish_reason is
+    kept. Usage is taken from the stream (top level, or Groq's x_groq) and
+    estimated when the stream reports none. A complete chat.completion sent
+    as one event is returned as is. The stream is always read to the end so
+    its cleanup runs.
+    
+    Parameters:
+    events: Iterable of SSE events or lines
+    model (str): Model name reported in the response
+    prompt_tokens (int): Prompt size used when the stream reports no usage
+    
+    Returns:
+    dict: The chat.completion object, or {"error": {...}} if the stream carried an error event
+    """
+    completion_id = None
+    content_parts = []
+    tool_calls = {}
+    finish_reason = None
+    usage = None
+    result = None
+    for event in events:
+        for line in event.split("\n"):
+            line = line.strip()
+            if not line.startswith('data: ') or line == 'data: [DONE]' or result:
+                continue
+            try:
+                chunk = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            if 'error' in chunk:
+                result = {"error": chunk['error']}
+                continue
+            if chunk.get('object') == 'chat.completion':
+                result = dict(chunk, model=model)
+                continue
+            completion_id = completion_id or chunk.get('id')
+            usage = chunk.get('usage') or (chunk.get('x_groq') or {}).get('usage') or usage
+            for choice in (chunk.get('choices') or [])[:1]:
+                delta = choice.get('delta') or {}
+                if delta.get('content'):
+                    content_parts.append(delta['content'])
+                for call in delta.get('tool_calls') or []:
+                    merged = tool_calls.setdefault(call.get('index', len(tool_calls)), {
+                        "id": None,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""}
+                    })
+                    merged['id'] = call.get('id') or merged['id']
+                    function = call.get('function') or {}
+                    merged['function']['name'] += function.get('name') or ""
+                    merged['function']['arguments'] += function.get('arguments') or ""
+                finish_reason = choice.get('finish_reason') or finish_reason
+    if result:
+        return result
+    
+    content = "".join(content_parts)
+    message = {"role": "assistant", "content": content if content or not tool_calls else None}
+    if tool_calls:
+        message['tool_calls'] = [tool_calls[index] for index in sorted(tool_calls)]
+    if not usage:
+        completion_tokens = max(1, len(content) // 4) if content else 0
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    return {
+        "id": completion_id or f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason or ("tool_calls" if tool_calls else "stop")}],
+        "usage": usage
+    }
+
+def aggregated_response(completion):
+    """JSON response for an aggregated completion, with an error status if the stream failed"""
+    error = completion.get('error')
+    if not error:
+        return jsonify(completion)
+    if error.get('type') == 'timeout_error':
+        status = 504
+    elif error.get('code') == 'superseded':
+        status = 409
+    else:
+        status = 502
+    return jsonify({"error": error}), status
+
+# Repetition abort counters, reported on /debug
+repetition_stats = {"checked": 0, "aborted_loop": 0, "aborted_echo": 0, "tokens_saved": 0}
+repetition_lock = threading.Lock()
+
+def record_repetition_event(event, amount=1):
+    with repetition_lock:
+        repetition_stats[event] += amount
+
+class RollingNgramHash:
+    """Rolling polynomial hash of the last n words pushed"""
+    BASE = 1000003
+    MOD = (1 << 61) - 1
+
+    def __init__(self, n):
+        self.n = n
+        self.window = deque()
+        self.value = 0
+        self.power = pow(self.BASE, n - 1, self.MOD)
+
+    def push(self, word):
+        """Add a word; returns the hash of the last n words, or None until n words were pushed"""
+        word_hash = hash(word) % self.MOD
+        if len(self.window) == self.n:
+            self.value = (self.value - self.window.popleft() * self.power) % self.MOD
+        self.window.append(word_hash)
+        self.value = (self.value * self.BASE + word_hash) % self.MOD
+        return self.value if len(self.window) == self.n else None
+
+class RepetitionDetector:
+    """
+    Watches a streamed completion for runaway repetition
+    
+    The output's words are hashed as rolling n-grams. A run of loop_words
+    n-grams in a row that this response already produced means the model is
+    looping; a run of echo_words n-grams in a row taken from the
+    conversation's recent assistant messages means it is re-emitting an
+    earlier answer, such as the same edit again. Either one stops the stream.
+    """
+
+    def __init__(self, limits, messages, budget_tokens):
+        self.loop_words = limits.get("loop_words", 0)
+        self.echo_words = limits.get("echo_words", 0)
+        self.ngram = max(1, int(limits.get("ngram", 8)))
+        self.budget_tokens = budget_tokens
+        self.rolling = RollingNgramHash(self.ngram)
+        self.seen = set()
+        self.previous = set()
+        if self.echo_words:
+            history = [message_text(message) for message in messages if message.get('role') == 'assistant']
+            for text in history[-REPETITION_HISTORY_RESPONSES:]:
+                rolling = RollingNgramHash(self.ngram)
+                for word in text.split():
+                    ngram_hash = rolling.push(word)
+                    if ngram_hash is not None:
+                        self.previous.add(ngram_hash)
+        self.loop_run = 0
+        self.echo_run = 0
+        self.partial = ""
+        self.chars = 0
+        self.reason = None
+
+    def feed(self, text):
+        """
+        Add streamed content
+        
+        Returns:
+        str: "loop" or "echo" once the stream should be stopped, otherwise None
+        """
+        if self.reason:
+            return self.reason
+        self.chars += len(text)
+        text = self.partial + text
+        words = text.split()
+        # A word at the end of the chunk may continue in the next one
+        self.partial = words.pop() if words and not text[-1].isspace() else ""
+        for word in words:
+            ngram_hash = self.rolling.push(word)
+            if ngram_hash is None:
+                continue
+            self.loop_run = self.loop_run + 1 if ngram_hash in self.seen else 0
+            self.echo_run = self.echo_run + 1 if ngram_hash in self.previous else 0
+            self.seen.add(ngram_hash)
+            if self.loop_words and self.loop_run >= self.loop_words:
+                self.reason = "loop"
+            elif self.echo_words and self.echo_run >= self.echo_words:
+                self.reason = "echo"
+            if self.reason:
+                return self.reason
+        return None
+
+def repetition_abort_events(detector, model):
+    """
+    End a stream stopped by the repetition detector: an explanatory delta,
+    a clean finish chunk and [DONE]
+    """
+    emitted_tokens = detector.chars // 4
+    saved = max(0, detector.budget_tokens - emitted_tokens)
+    record_repetition_event(f"aborted_{detector.reason}")
+    record_repetition_event("tokens_saved", saved)
+    logger.warning(f"Stopped a repeating generation ({detector.reason}) after about {emitted_tokens} tokens, up to {saved} tokens saved")
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time())
+    for delta, reason in (({"content": REPETITION_ABORT_MESSAGES[detector.reason]}, None), ({}, "stop")):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": reason}]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+def repetition_snapshot():
+    with repetition_lock:
+        return {"enabled": REPETITION_ABORT_ENABLED, "limits": REPETITION_LIMITS, **repetition_stats}
+
+def repetition_detector_for(request_data, model, upstream_model):
+    """A RepetitionDetector with the model's limits, or None when repetition abort is off"""
+    if not REPETITION_ABORT_ENABLED:
+        return None
+    limits = REPETITION_LIMITS.get(model) or REPETITION_LIMITS.get(upstream_model) or REPETITION_LIMITS["default"]
+    budget = request_data.get('max_tokens') or MODEL_CAPABILITIES.get(upstream_model, {}).get('max_output', 4096)
+    record_repetition_event("checked")
+    return RepetitionDetector(limits, request_data.get('messages') or [], budget)
+
+# Request-to-first-token times and heartbeat counts, reported on /debug
+first_token_times = deque(maxlen=FIRST_TOKEN_SAMPLES)
+heartbeat_stats = {"streams": 0, "heartbeats": 0, "no_token": 0, "events": 0, "writes": 0}
+heartbeat_lock = threading.Lock()
+
+def record_heartbeat_event(event):
+    with heartbeat_lock:
+        heartbeat_stats[event] += 1
+
+def heartbeat_snapshot():
+    with heartbeat_lock:
+        times = sorted(first_token_times)
+        return {
+            "enabled": HEARTBEAT_ENABLED,
+            "interval": HEARTBEAT_INTERVAL,
+            "coalesce_window_ms": COALESCE_WINDOW_MS if COALESCE_ENABLED else 0,
+            **heartbeat_stats,
+            "events_per_write": round(heartbeat_stats["events"] / heartbeat_stats["writes"], 2) if heartbeat_stats["writes"] else 0,
+            "first_token_p50": round(times[len(times) // 2], 3) if times else 0,
+            "first_token_p95": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3) if times else 0
+        }
+
+def role_delta_event(model):
+    """SSE event opening an assistant message, sent before any upstream output"""
+    chunk = {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+class StreamCanceller:
+    """
+    Closes a request's upstream streaming response from another thread
+    
+    The thread reading a stream blocks inside iter_lines until the next chunk
+    arrives, so closing the response alone only takes effect then. cancel()
+    also shuts the socket down, which wakes the reader at once. Responses
+    attached after cancel() are closed straight away, and cancelling also
+    cancels the child cancellers made with child(). Waits made with wait()
+    end as soon as the request is cancelled.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = set()
+        self.children = []
+        self.cancelled = False
+        # Set by cancel(), or by a supersede token the wait is registered with
+        self.wakeup = threading.Event()
+
+    def child(self):
+        """A canceller for one part of the request, e.g. one side of a hedge, cancelled along with it"""
+        child = StreamCanceller()
+        with self.lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self.children.append(child)
+        if cancelled:
+            child.cancel()
+        return child
+
+    def attach(self, response):
+        """Track a response being read, closing it at once if already cancelled"""
+        with self.lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self.responses.add(response)
+        if cancelled:
+            close_upstream_response(response)
+        return response
+
+    def detach(self, response):
+        """Stop tracking a response that has been read to the end or closed"""
+        with self.lock:
+            self.responses.discard(response)
+
+    def wait(self, timeout):
+        """Sleep up to timeout seconds, returning True early if woken by a cancel"""
+        return self.wakeup.wait(timeout)
+
+    def cancel(self):
+        """Close every tracked response and refuse later ones"""
+        with self.lock:
+            self.cancelled = True
+            responses = list(self.responses)
+            children = self.children
+            self.responses.clear()
+            self.children = []
+        self.wakeup.set()
+        for response in responses:
+            close_upstream_response(response)
+        for child in children:
+            child.cancel()
+
+def close_upstream_response(response):
+    """Close a streaming response, waking any thread blocked reading from it"""
+    sock = getattr(getattr(getattr(response, 'raw', None), 'connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception as e:
+        logger.debug(f"Error closing upstream response: {str(e)}")
+
+def strip_role_delta(event):
+    """
+    Remove `role` from the delta of an SSE completion chunk
+    
+    Returns:
+    str: The event without a role (unchanged if it had none), or None if it is not a completion chunk
+    """
+    if not event.startswith('data: ') or event.strip() == 'data: [DONE]':
+        return None
+    try:
+        chunk = json.loads(event[6:])
+    except json.JSONDecodeError:
+        return None
+    choices = chunk.get('choices') if isinstance(chunk, dict) else None
+    if not choices:
+        return None
+    deltas = [choice.get('delta') for choice in choices if isinstance(choice.get('delta'), dict)]
+    if not any('role' in delta for delta in deltas):
+        return event
+    for delta in deltas:
+        delta.pop('role', None)
+    return f"data: {json.dumps(chunk)}\n\n"
+
+def stream_with_heartbeats(events, model, started, canceller=None, ticket=None):
+    """
+    Yield an SSE stream that opens with a role delta and stays alive while upstream is silent
+    
+    `events` runs in a worker thread, so concurrency-limit queueing, failover
+    and slow first tokens no longer hold back the first byte. While it is
+    silent an SSE comment is sent every HEARTBEAT_INTERVAL seconds so tunnels
+    don't drop the idle connection.
+    
+    After the first token, events that arrive together are joined into one
+    write: whatever is already queued is taken at once, and on a stream whose
+    events come faster than COALESCE_WINDOW_MS apart the batch waits up to
+    that long for more. The first token is always sent on its own.
+    
+    When the client disconnects the worker is told to stop, the upstream
+    response is closed through `canceller` and anything still buffered is
+    dropped, so generation does not carry on for nobody.
+    
+    Parameters:
+    events: Generator of SSE events for the completion
+    model (str): Model name reported in the role delta
+    started (float): Time the request arrived, the first real token is measured from it
+    canceller (StreamCanceller): Closes the upstream responses when the client goes away
+    ticket (AdmissionTicket): Admission slot the worker holds until the upstream request ends
+    """
+    if not HEARTBEAT_ENABLED and not COALESCE_ENABLED:
+        yield from events
+        return
+    buffer = queue.Queue()
+    stopped = threading.Event()
+
+    def pump():
+        # Runs in a worker thread and forwards the stream's events to the buffer
+        try:
+            for event in events:
+                if stopped.is_set():
+                    return
+                buffer.put(("event", event))
+            buffer.put(("end", None))
+        except Exception as e:
+            if not stopped.is_set():
+                buffer.put(("error", e))
+        finally:
+            events.close()
+            if ticket:
+                # The slot frees when the upstream request has ended, not when the client left
+                admission_scheduler.release(ticket)
+
+    record_heartbeat_event("streams")
+    if HEARTBEAT_ENABLED:
+        yield role_delta_event(model)
+    if ticket:
+        admission_scheduler.hold(ticket)
+    threading.Thread(target=pump, daemon=True).start()
+    window = COALESCE_WINDOW_MS / 1000
+    first_token = False
+    # Average gap between events, which decides whether waiting for more is worthwhile
+    event_gap = None
+    last_event = None
+    last_batch_size = 1
+    pending = None
+    # The synthetic role delta opened the message; upstream's own role is dropped
+    role_pending = HEARTBEAT_ENABLED
+    try:
+        while True:
+            if pending:
+                kind, payload = pending
+                pending = None
+            else:
+                try:
+                    kind, payload = buffer.get(timeout=HEARTBEAT_INTERVAL if HEARTBEAT_ENABLED else None)
+                except queue.Empty:
+                    record_heartbeat_event("heartbeats")
+                    yield ": keep-alive\n\n"
+                    continue
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            if role_pending:
+                stripped = strip_role_delta(payload)
+                if stripped is not None:
+                    payload = stripped
+                    role_pending = False
+            batch = [payload]
+            if not first_token:
+                delta = parse_stream_delta(payload.strip())
+                if delta and (delta[0] or delta[2]):
+                    first_token = True
+                    with heartbeat_lock:
+                        first_token_times.append(time.time() - started)
+            elif COALESCE_ENABLED:
+                now = time.time()
+                if last_event is not None:
+                    gap = (now - last_event) / last_batch_size
+                    event_gap = gap if event_gap is None else 0.8 * event_gap + 0.2 * gap
+                last_event = now
+                flush_at = now + window if event_gap is not None and event_gap < window else now
+                size = len(payload)
+                while size < COALESCE_MAX_BYTES and "[DONE]" not in batch[-1]:
+                    try:
+                        remaining = flush_at - time.time()
+                        kind, payload = buffer.get(timeout=remaining) if remaining > 0 else buffer.get_nowait()
+                    except queue.Empty:
+                        break
+                    if kind != "event":
+                        pending = (kind, payload)
+                        break
+                    batch.append(payload)
+                    size += len(payload)
+                last_batch_size = len(batch)
+            with heartbeat_lock:
+                heartbeat_stats["events"] += len(batch)
+                heartbeat_stats["writes"] += 1
+            yield "".join(batch)
+    finally:
+        # Stop the worker, drop the upstream request and whatever was buffered for the client
+        stopped.set()
+        if canceller:
+            canceller.cancel()
+        pending = None
+        while True:
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                break
+        if not first_token:
+            record_heartbeat_event("no_token")
+
+def continuation_request(request_data, emitted_text):
+    """
+    Build a request that resumes a completion from the text already streamed
+    
+    The partial output is appended as an assistant message, which the model
+    continues from instead of starting over.
+    """
+    continued = dict(request_data)
+    continued['messages'] = list(request_data.get('messages', [])) + [{"role": "assistant", "content": emitted_text}]
+    if continued.get('max_tokens'):
+        # Rough token estimate so the spliced response stays within the original limit
+        continued['max_tokens'] = max(1, continued['max_tokens'] - len(emitted_text) // 4)
+    return continued
+
+# Recent time-to-first-token samples per provider/model
+ttft_samples = {}
+ttft_samples_lock = threading.Lock()
+
+def record_ttft(provider, model, seconds):
+    with ttft_samples_lock:
+        ttft_samples.setdefault(f"{provider}/{model}", deque(maxlen=TTFT_SAMPLE_SIZE)).append(seconds)
+
+def ttft_percentile(provider, model, percentile):
+    """Return the TTFT percentile in seconds, or None without enough samples"""
+    with ttft_samples_lock:
+        samples = sorted(ttft_samples.get(f"{provider}/{model}", ()))
+    if len(samples) < TTFT_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+# Hedging counters, reported on /debug
+hedge_stats = {"eligible": 0, "fired": 0, "hedge_wins": 0, "primary_wins": 0, "budget_denied": 0, "cancelled": 0}
+hedge_stats_lock = threading.Lock()
+hedge_budget = RetryBudget(HEDGE_BUDGET_RATIO, 0)
+
+def record_hedge_event(event):
+    with hedge_stats_lock:
+        hedge_stats[event] += 1
+
+class LatencyTable:
+    """
+    Smoothed time-to-first-token and throughput for each provider/model backend
+    
+    Measurements come from live traffic and from the background prober and
+    are folded into exponentially weighted moving averages.
+    """
+
+    def __init__(self):
+        self.backends = {}
+        self.lock = threading.Lock()
+
+    def entry(self, provider, model):
+        name = f"{provider}/{model}"
+        if name not in self.backends:
+            self.backends[name] = {
+                "ttft": None,
+                "tokens_per_second": None,
+                "samples": 0,
+                "probes": 0,
+                "errors": 0,
+                "last_success": 0,
+                "last_error": 0,
+                "last_error_message": None
+            }
+        return self.backends[name]
+
+    def record(self, provider, model, ttft, tokens_per_second=None, probe=False):
+        with self.lock:
+            entry = self.entry(provider, model)
+            entry["ttft"] = ttft if entry["ttft"] is None else (
+                LATENCY_EWMA_ALPHA * ttft + (1 - LATENCY_EWMA_ALPHA) * entry["ttft"])
+            if tokens_per_second:
+                entry["tokens_per_second"] = tokens_per_second if entry["tokens_per_second"] is None else (
+                    LATENCY_EWMA_ALPHA * tokens_per_second + (1 - LATENCY_EWMA_ALPHA) * entry["tokens_per_second"])
+            entry["samples"] += 1
+            entry["probes"] += 1 if probe else 0
+            entry["last_success"] = time.time()
+
+    def record_error(self, provider, model, message):
+        with self.lock:
+            entry = self.entry(provider, model)
+            entry["errors"] += 1
+            entry["last_error"] = time.time()
+            entry["last_error_message"] = message[:200]
+
+    def rank(self, provider, model):
+        """
+        Sort key for a backend: healthy and measured first, then by TTFT
+        
+        A backend is unhealthy if its breaker is not closed or its latest
+        measurement was an error.
+        """
+        breaker = circuit_breakers.get(f"{provider}/{model}")
+        with self.lock:
+            entry = self.backends.get(f"{provider}/{model}")
+            unhealthy = (breaker is not None and breaker.state != "closed") or (
+                entry is not None and entry["last_error"] > entry["last_success"])
+            ttft = entry["ttft"] if entry else None
+        return (unhealthy, ttft is None, ttft or 0)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {
+                    "ttft": round(entry["ttft"], 3) if entry["ttft"] is not None else None,
+                    "tokens_per_second": round(entry["tokens_per_second"], 1) if entry["tokens_per_second"] else None,
+                    "samples": entry["samples"],
+                    "probes": entry["probes"],
+                    "errors": entry["errors"],
+                    "healthy": entry["last_error"] <= entry["last_success"],
+                    "last_error": entry["last_error_message"]
+                }
+                for name, entry in self.backends.items()
+            }
+
+latency_table = LatencyTable()
+
+def timed_stream(stream, provider, model, probe=False):
+    """Pass a stream through, recording its time to first event and throughput"""
+    started = time.time()
+    first_event_at = None
+    last_content_at = None
+    content_chars = 0
+    try:
+        for event in stream:
+            now = time.time()
+            if first_event_at is None:
+                first_event_at = now
+                record_ttft(provider, model, now - started)
+            delta = parse_stream_delta(event.strip())
+            if delta and delta[0]:
+                content_chars += len(delta[0])
+                last_content_at = now
+            yield event
+    except (UpstreamError, requests.exceptions.RequestException) as e:
+        # Client errors say nothing about the backend's health
+        if not isinstance(e, UpstreamError) or e.retryable:
+            latency_table.record_error(provider, model, str(e))
+        raise
+    
+    if first_event_at is not None:
+        # Rough throughput from about 4 characters per token over the streaming window
+        duration = (last_content_at or first_event_at) - first_event_at
+        tokens_per_second = (content_chars / 4) / duration if duration > 0 else None
+        latency_table.record(provider, model, first_event_at - started, tokens_per_second, probe=probe)
+
+def rank_backends(chain):
+    """Order (provider, model) backends healthiest and fastest first when latency routing is on"""
+    if not LATENCY_ROUTING_ENABLED:
+        return chain
+    return sorted(chain, key=lambda backend: latency_table.rank(*backend))
+
+def probe_targets():
+    """Distinct (provider, upstream model) pairs of every configured provider"""
+    targets = []
+    for provider, mappings in MODEL_MAPPINGS.items():
+        adapter = PROVIDER_ADAPTERS.get(provider)
+        if not adapter or not adapter.configured:
+            continue
+        for upstream_model in dict.fromkeys(mappings.values()):
+            targets.append((provider, upstream_model))
+    return targets
+
+def probe_backend(provider, upstream_model):
+    """Send a tiny request to one backend and record its latency"""
+    adapter = PROVIDER_ADAPTERS[provider]
+    probe_data = adapter.format_request({
+        "model": upstream_model,
+        "messages": [{"role": "user", "content": LATENCY_PROBE_PROMPT}],
+        "max_tokens": LATENCY_PROBE_MAX_TOKENS
+    }, upstream_model)
+    probe_data['stream'] = adapter.supports_streaming
+    try:
+        for _ in timed_stream(stream_from_provider(adapter, probe_data, upstream_model), provider, upstream_model, probe=True):
+            pass
+    except Exception as e:
+        logger.info(f"Latency probe for {provider}/{upstream_model} failed: {str(e)[:100]}")
+
+def latency_probe_loop():
+    """Background loop that probes every backend each LATENCY_PROBE_INTERVAL seconds"""
+    while True:
+        for provider, upstream_model in probe_targets():
+            probe_backend(provider, upstream_model)
+        time.sleep(LATENCY_PROBE_INTERVAL)
+
+def start_latency_prober():
+    if LATENCY_ROUTING_ENABLED and LATENCY_PROBE_INTERVAL > 0:
+        threading.Thread(target=latency_probe_loop, name="latency-prober", daemon=True).start()
+        logger.info(f"Latency prober started (every {LATENCY_PROBE_INTERVAL}s)")
+
+def hedging_enabled(model_name):
+    return "*" in HEDGE_MODELS or model_name in HEDGE_MODELS
+
+def hedge_delay(provider, model):
+    """Seconds to wait for a first token before hedging, from the TTFT percentile"""
+    delay = ttft_percentile(provider, model, HEDGE_PERCENTILE)
+    if delay is None:
+        delay = HEDGE_DEFAULT_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, delay))
+
+def hedged_stream(start_primary, start_hedge, delay, canceller):
+    """
+    Yield events from the primary stream, racing a hedge if it is slow to start
+    
+    If the primary stream has produced nothing after `delay` seconds and the
+    hedge budget allows, start_hedge() opens a second stream. Whichever stream
+    produces an event first is used, and the other's upstream response is
+    closed at once through its canceller. Errors are only raised once neither
+    stream can produce output.
+    
+    Parameters:
+    start_primary: Callable taking a StreamCanceller and returning a generator for the original request
+    start_hedge: Callable taking a StreamCanceller and returning a generator for the hedge request
+    delay (float): Seconds to wait for the primary's first event
+    canceller (StreamCanceller): The request's canceller; each side gets a child of it
+    """
+    events = queue.Queue()
+    cancellers = {"primary": canceller.child(), "hedge": canceller.child()}
+
+    def pump(source, stream):
+        # Runs in a worker thread and forwards the stream's events to the queue
+        try:
+            for event in stream:
+                if cancellers[source].cancelled:
+                    return
+                events.put((source, "event", event))
+            events.put((source, "end", None))
+        except Exception as e:
+            events.put((source, "error", e))
+        finally:
+            stream.close()
+
+    threading.Thread(target=pump, args=("primary", start_primary(cancellers["primary"])), daemon=True).start()
+    active = {"primary"}
+    errors = {}
+    winner = None
+    hedge_fired = False
+    hedge_launched = False
+    deadline = time.time() + delay
+    try:
+        while True:
+            timeout = max(0, deadline - time.time()) if winner is None and not hedge_fired else None
+            try:
+                source, kind, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                # The primary is slow to start, fire the hedge if the budget allows
+                hedge_fired = True
+                if not hedge_budget.try_acquire():
+                    record_hedge_event("budget_denied")
+                    continue
+                record_hedge_event("fired")
+                logger.info(f"No first token after {delay:.2f}s, sending hedge request")
+                threading.Thread(target=pump, args=("hedge", start_hedge(cancellers["hedge"])), daemon=True).start()
+                active.add("hedge")
+                hedge_launched = True
+                continue
+            
+            if winner is not None and source != winner:
+                continue
+            if kind == "error":
+                if source == winner:
+                    raise payload
+                active.discard(source)
+                errors[source] = payload
+                if not active:
+                    raise errors.get("primary", payload)
+                continue
+            if winner is None:
+                # First output (or a clean empty finish) decides the race
+                winner = source
+                if hedge_launched:
+                    loser = "hedge" if winner == "primary" else "primary"
+                    # Close the loser's upstream response now rather than at its next event
+                    cancellers[loser].cancel()
+                    record_hedge_event("hedge_wins" if winner == "hedge" else "primary_wins")
+                    if loser in active:
+                        record_hedge_event("cancelled")
+            if kind == "end":
+                return
+            yield payload
+    finally:
+        # Stop whatever is still running, e.g. when the client disconnects
+        for source_canceller in cancellers.values():
+            source_canceller.cancel()
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot get an admission slot (queue full or waited too long)"""
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+class AdmissionTicket:
+    """One request's place in the admission scheduler"""
+    def __init__(self, priority_class, client="anonymous", cost=1.0):
+        self.priority_class = priority_class
+        self.client = client
+        self.cost = cost
+        self.enqueued = time.time()
+        self.granted = threading.Event()
+        # Holders of the slot (the response, plus a stream worker still reading upstream)
+        self.holds = 1
+        self.released = False
+
+class AdmissionScheduler:
+    """
+    Admits requests to a fixed number of upstream slots by priority class and client
+    
+    Each class keeps its reserved slots; the rest are shared. When a slot
+    frees, waiting classes are served by weighted fair queueing (the class
+    with the lowest virtual finish time goes next), so a burst in one class
+    delays the others by at most their weight share. Within a class, clients
+    are served by deficit round robin, one turn per round plus one for every
+    CLIENT_DRR_TOKENS_PER_TURN prompt tokens. If CLIENT_MAX_CONCURRENCY is set,
+    no client holds more slots than that.
+    """
+
+    def __init__(self, capacity, classes, client_limit=CLIENT_MAX_CONCURRENCY):
+        self.capacity = capacity
+        self.classes = classes
+        self.client_limit = client_limit
+        self.shared_capacity = max(0, capacity - sum(config["reserved"] for config in classes.values()))
+        # Per class: client -> queued tickets, and the round-robin order of clients with queued tickets
+        self.queues = {name: {} for name in classes}
+        self.rounds = {name: deque() for name in classes}
+        self.deficits = {name: {} for name in classes}
+        self.queued = {name: 0 for name in classes}
+        self.running = {name: 0 for name in classes}
+        self.client_running = {}
+        self.client_queued = {}
+        self.virtual_time = {name: 0.0 for name in classes}
+        self.stats = {name: {"admitted": 0, "rejected": 0, "timed_out": 0} for name in classes}
+        self.waits = {name: deque(maxlen=ADMISSION_WAIT_SAMPLES) for name in classes}
+        self.lock = threading.Lock()
+
+    def shared_in_use(self):
+        return sum(max(0, self.running[name] - self.classes[name]["reserved"]) for name in self.classes)
+
+    def can_run(self, name):
+        if sum(self.running.values()) >= self.capacity:
+            return False
+        return self.running[name] < self.classes[name]["reserved"] or self.shared_in_use() < self.shared_capacity
+
+    def client_can_run(self, client):
+        return not self.client_limit or self.client_running.get(client, 0) < self.client_limit
+
+    def has_runnable_client(self, name):
+        return any(self.client_can_run(client) for client in self.rounds[name])
+
+    def next_ticket(self, name):
+        """Pick the next ticket of a class by deficit round robin, skipping clients at their cap"""
+        clients = self.rounds[name]
+        deficits = self.deficits[name]
+        while clients:
+            client = clients[0]
+            if not self.client_can_run(client):
+                clients.rotate(-1)
+                if not self.has_runnable_client(name):
+                    return None
+                continue
+            ticket = self.queues[name][client][0]
+            if deficits.get(client, 0) < ticket.cost:
+                # Not enough credit this round; top up one turn and move to the back
+                deficits[client] = deficits.get(client, 0) + 1
+                clients.rotate(-1)
+                continue
+            deficits[client] -= ticket.cost
+            self.queues[name][client].popleft()
+            if not self.queues[name][client]:
+                del self.queues[name][client]
+                del deficits[client]
+                clients.popleft()
+            self.queued[name] -= 1
+            self.adjust(self.client_queued, client, -1)
+            return ticket
+        return None
+
+    def dispatch(self):
+        """Grant free slots to waiting requests; called with the lock held"""
+        while True:
+            eligible = [name for name in self.classes if self.queued[name] and self.can_run(name) and self.has_runnable_client(name)]
+            if not eligible:
+                return
+            name = min(eligible, key=lambda candidate: self.virtual_time[candidate])
+            self.grant(self.next_ticket(name))
+
+    def grant(self, ticket):
+        name = ticket.priority_class
+        # A class returning from idle starts at the current minimum so it cannot claim a backlog of turns
+        active = [self.virtual_time[other] for other in self.classes if other != name and (self.queued[other] or self.running[other])]
+        if active:
+            self.virtual_time[name] = max(self.virtual_time[name], min(active))
+        self.virtual_time[name] += 1.0 / max(self.classes[name]["weight"], 0.001)
+        self.running[name] += 1
+        self.adjust(self.client_running, ticket.client, 1)
+        self.stats[name]["admitted"] += 1
+        self.waits[name].append(time.time() - ticket.enqueued)
+        ticket.granted.set()
+
+    @staticmethod
+    def adjust(counts, client, amount):
+        counts[client] = counts.get(client, 0) + amount
+        if counts[client] <= 0:
+            del counts[client]
+
+    def acquire(self, priority_class, client="anonymous", cost=1.0, timeout=ADMISSION_MAX_WAIT):
+        """
+        Wait for a slot for a request of the given class and client
+        
+        Parameters:
+        priority_class (str): Name of the request's priority class
+        client (str): Client identity the request is fair-queued under
+        cost (float): Round-robin turns the request uses up
+        timeout (float): Longest time to wait in the queue
+        
+        Returns:
+        AdmissionTicket: Pass it to release() when the request finishes
+        
+        Raises AdmissionRejected if a queue is full or no slot frees within timeout.
+        """
+        ticket = AdmissionTicket(priority_class, client, cost)
+        with self.lock:
+            if not self.queued[priority_class] and self.can_run(priority_class) and self.client_can_run(client):
+                self.grant(ticket)
+                return ticket
+            if self.queued[priority_class] >= self.classes[priority_class]["max_queue"]:
+                self.stats[priority_class]["rejected"] += 1
+                raise AdmissionRejected(f"Too many queued {priority_class} requests, try again later", "queue_full")
+            if self.client_queued.get(client, 0) >= CLIENT_MAX_QUEUE:
+                self.stats[priority_class]["rejected"] += 1
+                raise AdmissionRejected("Too many queued requests from this client, try again later", "client_queue_full")
+            if client not in self.queues[priority_class]:
+                self.queues[priority_class][client] = deque()
+                self.rounds[priority_class].append(client)
+            self.queues[priority_class][client].append(ticket)
+            self.queued[priority_class] += 1
+            self.adjust(self.client_queued, client, 1)
+            self.dispatch()
+        
+        if not ticket.granted.wait(timeout):
+            with self.lock:
+                if not ticket.granted.is_set():
+                    self.remove(ticket)
+                    self.stats[priority_class]["timed_out"] += 1
+                    raise AdmissionRejected(
+                        f"No capacity for {priority_class} request after waiting {timeout:.0f}s, try again later", "queue_timeout")
+        return ticket
+
+    def remove(self, ticket):
+        """Take a ticket that gave up waiting out of its queue; called with the lock held"""
+        name, client = ticket.priority_class, ticket.client
+        self.queues[name][client].remove(ticket)
+        if not self.queues[name][client]:
+            del self.queues[name][client]
+            self.deficits[name].pop(client, None)
+            self.rounds[name].remove(client)
+        self.queued[name] -= 1
+        self.adjust(self.client_queued, client, -1)
+
+    def hold(self, ticket):
+        """Keep a granted slot until one more release(), e.g. while a worker still reads upstream"""
+        with self.lock:
+            if not ticket.released:
+                ticket.holds += 1
+
+    def release(self, ticket):
+        """Drop one hold on a slot; the slot frees once every holder has released it"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.holds -= 1
+            if ticket.holds > 0:
+                return
+            ticket.released = True
+            self.running[ticket.priority_class] -= 1
+            self.adjust(self.client_running, ticket.client, -1)
+            self.dispatch()
+
+    def snapshot(self):
+        with self.lock:
+            classes = {}
+            for name, config in self.classes.items():
+                waits = sorted(self.waits[name])
+                classes[name] = {
+                    **config,
+                    "running": self.running[name],
+                    "queued": self.queued[name],
+                    **self.stats[name],
+                    "wait_p50": round(waits[len(waits) // 2], 3) if waits else 0,
+                    "wait_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0
+                }
+            clients = {
+                client: {"in_flight": self.client_running.get(client, 0), "queued": self.client_queued.get(client, 0)}
+                for client in set(self.client_running) | set(self.client_queued)
+            }
+            return {
+                "capacity": self.capacity,
+                "shared_capacity": self.shared_capacity,
+                "client_limit": self.client_limit,
+                "classes": classes,
+                "clients": clients
+            }
+
+admission_scheduler = AdmissionScheduler(ADMISSION_MAX_CONCURRENCY, PRIORITY_CLASSES)
+
+def classify_priority(route_class):
+    """Pick the priority class for the current request from its header, model or route"""
+    header_class = request.headers.get(PRIORITY_HEADER, "").strip().lower()
+    if header_class in PRIORITY_CLASSES:
+        return header_class
+    data = request.get_json(silent=True) if request.is_json else None
+    model_class = PRIORITY_MODEL_CLASSES.get((data or {}).get('model'))
+    if model_class in PRIORITY_CLASSES:
+        return model_class
+    return PRIORITY_ROUTE_CLASSES.get(route_class, "interactive")
+
+def client_identity():
+    """
+    Identify the client for fair queueing: its IP, or a label of its bearer token
+    when CLIENT_IDENTITY is "auto"
+    
+    The token itself is never stored or logged, only a short hash of it.
+    """
+    auth = request.headers.get('Authorization', '')
+    if CLIENT_IDENTITY != "ip" and auth.lower().startswith("bearer ") and auth[7:].strip():
+        return "key-" + hashlib.sha256(auth[7:].strip().encode('utf-8')).hexdigest()[:12]
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.split(',')[0].strip() or request.remote_addr or "anonymous"
+
+class RequestSuperseded(Exception):
+    """Raised to stop work on a request replaced by a newer one from the same conversation"""
+    code = "superseded"
+
+class SupersedeToken:
+    """Cancellation flag for one in-flight request of a conversation"""
+    def __init__(self, scope, chain):
+        self.scope = scope
+        self.chain = chain
+        self.cancelled = threading.Event()
+        # Events of waits (e.g. a failover backoff) to end when the request is superseded
+        self.wakeups = []
+
+    def cancel(self):
+        self.cancelled.set()
+        for wakeup in list(self.wakeups):
+            wakeup.set()
+
+class ConversationTracker:
+    """
+    Tracks in-flight requests per client and model
+    
+    A request supersedes an older in-flight one only when its messages start
+    with all of the older request's messages, i.e. it resends or continues
+    that conversation. Requests that merely share a system prompt or earlier
+    turns are independent. A superseded request stops before going upstream,
+    or closes its upstream stream at the next line.
+    """
+
+    def __init__(self):
+        self.active = {}
+        self.stats = {"tracked": 0, "superseded": 0, "cancelled_before_upstream": 0, "cancelled_streams": 0}
+        self.lock = threading.Lock()
+
+    def start(self, key):
+        scope, chain = key
+        token = SupersedeToken(scope, chain)
+        with self.lock:
+            in_flight = self.active.setdefault(scope, [])
+            superseded = [
+                other for other in in_flight
+                if len(other.chain) <= len(chain) and chain[len(other.chain) - 1] == other.chain[-1]
+            ]
+            for other in superseded:
+                in_flight.remove(other)
+            in_flight.append(token)
+            self.stats["tracked"] += 1
+            self.stats["superseded"] += len(superseded)
+        for other in superseded:
+            logger.info(f"Request in conversation {other.chain[-1][:12]} superseded by a newer one, cancelling it")
+            other.cancel()
+        return token
+
+    def finish(self, token):
+        with self.lock:
+            in_flight = self.active.get(token.scope, [])
+            if token in in_flight:
+                in_flight.remove(token)
+            if not in_flight:
+                self.active.pop(token.scope, None)
+
+    def record(self, event):
+        with self.lock:
+            self.stats[event] += 1
+
+    def snapshot(self):
+        with self.lock:
+            in_flight = sum(len(tokens) for tokens in self.active.values())
+            return {"enabled": SUPERSEDE_ENABLED, "debounce": SUPERSEDE_DEBOUNCE, "in_flight": in_flight, **self.stats}
+
+conversation_tracker = ConversationTracker()
+
+def conversation_key(messages, model, client):
+    """
+    Identify the conversation of a request
+    
+    Returns:
+    tuple: (scope, chain) - scope is the client and model; chain[i] hashes
+    messages 0..i, so a request that extends another one carries the other's
+    last hash at the same position. None if there are no messages.
+    """
+    if not messages:
+        return None
+    digest = hashlib.sha256(json.dumps([client, model]).encode('utf-8'))
+    chain = []
+    for message in messages:
+        digest.update(json.dumps([message.get('role'), message_text(message)]).encode('utf-8'))
+        chain.append(digest.copy().hexdigest())
+    return (client, model), chain
+
+def run_admitted(handler, route_class, *args, **kwargs):
+    """
+    Run a route handler once the admission scheduler grants it a slot
+    
+    The slot is held until the response has been fully sent, and streams
+    started with stream_with_heartbeats hold it until their upstream request
+    has ended, so streamed completions count against the limit for as long
+    as the provider is generating them.
+    """
+    if not ADMISSION_ENABLED or request.method == 'OPTIONS':
+        return handler(*args, **kwargs)
+    priority_class = classify_priority(route_class)
+    client = client_identity()
+    deadline = request_deadline(route_class)
+    try:
+        cost = 1 + (len(request.get_data()) // 4) / CLIENT_DRR_TOKENS_PER_TURN
+        ticket = admission_scheduler.acquire(priority_class, client, cost, timeout=max(0, min(ADMISSION_MAX_WAIT, deadline.remaining())))
+    except AdmissionRejected as e:
+        logger.warning(str(e))
+        response = make_response(jsonify({
+            "error": {
+                "message": str(e),
+                "type": "server_error",
+                "param": None,
+                "code": e.code
             }
-            formatted_data = ollama_request
-    
-    # For Groq, Grok, and other OpenAI-compatible APIs, the format is already compatible
+        }))
+        response.status_code = 503
+        response.headers['Retry-After'] = "1"
+        return response
     
-    return formatted_data
+    g.admitted_at = time.time()
+    g.admission_ticket = ticket
+    wait = g.admitted_at - ticket.enqueued
+    if wait > 0.05:
+        logger.info(f"Admitted {priority_class} request from {client} after {wait:.2f}s in queue")
+    try:
+        response = make_response(handler(*args, **kwargs))
+    except Exception:
+        admission_scheduler.release(ticket)
+        raise
+    response.call_on_close(lambda: admission_scheduler.release(ticket))
+    return response
+
+def admitted(route_class):
+    """Decorator that puts a route behind the admission scheduler"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            return run_admitted(handler, route_class, *args, **kwargs)
+        return wrapper
+    return decorator
 
-def format_response_for_openai(provider_response, original_model):
+def stream_from_provider(adapter, request_data, original_model, deadline=None, canceller=None):
     """
-    Format provider response to match OpenAI format
+    Send a request to one provider and yield OpenAI-style SSE events
     
-    This function converts from provider-specific response formats to OpenAI-compatible format.
-    Modify this function if you need to support additional providers or custom formats.
+    Raises UpstreamError before yielding anything if the provider cannot be
+    reached, answers with an error status, has an open circuit breaker or has
+    no endpoint with spare capacity, or if its concurrency limit does not free
+    up in time, so the caller can fail over.
+    
+    Parameters:
+    adapter (ProviderAdapter): The provider to send the request to
+    request_data (dict): Request body already formatted for the provider
+    original_model (str): Model name the client asked for
+    deadline (Deadline): The client's deadline, which bounds queueing, timeouts and reading
+    canceller (StreamCanceller): Tracks the response so it can be closed from another thread
     """
-    provider = AI_PROVIDER
+    if deadline:
+        deadline.check()
+    if canceller and canceller.cancelled:
+        raise UpstreamError("Request cancelled before it was sent")
+    breaker = get_circuit_breaker(adapter.provider, request_data.get('model', 'default'))
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"Circuit breaker open for {breaker.name}, failing fast")
+    
+    # Wait for a free generation slot on backends with a concurrency limit
+    limiters = acquire_concurrency(
+        adapter.provider, request_data.get('model', 'default'),
+        max(0, min(CONCURRENCY_QUEUE_TIMEOUT, deadline.remaining())) if deadline else CONCURRENCY_QUEUE_TIMEOUT
+    )
     
+    # Pick a base URL from the provider's endpoint pool
+    endpoint = adapter.endpoint_pool.acquire()
+    if endpoint is None:
+        release_concurrency(limiters)
+        raise UpstreamError(f"All {adapter.provider} endpoints are at capacity or ejected", retryable=True)
+    endpoint_failed = True
+    provider_response = None
+    api_key = None
+    key_failed = False
     try:
-        if provider == "anthropic":
-            # Convert Anthropic response to OpenAI format
-            content = provider_response.get("content", [])
-            content_text = ""
-            for item in content:
-                if item.get("type") == "text":
-                    content_text += item.get("text", "")
-            
-            return {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": original_model,
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": content_text
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": provider_response.get("usage", {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
-                })
-            }
-            
-        elif provider == "google":
-            # Convert Google response to OpenAI format
-            content = ""
-            if "candidates" in provider_response:
-                candidate = provider_response["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    for part in candidate["content"]["parts"]:
-                        if "text" in part:
-                            content += part["text"]
-            
-            return {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": original_model,
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": content
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
-                }
-            }
-            
-        elif provider == "ollama":
-            # Convert Ollama response to OpenAI format
-            message = provider_response.get("message", {})
-            content = message.get("content", "")
-            
-            return {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": original_model,
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": content
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": provider_response.get("usage", {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
-                })
-            }
-            
-        elif provider in ["groq", "grok", "custom"]:
-            # Groq, Grok, and other OpenAI-compatible APIs already return OpenAI-compatible format
-            response = provider_response.copy()
-            response["model"] = original_model
-            return response
+        timeout = deadline.timeout() if deadline else API_TIMEOUT
         
-        else:
-            # Default case - create a basic response
-            logger.warning(f"Unknown provider: {provider}, using default response format")
-            return {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": original_model,
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": "Response from unknown provider"
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
-                }
-            }
-            
-    except Exception as e:
-        logger.error(f"Error formatting response: {str(e)}")
-        logger.error(traceback.format_exc())
+        # Use the pooled key with the most budget left
+        api_key = adapter.key_pool.choose(estimate_prompt_tokens(request_data)) if adapter.key_pool else None
+    
+        started = time.time()
+        try:
+            provider_response = requests.post(
+                adapter.chat_url(api_key, endpoint.url),
+                json=request_data,
+                headers=adapter.request_headers(api_key),
+                stream=adapter.supports_streaming,
+                timeout=timeout
+            )
+        except requests.exceptions.RequestException as e:
+            breaker.record_result(started)
+            key_failed = True
+            if not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                raise
+            raise UpstreamError(f"{adapter.provider} is unreachable: {str(e)}", retryable=True)
+        if canceller:
+            canceller.attach(provider_response)
+        breaker.record_result(started, provider_response.status_code)
+        endpoint_failed = provider_response.status_code >= 500
+        if api_key:
+            adapter.key_pool.record_response(api_key, provider_response.status_code, provider_response.headers)
+    
+        with provider_response:
+            # Check for error status
+            if provider_response.status_code != 200:
+                error_msg = provider_response.text[:200] if hasattr(provider_response, 'text') else "Unknown error"
+                logger.error(f"API error: {provider_response.status_code} - {error_msg}")
+                raise UpstreamError(
+                    error_msg,
+                    status_code=provider_response.status_code,
+                    retryable=provider_response.status_code in RETRYABLE_STATUS_CODES
+                )
         
-        # Return a basic response structure
-        return {
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": original_model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": f"Error formatting response: {str(e)}"
-                    },
-                    "finish_reason": "stop"
+            # For non-streaming providers, return the response as a single event
+            if not adapter.supports_streaming:
+                response_json = provider_response.json()
+                log_raw_data(f"{adapter.provider.upper()} RESPONSE", response_json)
+                openai_response = adapter.format_response(response_json, original_model)
+                yield f"data: {json.dumps(openai_response)}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+        
+            # Create a list to collect streaming chunks for logging
+            collected_chunks = []
+        
+            # Track if we're in a code block to prevent premature closing
+            in_code_block = False
+            code_block_count = 0
+        
+            # Process the streaming response
+            for line in provider_response.iter_lines():
+                if deadline:
+                    # The client has given up; stop generating for it
+                    deadline.check()
+                if line:
+                    line = line.decode('utf-8')
+                
+                    # Collect the chunk for logging
+                    collected_chunks.append(line)
+                
+                    # Check if we're entering or exiting a code block
+                    if line.startswith('data: ') and '"content":"```' in line:
+                        in_code_block = True
+                        code_block_count += 1
+                        logger.info(f"Entering code block #{code_block_count}")
+                    elif line.startswith('data: ') and '"content":"```' in line and in_code_block:
+                        in_code_block = False
+                        logger.info(f"Exiting code block #{code_block_count}")
+                
+                    if line.strip() == 'data: [DONE]':
+                        # The final [DONE] marker is sent once after the loop
+                        break
+                
+                    # Convert the provider's streaming format to OpenAI SSE
+                    for event in adapter.convert_stream_line(line, original_model):
+                        yield event
+        
+            # Log all collected chunks at once
+            if collected_chunks:
+                log_raw_data("STREAMING RESPONSE (COMPLETE)", 
+                            collect_streaming_chunks(collected_chunks))
+        
+            # If we were in a code block, make sure we send a proper closing
+            if in_code_block:
+                logger.info("Detected unclosed code block, sending closing marker")
+                # Send a dummy chunk to keep the connection alive
+                dummy_chunk = {
+                    "id": f"chatcmpl-{uuid.uuid4()}",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": original_model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": ""},
+                        "finish_reason": None
+                    }]
                 }
-            ]
-        }
+                yield f"data: {json.dumps(dummy_chunk)}\n\n"
+        
+            # Always send a final [DONE] marker
+            yield "data: [DONE]\n\n"
+        
+            # Wait a moment before closing to ensure all data is processed
+            time.sleep(0.5)
+    except requests.exceptions.RequestException as e:
+        if canceller and canceller.cancelled:
+            # A read broken by cancelling the request says nothing about the endpoint's health
+            endpoint_failed = False
+            raise UpstreamError("Request cancelled") from e
+        endpoint_failed = True
+        raise
+    finally:
+        if canceller and provider_response is not None:
+            canceller.detach(provider_response)
+        # The key stays in flight until the stream has been read to the end
+        if api_key:
+            adapter.key_pool.release(api_key, failed=key_failed)
+        adapter.endpoint_pool.release(endpoint, endpoint_failed)
+        release_concurrency(limiters)
 
 # ============================================================================
 # FLASK APPLICATION SETUP
@@ -630,11 +3577,63 @@ def debug():
             "/simple",
             "/agent"
         ],
-        "models": list(MODEL_MAPPINGS[AI_PROVIDER].keys()),
+        "models": list(ROUTING_TABLE.keys()),
         "api_key_set": bool(get_provider_api_key()),
         "agent_mode_enabled": AGENT_MODE_ENABLED,
         "base_url": PROVIDER_URLS.get(AI_PROVIDER, ""),
-        "chat_endpoint": PROVIDER_CHAT_ENDPOINTS.get(AI_PROVIDER, "")
+        "chat_endpoint": PROVIDER_CHAT_ENDPOINTS.get(AI_PROVIDER, ""),
+        "routing_table": {model: f"{provider}/{upstream}" for model, (provider, upstream) in ROUTING_TABLE.items()},
+        "providers": {
+            name: {
+                "configured": adapter.configured,
+                "base_url": adapter.base_url,
+                "chat_endpoint": adapter.endpoint,
+                "streaming": adapter.supports_streaming,
+                "endpoints": adapter.endpoint_pool.snapshot()
+            }
+            for name, adapter in PROVIDER_ADAPTERS.items()
+        },
+        "failover": {
+            "chains": FAILOVER_CHAINS,
+            "max_retries": MAX_RETRIES,
+            "stats": dict(failover_stats)
+        },
+        "hedging": {
+            "models": HEDGE_MODELS,
+            "percentile": HEDGE_PERCENTILE,
+            "stats": dict(hedge_stats),
+            "overhead": round(hedge_stats["fired"] / hedge_stats["eligible"], 3) if hedge_stats["eligible"] else 0,
+            "hedge_win_rate": round(hedge_stats["hedge_wins"] / hedge_stats["fired"], 3) if hedge_stats["fired"] else 0
+        },
+        "auto_router": {
+            "enabled": AUTO_ROUTER_ENABLED,
+            "model": AUTO_MODEL_NAME,
+            "fast_model": AUTO_FAST_MODEL,
+            "strong_model": AUTO_STRONG_MODEL,
+            "threshold": AUTO_ROUTER_THRESHOLD,
+            "stats": dict(auto_router_stats),
+            "recent": list(auto_router_history)[-20:]
+        },
+        "context_routing": {
+            "enabled": CONTEXT_ROUTING_ENABLED,
+            "capabilities": MODEL_CAPABILITIES,
+            "stats": dict(context_stats)
+        },
+        "stream_continuation": {
+            "enabled": STREAM_CONTINUATION_ENABLED,
+            "max_attempts": STREAM_CONTINUATION_MAX_ATTEMPTS,
+            "stats": dict(continuation_stats)
+        },
+        "concurrency": {name: limiter.snapshot() for name, limiter in concurrency_limiters.items()},
+        "admission": {"enabled": ADMISSION_ENABLED, **admission_scheduler.snapshot()},
+        "supersede": conversation_tracker.snapshot(),
+        "heartbeats": heartbeat_snapshot(),
+        "repetition": repetition_snapshot(),
+        "api_keys": {
+            name: adapter.key_pool.snapshot()
+            for name, adapter in PROVIDER_ADAPTERS.items() if adapter.key_pool
+        },
+        "cache_memory": get_cache_stats()
     })
 
 # Handle OPTIONS requests for all routes
@@ -673,6 +3672,7 @@ def process_chat_request():
         
         # Generate a unique request ID
         request_id = str(uuid.uuid4())
+        received_at = time.time()
         
         # Check if we're already streaming this request
         request_hash = hash(str(request.data))
@@ -734,251 +3734,310 @@ def process_chat_request():
             
             # Get the original model name for later use
             original_model = data.get('model', 'default-model')
-            
-            # Format the request data for the specific provider
-            request_data = format_request_for_provider(data)
         else:
             try:
                 data = json.loads(request.data.decode('utf-8'))
                 logger.info(f"Non-JSON request parsed for model: {data.get('model', 'unknown')}")
                 original_model = data.get('model', 'default-model')
-                request_data = format_request_for_provider(data)
             except:
                 logger.error("Failed to parse request data")
                 original_model = "default-model"
-                request_data = {}
+                data = {}
         
-        # Check cache for this exact request
-        cache_key = None
-        if request.is_json:
-            try:
-                cache_key = json.dumps(data, sort_keys=True)
-                if cache_key in request_cache:
-                    logger.info("Using cached response for duplicate request")
-                    return request_cache[cache_key]
-            except Exception as e:
-                logger.error(f"Error checking cache: {str(e)}")
+        # Every upstream hop made for this request must finish before the client gives up
+        deadline = request_deadline("chat")
         
-        # Get provider-specific information
-        base_url, endpoint = get_provider_url_and_endpoint()
-        auth_headers = get_provider_auth_headers()
+        # Let the auto router pick a model name; responses keep the name the client asked for
+        route_model = original_model
+        auto_decision = None
+        if AUTO_ROUTER_ENABLED and original_model == AUTO_MODEL_NAME:
+            route_model, auto_decision = route_auto_model(data, request_id)
         
-        # Modify request for streaming if supported
-        if AI_PROVIDER in ["groq", "grok", "anthropic", "ollama"]:
-            # These providers support streaming
-            request_data['stream'] = True
-        else:
-            # For providers that don't support streaming, we'll use non-streaming
-            request_data['stream'] = False
+        # Route the model to a provider and format the request for it
+        provider, upstream_model = resolve_model_route(route_model)
+        logger.info(f"Routing model {original_model} to {provider}/{upstream_model}")
         
-        logger.info(f"Sending request to {AI_PROVIDER.upper()} API")
-        log_raw_data(f"{AI_PROVIDER.upper()} REQUEST", request_data)
+        # Clamp max_tokens or move to a larger-context model of the same provider before any upstream call
+        if data:
+            data, fitted_model = fit_request_to_context(data, upstream_model, list(dict.fromkeys(MODEL_MAPPINGS.get(provider, {}).values())))
+            upstream_model = fitted_model
         
-        # Google API might need special handling for the API key
-        full_url = f"{base_url}{endpoint}"
-        if AI_PROVIDER == "google":
-            full_url += f"?key={GOOGLE_API_KEY}"
+        def prepare_request(candidate_provider, candidate_model, emitted_text=None):
+            """Format the request body for one candidate, optionally continuing a partial response"""
+            source_data = continuation_request(data, emitted_text) if emitted_text else data
+            source_data = clamp_max_tokens(source_data, candidate_model) if source_data else source_data
+            candidate_data = PROVIDER_ADAPTERS[candidate_provider].format_request(source_data, candidate_model) if source_data else {}
+            # Stream from providers that support it, use a single response otherwise
+            candidate_data['stream'] = PROVIDER_ADAPTERS[candidate_provider].supports_streaming
+            return candidate_data
         
-        def generate():
-            try:
-                # Create a list to collect streaming chunks for logging
-                collected_chunks = []
-                
-                # Track if we're in a code block to prevent premature closing
-                in_code_block = False
-                code_block_count = 0
-                last_chunk_time = time.time()
+        request_data = prepare_request(provider, upstream_model)
+        failover_chain = build_failover_chain(route_model, provider, upstream_model)
+        # Failover candidates too small for the prompt would only fail after a round trip
+        prompt_tokens = request_context_tokens(data) if data else 0
+        fitting_chain = [failover_chain[0]] + [backend for backend in failover_chain[1:] if fits_context(backend[1], prompt_tokens)]
+        if len(fitting_chain) < len(failover_chain):
+            record_context_event("skipped_failover")
+            failover_chain = fitting_chain
+        if LATENCY_ROUTING_ENABLED:
+            failover_chain = rank_backends(failover_chain)
+            if failover_chain[0] != (provider, upstream_model):
+                logger.info(f"Latency routing: {original_model} -> {failover_chain[0][0]}/{failover_chain[0][1]}")
+                provider, upstream_model = failover_chain[0]
+                request_data = prepare_request(provider, upstream_model)
+        if len(failover_chain) > 1:
+            logger.info(f"Failover chain for {original_model}: {[f'{p}/{m}' for p, m in failover_chain]}")
+        
+        # Hedge slow starts against the next candidate in the chain, or the same provider
+        hedge_target = None
+        if hedging_enabled(route_model) and PROVIDER_ADAPTERS[provider].supports_streaming:
+            hedge_target = failover_chain[1] if len(failover_chain) > 1 else failover_chain[0]
+            hedge_budget.record_request()
+            record_hedge_event("eligible")
+        
+        logger.info(f"Sending request to {provider.upper()} API")
+        log_raw_data(f"{provider.upper()} REQUEST", request_data)
+        
+        # A newer request from the same conversation cancels this one
+        supersede_token = None
+        if SUPERSEDE_ENABLED:
+            key = conversation_key(data.get('messages'), original_model, client_identity())
+            if key:
+                supersede_token = conversation_tracker.start(key)
+        
+        # Closes the upstream responses if the client disconnects
+        canceller = StreamCanceller()
+        
+        def stream_with_failover(emitted_text=None, canceller=canceller):
+            """
+            Stream from the first candidate in the failover chain that answers
+            
+            Candidates that fail before producing any output are skipped. With
+            emitted_text set, each candidate is asked to continue that partial output.
+            """
+            # Set once any event has been sent; after that a failure can no longer be retried
+            sent_any = False
+            last_error = None
+            counted = False
+            for pass_index in range(MAX_RETRIES + 1):
+                if pass_index > 0:
+                    if isinstance(last_error, ConcurrencyLimitExceeded):
+                        # The candidate already waited its full queue timeout; another pass would only wait again
+                        break
+                    delay = failover_backoff(pass_index - 1)
+                    if delay >= deadline.remaining():
+                        logger.warning("Not enough time left before the deadline for another pass over the failover chain")
+                        break
+                    logger.info(f"All providers failed, retrying failover chain in {delay:.2f}s (pass {pass_index + 1})")
+                    # Wait without holding up cancellation: a client disconnect or a newer request in the conversation ends the wait
+                    if supersede_token:
+                        supersede_token.wakeups.append(canceller.wakeup)
+                    if not (supersede_token and supersede_token.cancelled.is_set()):
+                        canceller.wait(max(0, min(delay, deadline.remaining())))
+                    if supersede_token and supersede_token.cancelled.is_set():
+                        conversation_tracker.record("cancelled_before_upstream")
+                        raise RequestSuperseded("Superseded by a newer request in the same conversation")
+                    if canceller.cancelled:
+                        raise UpstreamError("Request cancelled")
                 
-                # For non-streaming providers, handle differently
-                if AI_PROVIDER not in ["groq", "grok", "anthropic", "ollama"]:
-                    # Non-streaming approach
-                    response = requests.post(
-                        full_url,
-                        json=request_data,
-                        headers=auth_headers,
-                        timeout=API_TIMEOUT
-                    )
-                    
-                    if response.status_code != 200:
-                        error_msg = response.text[:200] if hasattr(response, 'text') else "Unknown error"
-                        logger.error(f"API error: {response.status_code} - {error_msg}")
-                        error_response = {
-                            "id": f"chatcmpl-{uuid.uuid4()}",
-                            "object": "chat.completion",
-                            "created": int(time.time()),
-                            "model": original_model,
-                            "choices": [{
-                                "index": 0,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": f"**Error: {error_msg}**\n\nPlease try a different approach or ask the user for guidance."
-                                },
-                                "finish_reason": "stop"
-                            }],
-                            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                        }
-                        
-                        log_raw_data("ERROR RESPONSE", error_response)
-                        yield f"data: {json.dumps(error_response)}\n\n"
-                        yield "data: [DONE]\n\n"
-                        return
-                    
-                    # Parse the response
-                    provider_response = response.json()
-                    log_raw_data(f"{AI_PROVIDER.upper()} RESPONSE", provider_response)
+                candidates = list(failover_chain)
+                endpoint_retries = {}
+                for index, (candidate_provider, candidate_model) in enumerate(candidates):
+                    candidate_adapter = PROVIDER_ADAPTERS[candidate_provider]
+                    if emitted_text is None and (candidate_provider, candidate_model) == (provider, upstream_model):
+                        candidate_data = request_data
+                    else:
+                        candidate_data = prepare_request(candidate_provider, candidate_model, emitted_text)
+                        logger.info(f"Sending request to {candidate_provider}/{candidate_model}")
+                        log_raw_data(f"{candidate_provider.upper()} REQUEST", candidate_data)
+                    # Retrying after an upstream failure spends retry budget; skipping an open breaker or a full backend does not
+                    if last_error is None or isinstance(last_error, (CircuitOpenError, ConcurrencyLimitExceeded)):
+                        if not counted and emitted_text is None:
+                            retry_budget.record_request()
+                            counted = True
+                    elif not retry_budget.try_acquire():
+                        logger.warning("Retry budget exhausted, not trying further providers")
+                        raise last_error
+                    record_failover_event("attempts")
                     
-                    # Format the response to match OpenAI format
-                    openai_response = format_response_for_openai(provider_response, original_model)
+                    try:
+                        for event in timed_stream(stream_from_provider(candidate_adapter, candidate_data, original_model, deadline, canceller),
+                                                  candidate_provider, candidate_model):
+                            sent_any = True
+                            yield event
+                    except (UpstreamError, requests.exceptions.RequestException) as e:
+                        if sent_any or canceller.cancelled:
+                            raise
+                        last_error = e
+                        retryable = e.retryable if isinstance(e, UpstreamError) else True
+                        logger.warning(f"{candidate_provider}/{candidate_model} failed before the first token: {str(e)[:200]}")
+                        if not retryable:
+                            raise
+                        if (isinstance(e, UpstreamError) and e.status_code in (401, 429)
+                                and candidate_adapter.key_pool and candidate_adapter.key_pool.available_count()):
+                            # The key was ejected; try the same candidate again with another pooled key
+                            candidates.insert(index + 1, (candidate_provider, candidate_model))
+                            continue
+                        candidate = (candidate_provider, candidate_model)
+                        retries_left = len(candidate_adapter.endpoint_pool.endpoints) - 1 - endpoint_retries.get(candidate, 0)
+                        if (not isinstance(e, (CircuitOpenError, ConcurrencyLimitExceeded)) and retries_left > 0
+                                and (not isinstance(e, UpstreamError) or e.status_code is None or e.status_code >= 500)):
+                            # Another endpoint of the same provider may be healthy
+                            endpoint_retries[candidate] = endpoint_retries.get(candidate, 0) + 1
+                            candidates.insert(index + 1, candidate)
+                            continue
+                        record_failover_event("failovers")
+                        continue
                     
-                    # Return the response as a single event
-                    yield f"data: {json.dumps(openai_response)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    if last_error is not None:
+                        record_failover_event("recovered")
                     return
+            
+            # Every candidate failed with a retryable error
+            record_failover_event("exhausted")
+            raise last_error
+        
+        def generate():
+            # Text already sent to the client, kept so a dropped stream can be continued
+            emitted_parts = []
+            finished = False
+            continuations = 0
+            splicing = False
+            # Outcome reported to the auto router once the response ends
+            generate_started = time.time()
+            outcome_status = "ok"
+            # Stops the stream early if the model starts repeating itself
+            repetition = repetition_detector_for(data, original_model, upstream_model) if data else None
+            if hedge_target:
+                hedge_provider, hedge_model = hedge_target
+                stream = hedged_stream(
+                    lambda primary_canceller: stream_with_failover(canceller=primary_canceller),
+                    lambda hedge_canceller: timed_stream(
+                        stream_from_provider(PROVIDER_ADAPTERS[hedge_provider], prepare_request(hedge_provider, hedge_model), original_model, deadline, hedge_canceller),
+                        hedge_provider, hedge_model
+                    ),
+                    hedge_delay(provider, upstream_model),
+                    canceller
+                )
+            else:
+                stream = stream_with_failover()
+            try:
+                if supersede_token and supersede_token.cancelled.wait(SUPERSEDE_DEBOUNCE):
+                    conversation_tracker.record("cancelled_before_upstream")
+                    raise RequestSuperseded("Superseded by a newer request in the same conversation")
                 
-                # For streaming providers
-                with requests.post(
-                    full_url,
-                    json=request_data,
-                    headers=auth_headers,
-                    stream=True,
-                    timeout=API_TIMEOUT
-                ) as provider_response:
-                    
-                    # Check for error status
-                    if provider_response.status_code != 200:
-                        error_msg = provider_response.text[:200] if hasattr(provider_response, 'text') else "Unknown error"
-                        logger.error(f"API error: {provider_response.status_code} - {error_msg}")
-                        error_response = {
-                            "id": f"chatcmpl-{uuid.uuid4()}",
-                            "object": "chat.completion",
-                            "created": int(time.time()),
-                            "model": original_model,
-                            "choices": [{
-                                "index": 0,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": f"**Error: {error_msg}**\n\nPlease try a different approach or ask the user for guidance."
-                                },
-                                "finish_reason": "stop"
-                            }],
-                            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                        }
-                        
-                        log_raw_data("ERROR RESPONSE", error_response)
-                        yield f"data: {json.dumps(error_response)}\n\n"
-                        yield "data: [DONE]\n\n"
+                while True:
+                    try:
+                        for event in stream:
+                            if supersede_token and supersede_token.cancelled.is_set():
+                                conversation_tracker.record("cancelled_streams")
+                                raise RequestSuperseded("Superseded by a newer request in the same conversation")
+                            delta = parse_stream_delta(event.strip())
+                            if delta:
+                                emitted_parts.append(delta[0])
+                                finished = finished or bool(delta[1])
+                                if splicing:
+                                    splicing = False
+                                    record_continuation_event("spliced")
+                                    record_continuation_event("tokens_saved", len("".join(emitted_parts)) // 4)
+                            yield event
+                            if repetition and delta and delta[0] and repetition.feed(delta[0]):
+                                # Closing the stream drops the upstream request and frees its slots
+                                stream.close()
+                                yield from repetition_abort_events(repetition, original_model)
+                                return
                         return
+                    except requests.exceptions.RequestException as e:
+                        if splicing:
+                            # The previous continuation failed before producing any output
+                            splicing = False
+                            record_continuation_event("failed")
+                        if finished:
+                            # The answer was complete; only the end of the stream was lost
+                            logger.info(f"Stream dropped after its finish_reason ({str(e)[:100]}), ending normally")
+                            yield "data: [DONE]\n\n"
+                            return
+                        emitted_text = "".join(emitted_parts)
+                        if (not STREAM_CONTINUATION_ENABLED or not emitted_text or canceller.cancelled
+                                or continuations >= STREAM_CONTINUATION_MAX_ATTEMPTS):
+                            raise
+                        continuations += 1
+                        splicing = True
+                        record_continuation_event("attempts")
+                        logger.warning(f"Stream dropped after {len(emitted_text)} characters ({str(e)[:100]}), continuing from partial output")
+                        stream = stream_with_failover(emitted_text)
+                    except UpstreamError:
+                        if not splicing:
+                            raise
+                        # No candidate could continue the partial response
+                        record_continuation_event("failed")
+                        raise requests.exceptions.ConnectionError("Stream dropped and could not be continued")
 
-                    # Process the streaming response
-                    for line in provider_response.iter_lines():
-                        if line:
-                            line = line.decode('utf-8')
-                            last_chunk_time = time.time()
-                            
-                            # Collect the chunk for logging
-                            collected_chunks.append(line)
-                            
-                            # Check if we're entering or exiting a code block
-                            if line.startswith('data: ') and '"content":"```' in line:
-                                in_code_block = True
-                                code_block_count += 1
-                                logger.info(f"Entering code block #{code_block_count}")
-                            elif line.startswith('data: ') and '"content":"```' in line and in_code_block:
-                                in_code_block = False
-                                logger.info(f"Exiting code block #{code_block_count}")
-                            
-                            if line.startswith('data: '):
-                                # Pass through the streaming data
-                                # For Anthropic, we'd need to transform their SSE format to OpenAI format
-                                if AI_PROVIDER == "anthropic":
-                                    try:
-                                        # Handle Anthropic's SSE format
-                                        if line.startswith('data: ') and line[6:].strip():
-                                            anthropic_data = json.loads(line[6:])
-                                            
-                                            # Check for completion event
-                                            if anthropic_data.get('type') == 'content_block_delta':
-                                                delta_text = anthropic_data.get('delta', {}).get('text', '')
-                                                
-                                                # Create OpenAI-style chunk
-                                                openai_chunk = {
-                                                    "id": f"chatcmpl-{uuid.uuid4()}",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": int(time.time()),
-                                                    "model": original_model,
-                                                    "choices": [{
-                                                        "index": 0,
-                                                        "delta": {"content": delta_text},
-                                                        "finish_reason": None
-                                                    }]
-                                                }
-                                                
-                                                yield f"data: {json.dumps(openai_chunk)}\n\n"
-                                    except json.JSONDecodeError:
-                                        # If it's not JSON, just pass it through
-                                        yield f"{line}\n\n"
-                                elif AI_PROVIDER == "ollama":
-                                    try:
-                                        # Handle Ollama's SSE format
-                                        if line.startswith('data: ') and line[6:].strip():
-                                            ollama_data = json.loads(line[6:])
-                                            
-                                            if 'message' in ollama_data and 'content' in ollama_data['message']:
-                                                content = ollama_data['message']['content']
-                                                
-                                                # Create OpenAI-style chunk
-                                                openai_chunk = {
-                                                    "id": f"chatcmpl-{uuid.uuid4()}",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": int(time.time()),
-                                                    "model": original_model,
-                                                    "choices": [{
-                                                        "index": 0,
-                                                        "delta": {"content": content},
-                                                        "finish_reason": None
-                                                    }]
-                                                }
-                                                
-                                                yield f"data: {json.dumps(openai_chunk)}\n\n"
-                                    except json.JSONDecodeError:
-                                        # If it's not JSON, just pass it through
-                                        yield f"{line}\n\n"
-                                else:
-                                    # For Groq, Grok, and custom, pass through directly
-                                    yield f"{line}\n\n"
-                            elif line.strip() == 'data: [DONE]':
-                                yield "data: [DONE]\n\n"
-                                return  # Ensure we exit the generator after [DONE]
-                    
-                    # Log all collected chunks at once
-                    if collected_chunks:
-                        log_raw_data("STREAMING RESPONSE (COMPLETE)", 
-                                    collect_streaming_chunks(collected_chunks))
-                    
-                    # If we were in a code block, make sure we send a proper closing
-                    if in_code_block:
-                        logger.info("Detected unclosed code block, sending closing marker")
-                        # Send a dummy chunk to keep the connection alive
-                        dummy_chunk = {
-                            "id": f"chatcmpl-{uuid.uuid4()}",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": original_model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": ""},
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(dummy_chunk)}\n\n"
-                    
-                    # Always send a final [DONE] marker
-                    yield "data: [DONE]\n\n"
-                    
-                    # Wait a moment before closing to ensure all data is processed
-                    time.sleep(0.5)
-
+            except RequestSuperseded as e:
+                outcome_status = "superseded"
+                # Closing the stream drops the upstream request and frees its slots
+                stream.close()
+                error_response = {
+                    "error": {
+                        "message": str(e),
+                        "type": "server_error",
+                        "param": None,
+                        "code": e.code
+                    }
+                }
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
+            except DeadlineExceeded as e:
+                outcome_status = "error"
+                logger.warning(f"{str(e)}, abandoning upstream work")
+                error_response = {
+                    "error": {
+                        "message": str(e),
+                        "type": "timeout_error",
+                        "param": None,
+                        "code": e.code
+                    }
+                }
+                log_raw_data("DEADLINE ERROR", error_response)
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
+            except ConcurrencyLimitExceeded as e:
+                outcome_status = "error"
+                logger.warning(str(e))
+                error_response = {
+                    "error": {
+                        "message": f"The model is overloaded: {str(e)}. Please retry shortly.",
+                        "type": "server_error",
+                        "param": None,
+                        "code": e.code
+                    }
+                }
+                log_raw_data("CONCURRENCY LIMIT ERROR", error_response)
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
+            except UpstreamError as e:
+                outcome_status = "error"
+                error_response = {
+                    "id": f"chatcmpl-{uuid.uuid4()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": original_model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": f"**Error: {str(e)}**\n\nPlease try a different approach or ask the user for guidance."
+                        },
+                        "finish_reason": "stop"
+                    }],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+                }
+                
+                log_raw_data("ERROR RESPONSE", error_response)
+                yield f"data: {json.dumps(error_response)}\n\n"
+                yield "data: [DONE]\n\n"
             except requests.exceptions.Timeout:
+                outcome_status = "error"
                 logger.error("API timeout")
                 error_response = {
                     "error": {
@@ -992,6 +4051,7 @@ def process_chat_request():
                 yield "data: [DONE]\n\n"
             except Exception as e:
                 logger.error(f"Error during streaming: {str(e)}")
+                outcome_status = "error"
                 error_response = {
                     "error": {
                         "message": str(e),
@@ -1003,19 +4063,25 @@ def process_chat_request():
                 yield f"data: {json.dumps(error_response)}\n\n"
                 yield "data: [DONE]\n\n"
             finally:
-                # Clear the cache after processing the request
-                if cache_key in request_cache:
-                    del request_cache[cache_key]
-                    logger.info("Cache cleared for request")
+                if auto_decision:
+                    record_auto_outcome(auto_decision, outcome_status, generate_started, len("".join(emitted_parts)))
                 
                 # Remove this request from the streaming tracker
                 if request_hash in streaming_tracker:
                     del streaming_tracker[request_hash]
                     logger.info(f"Removed request from streaming tracker (hash: {request_hash})")
 
+        # Clients that asked for stream: false get the upstream stream assembled into one completion
+        if data.get('stream') is False:
+            try:
+                return aggregated_response(aggregate_completion(generate(), original_model, estimate_prompt_tokens(data)))
+            finally:
+                if supersede_token:
+                    conversation_tracker.finish(supersede_token)
+        
         # Return a streaming response with proper headers
         response = app.response_class(
-            generate(),
+            stream_with_heartbeats(generate(), original_model, received_at, canceller, g.get('admission_ticket')),
             mimetype='text/event-stream',
             headers={
                 'Cache-Control': 'no-cache',
@@ -1024,10 +4090,16 @@ def process_chat_request():
                 'x-request-id': request_id
             }
         )
+        if supersede_token:
+            response.call_on_close(lambda: conversation_tracker.finish(supersede_token))
         
         logger.info(f"Started streaming response (request ID: {request_id})")
         return response
             
+    except ContextLengthExceeded as e:
+        logger.warning(str(e))
+        streaming_tracker.pop(request_hash, None)
+        return context_length_error(e)
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         logger.error(traceback.format_exc())
@@ -1054,6 +4126,7 @@ def process_chat_request():
 
 # Route for standard OpenAI endpoint
 @app.route(OPENAI_CHAT_ENDPOINT, methods=['POST', 'OPTIONS'])
+@admitted("chat")
 def openai_chat_completions():
     """Handle requests to the standard OpenAI chat completions endpoint"""
     logger.info(f"Request to standard OpenAI endpoint")
@@ -1061,6 +4134,7 @@ def openai_chat_completions():
 
 # Route for Cursor's custom endpoint
 @app.route(CURSOR_CHAT_ENDPOINT, methods=['POST', 'OPTIONS'])
+@admitted("chat")
 def cursor_chat_completions():
     """Handle requests to Cursor's custom chat completions endpoint"""
     logger.info(f"Request to Cursor endpoint")
@@ -1068,6 +4142,7 @@ def cursor_chat_completions():
 
 # Catch-all route for any other chat completions endpoint
 @app.route('/<path:path>/chat/completions', methods=['POST', 'OPTIONS'])
+@admitted("chat")
 def any_chat_completions(path):
     """Handle requests to any other chat completions endpoint"""
     logger.info(f"Request to custom path: /{path}/chat/completions")
@@ -1079,14 +4154,22 @@ def list_models():
     """Return a list of available models that match the OpenAI models format"""
     logger.info("Request to models endpoint")
     
-    # Create a list of model objects based on the model mappings
+    # Create a list of model objects based on the routing table
     models = []
-    for openai_model in MODEL_MAPPINGS[AI_PROVIDER].keys():
+    for model_name, (provider, _) in ROUTING_TABLE.items():
         models.append({
-            "id": openai_model,
+            "id": model_name,
             "object": "model",
             "created": 1700000000,
-            "owned_by": "openai"
+            "owned_by": provider
+        })
+    
+    if AUTO_ROUTER_ENABLED:
+        models.append({
+            "id": AUTO_MODEL_NAME,
+            "object": "model",
+            "created": 1700000000,
+            "owned_by": "auto"
         })
     
     # Create response with OpenAI-specific headers
@@ -1110,16 +4193,27 @@ def list_models():
 def health_check():
     """Return health status of the proxy server"""
     logger.info("Health check request")
+    breaker_health = get_breaker_health()
+    any_open = any(breaker["state"] != "closed" for breaker in breaker_health["breakers"].values())
     return jsonify({
-        "status": "healthy",
+        "status": "degraded" if any_open else "healthy",
         "timestamp": time.time(),
         "uptime": time.time() - start_time,
         "provider": AI_PROVIDER,
-        "api_key_set": bool(get_provider_api_key())
+        "api_key_set": bool(get_provider_api_key()),
+        "providers_configured": {name: adapter.configured for name, adapter in PROVIDER_ADAPTERS.items()},
+        "circuit_breakers": breaker_health,
+        "latency": {
+            "routing_enabled": LATENCY_ROUTING_ENABLED,
+            "probe_interval": LATENCY_PROBE_INTERVAL,
+            "backends": latency_table.snapshot()
+        },
+        "cache_memory": get_cache_stats()
     })
 
 # Add a simple direct endpoint for non-streaming single-message exchange
 @app.route('/direct', methods=['POST', 'OPTIONS'])
+@admitted("direct")
 def direct_completion():
     """Simple endpoint that takes a single message and returns a response"""
     logger.info("Request to direct endpoint")
@@ -1143,49 +4237,33 @@ def direct_completion():
                 logger.error("Failed to parse direct request data")
                 return jsonify({"error": "Invalid request format"}), 400
         
-        # Create a simple request to the provider
-        provider_model = MODEL_MAPPINGS[AI_PROVIDER].get(model, MODEL_MAPPINGS[AI_PROVIDER]["default"])
-        provider_request = {
+        # Create a simple request to the provider the model routes to
+        provider, provider_model = resolve_model_route(model)
+        adapter = PROVIDER_ADAPTERS[provider]
+        provider_request = adapter.format_request({
             "model": provider_model,
             "messages": [
                 {"role": "user", "content": message}
             ],
-            "stream": False  # No streaming for direct endpoint
-        }
-        
-        # Forward the request to the provider
-        base_url, endpoint = get_provider_url_and_endpoint()
-        auth_headers = get_provider_auth_headers()
+            # Streamed where the provider supports it and aggregated into one response
+            "stream": adapter.supports_streaming
+        }, provider_model)
         
-        full_url = f"{base_url}{endpoint}"
-        if AI_PROVIDER == "google":
-            full_url += f"?key={GOOGLE_API_KEY}"
-        
-        logger.info(f"Sending direct request to {AI_PROVIDER}")
+        logger.info(f"Sending direct request to {provider}")
         log_raw_data("DIRECT REQUEST", provider_request)
         
-        response = requests.post(
-            full_url,
-            json=provider_request,
-            headers=auth_headers,
-            timeout=API_TIMEOUT
-        )
-        
-        if response.status_code != 200:
-            logger.error(f"API error: {response.status_code} - {response.text[:200]}")
-            log_raw_data("DIRECT ERROR RESPONSE", response.text)
-            return jsonify({
-                "error": f"API error: {response.status_code}",
-                "message": "Failed to get response from provider"
-            }), response.status_code
-        
-        # Parse the response
-        log_raw_data("DIRECT RAW RESPONSE", response.text)
-        provider_response = response.json()
-        log_raw_data("DIRECT PARSED RESPONSE", provider_response)
-        
-        # Format the provider response to OpenAI format
-        formatted_response = format_response_for_openai(provider_response, model)
+        stream = stream_from_provider(adapter, provider_request, model, request_deadline("direct"))
+        try:
+            # Stop at [DONE] instead of waiting for the stream to wind down
+            formatted_response = aggregate_completion(
+                itertools.takewhile(lambda event: event.strip() != "data: [DONE]", stream),
+                model, estimate_prompt_tokens(provider_request)
+            )
+        finally:
+            stream.close()
+        if "error" in formatted_response:
+            return aggregated_response(formatted_response)
+        log_raw_data("DIRECT PARSED RESPONSE", formatted_response)
         
         # Extract just the content from the response
         if "choices" in formatted_response and len(formatted_response["choices"]) > 0:
@@ -1196,6 +4274,16 @@ def direct_completion():
         else:
             return jsonify({"error": "No response content found"}), 500
             
+    except DeadlineExceeded as e:
+        logger.warning(str(e))
+        return jsonify({"error": str(e)}), 504
+    except UpstreamError as e:
+        logger.error(f"API error: {e.status_code} - {str(e)[:200]}")
+        log_raw_data("DIRECT ERROR RESPONSE", str(e))
+        return jsonify({
+            "error": f"API error: {e.status_code or 502}",
+            "message": "Failed to get response from provider"
+        }), e.status_code or 502
     except Exception as e:
         logger.error(f"Error processing direct request: {str(e)}")
         logger.error(traceback.format_exc())
@@ -1203,6 +4291,7 @@ def direct_completion():
 
 # Add an agent mode endpoint that includes specific instructions
 @app.route('/agent', methods=['POST', 'OPTIONS'])
+@admitted("agent")
 def agent_mode():
     """Handle requests with agent mode instructions included"""
     logger.info("Request to agent mode endpoint")
@@ -1238,7 +4327,8 @@ def agent_mode():
                     "content": AGENT_INSTRUCTIONS
                 })
         
-        # Continue with the standard request processing
+        # Continue with the standard request processing, under the agent route's deadline
+        request_deadline("agent")
         return process_chat_request()
             
     except Exception as e:
@@ -1276,7 +4366,7 @@ def home():
     <body>
         <h1>Multi-Provider AI Proxy Server</h1>
         <p>This server proxies requests to various AI providers while maintaining OpenAI API compatibility.</p>
-        <p>Currently using provider: <span class="provider">""" + AI_PROVIDER + """</span></p>
+        <p>Default provider: <span class="provider">""" + AI_PROVIDER + """</span> (use "provider/model" names or MODEL_ROUTES to reach other providers)</p>
         
         <h2>Available Endpoints</h2>
         <div class="endpoint">
@@ -1404,6 +4494,9 @@ if __name__ == "__main__":
     if use_ngrok:
         public_url = start_ngrok(port)
     
+    # Start measuring backend latency in the background
+    start_latency_prober()
+    
     # Start the Flask server
     print(f"Starting Multi-Provider AI Proxy server on port {port}")
     print(f"Using AI provider: {AI_PROVIDER}")
@@ -1412,7 +4505,7 @@ if __name__ == "__main__":
     
     try:
         # Use Waitress WSGI server for production-ready serving
-        serve(app, host="0.0.0.0", port=port)
+        serve(app, host="0.0.0.0", port=port, threads=WAITRESS_THREADS)
     except Exception as e:
         logger.critical(f"Server failed to start: {str(e)}")
         print(f"Server failed to start: {str(e)}")
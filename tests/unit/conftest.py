@@ -0,0 +1,17 @@
+"""
+Shared setup for the unit tests
+
+The proxies read their configuration at import time, so the environment is
+set here before either module is imported.
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+os.environ.setdefault("AI_PROVIDER", "groq")
+os.environ["LOG_RAW_DATA"] = "0"
+# Keep test runs from writing proxy.log into the working tree
+os.environ["LOG_FILE"] = os.path.join(tempfile.mkdtemp(prefix="proxy-tests-"), "proxy.log")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
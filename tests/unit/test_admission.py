@@ -0,0 +1,84 @@
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+CLASSES = {
+    "interactive": {"weight": 6, "reserved": 1, "max_queue": 4},
+    "bulk": {"weight": 1, "reserved": 0, "max_queue": 4}
+}
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def test_admission_is_off_by_default(proxy):
+    assert proxy.ADMISSION_ENABLED is False
+
+
+def test_slot_is_kept_until_every_holder_releases(proxy):
+    scheduler = proxy.AdmissionScheduler(1, CLASSES, client_limit=0)
+    ticket = scheduler.acquire("interactive", "a")
+    # A stream worker still reading upstream holds the slot after the response closes
+    scheduler.hold(ticket)
+    scheduler.release(ticket)
+    with pytest.raises(proxy.AdmissionRejected):
+        scheduler.acquire("interactive", "b", timeout=0)
+    scheduler.release(ticket)
+    scheduler.release(ticket)
+    assert scheduler.snapshot()["classes"]["interactive"]["running"] == 0
+    scheduler.release(scheduler.acquire("interactive", "b", timeout=0))
+
+
+def test_clients_are_not_capped_by_default(proxy):
+    assert proxy.CLIENT_IDENTITY == "ip"
+    scheduler = proxy.AdmissionScheduler(4, CLASSES)
+    tickets = [scheduler.acquire("interactive", "shared", timeout=0) for _ in range(4)]
+    assert scheduler.snapshot()["clients"]["shared"]["in_flight"] == 4
+    for ticket in tickets:
+        scheduler.release(ticket)
+
+
+def test_client_cap_when_configured(proxy):
+    scheduler = proxy.AdmissionScheduler(4, CLASSES, client_limit=1)
+    first = scheduler.acquire("interactive", "a")
+    with pytest.raises(proxy.AdmissionRejected):
+        scheduler.acquire("interactive", "a", timeout=0)
+    scheduler.release(scheduler.acquire("interactive", "b", timeout=0))
+    scheduler.release(first)
+
+
+def test_reserved_slot_keeps_interactive_requests_moving(proxy):
+    scheduler = proxy.AdmissionScheduler(2, CLASSES, client_limit=0)
+    bulk = scheduler.acquire("bulk", "a", timeout=0)
+    with pytest.raises(proxy.AdmissionRejected):
+        scheduler.acquire("bulk", "b", timeout=0)
+    interactive = scheduler.acquire("interactive", "c", timeout=0)
+    scheduler.release(interactive)
+    scheduler.release(bulk)
+
+
+@pytest.mark.parametrize("path", ["/v1/chat/completions", "/agent", "/direct"])
+def test_multi_routes_are_admitted(path, monkeypatch):
+    scheduler = multi_ai_proxy.AdmissionScheduler(1, CLASSES, client_limit=0)
+    monkeypatch.setattr(multi_ai_proxy, "admission_scheduler", scheduler)
+    monkeypatch.setattr(multi_ai_proxy, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(multi_ai_proxy, "PRIORITY_CLASSES", CLASSES)
+    monkeypatch.setattr(multi_ai_proxy, "PRIORITY_ROUTE_CLASSES", {"chat": "interactive", "agent": "interactive", "direct": "interactive"})
+    held = scheduler.acquire("interactive", "other")
+    monkeypatch.setattr(multi_ai_proxy, "ADMISSION_MAX_WAIT", 0)
+    response = multi_ai_proxy.app.test_client().post(path, json={"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 503
+    assert response.get_json()["error"]["code"] == "queue_timeout"
+    scheduler.release(held)
+
+
+def test_clients_share_an_identity_per_ip_unless_keyed(proxy, monkeypatch):
+    headers = {"Authorization": "Bearer user-key", "X-Forwarded-For": "10.0.0.7, 10.0.0.1"}
+    with proxy.app.test_request_context("/", headers=headers):
+        assert proxy.client_identity() == "10.0.0.7"
+        monkeypatch.setattr(proxy, "CLIENT_IDENTITY", "auto")
+        assert proxy.client_identity().startswith("key-")
+        assert "user-key" not in proxy.client_identity()
@@ -0,0 +1,81 @@
+import json
+
+import groq_proxy
+
+PATTERNS = groq_proxy.AGENT_RECURSIVE_RESPONSE_INDICATORS
+
+
+def test_scan_finds_a_pattern_inside_one_chunk():
+    _, found = groq_proxy.scan_stream_text("", "Oops. Let's try the edit again now.", PATTERNS)
+    assert found == ["Let's try the edit again"]
+
+
+def test_scan_finds_a_pattern_split_across_chunks():
+    tail = ""
+    found = []
+    for chunk in ["Oops. I'll tr", "y again ", "with the", " edit."]:
+        tail, found = groq_proxy.scan_stream_text(tail, chunk, PATTERNS)
+        if found:
+            break
+    assert found == ["I'll try again with the edit"]
+    assert chunk == " edit."
+
+
+def test_scan_keeps_only_a_short_tail():
+    tail, found = groq_proxy.scan_stream_text("", "x" * 10000, PATTERNS)
+    assert not found
+    assert len(tail) == max(len(pattern) for pattern in PATTERNS) - 1
+
+
+class FakeStream:
+    def __init__(self, lines):
+        self.status_code = 200
+        self.lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def iter_lines(self):
+        for line in self.lines:
+            yield line.encode("utf-8")
+
+
+def chunk_line(content, finish_reason=None):
+    return "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}]})
+
+
+def stream_contents(monkeypatch, lines):
+    monkeypatch.setattr(groq_proxy, "HEARTBEAT_ENABLED", False)
+    monkeypatch.setattr(groq_proxy, "COALESCE_ENABLED", False)
+    monkeypatch.setattr(groq_proxy, "post_to_groq", lambda *args, **kwargs: FakeStream(lines))
+    with groq_proxy.app.test_request_context():
+        response = groq_proxy.stream_agent_response({"model": "m", "messages": []}, {}, "m", None)
+        body = "".join(response.response)
+    chunks = [json.loads(event[6:]) for event in body.split("\n\n") if event.startswith("data: {")]
+    return [(chunk["choices"][0]["delta"].get("content"), chunk["choices"][0]["finish_reason"]) for chunk in chunks]
+
+
+def test_warning_follows_content_sent_with_the_finish_reason(monkeypatch):
+    events = stream_contents(monkeypatch, [chunk_line("Let me try again "), chunk_line("with the same edit.", "stop"), "data: [DONE]"])
+    assert events == [
+        ("Let me try again ", None),
+        ("with the same edit.", None),
+        (groq_proxy.AGENT_RECURSION_WARNING, None),
+        (None, "stop")
+    ]
+
+
+def test_warning_goes_before_a_separate_finish_chunk(monkeypatch):
+    events = stream_contents(monkeypatch, [chunk_line("Let's try the edit again"), chunk_line("", "stop"), "data: [DONE]"])
+    assert events[-2:] == [(groq_proxy.AGENT_RECURSION_WARNING, None), ("", "stop")]
+
+
+def test_no_warning_without_a_pattern(monkeypatch):
+    events = stream_contents(monkeypatch, [chunk_line("All done.", "stop"), "data: [DONE]"])
+    assert events == [("All done.", "stop")]
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def event(chunk):
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+def chunk(delta, finish_reason=None, **extra):
+    return event({"id": "chatcmpl-1", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra})
+
+
+def test_content_is_joined(proxy):
+    events = [chunk({"role": "assistant", "content": ""}), chunk({"content": "Hel"}), chunk({"content": "lo"}, "stop"), "data: [DONE]\n\n"]
+    completion = proxy.aggregate_completion(events, "m", prompt_tokens=7)
+    assert completion["id"] == "chatcmpl-1"
+    assert completion["model"] == "m"
+    assert completion["choices"][0]["message"] == {"role": "assistant", "content": "Hello"}
+    assert completion["choices"][0]["finish_reason"] == "stop"
+    assert completion["usage"]["prompt_tokens"] == 7
+
+
+def test_tool_call_fragments_are_merged(proxy):
+    events = [
+        chunk({"tool_calls": [{"index": 0, "id": "call_1", "function": {"name": "read_", "arguments": '{"pa'}}]}),
+        chunk({"tool_calls": [{"index": 0, "function": {"name": "file", "arguments": 'th": "a"}'}}]}),
+        chunk({"tool_calls": [{"index": 1, "id": "call_2", "function": {"name": "ls", "arguments": "{}"}}]})
+    ]
+    message = proxy.aggregate_completion(events, "m")["choices"][0]["message"]
+    assert message["content"] is None
+    assert [call["function"] for call in message["tool_calls"]] == [
+        {"name": "read_file", "arguments": '{"path": "a"}'},
+        {"name": "ls", "arguments": "{}"}
+    ]
+    assert message["tool_calls"][0]["id"] == "call_1"
+
+
+def test_stream_usage_is_preferred(proxy):
+    usage = {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+    events = [chunk({"content": "Hi"}), chunk({}, "stop", x_groq={"usage": usage})]
+    assert proxy.aggregate_completion(events, "m")["usage"] == usage
+
+
+def test_error_event_is_returned(proxy):
+    events = [chunk({"content": "Hi"}), event({"error": {"message": "boom", "type": "server_error"}}), chunk({"content": "more"})]
+    assert proxy.aggregate_completion(events, "m") == {"error": {"message": "boom", "type": "server_error"}}
+
+
+def test_whole_completion_is_passed_through(proxy):
+    whole = {"id": "x", "object": "chat.completion", "model": "upstream", "choices": []}
+    assert proxy.aggregate_completion([event(whole)], "m") == dict(whole, model="m")
+
+
+def test_stream_is_read_to_the_end(proxy):
+    read = []
+
+    def events():
+        for item in [event({"error": {"message": "boom"}}), chunk({"content": "late"})]:
+            read.append(item)
+            yield item
+
+    proxy.aggregate_completion(events(), "m")
+    assert len(read) == 2
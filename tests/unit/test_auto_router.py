@@ -0,0 +1,48 @@
+import pytest
+
+import multi_ai_proxy
+
+
+def classify(text, **extra):
+    return multi_ai_proxy.classify_request({"messages": [{"role": "user", "content": text}], **extra})
+
+
+@pytest.mark.parametrize("text", [
+    "How do I add a key to a dict?",
+    "What's the difference between a list and a tuple?",
+    "Can I remove an item from a set while iterating?",
+    "Thanks, let me know if that makes sense",
+    "Why does this return None?",
+])
+def test_quick_questions_go_to_the_fast_model(text):
+    tier, _, signals = classify(text)
+    assert tier == "fast"
+    assert "edit" not in signals
+    assert "code" not in signals
+
+
+@pytest.mark.parametrize("text", [
+    "Refactor this:\n```python\ndef f(x):\n    return x\n```",
+    "Please fix the bug in\nfunction load() {\n  return cache;\n}",
+    "Can you add type hints?\n```\ndef f(x): pass\n```",
+])
+def test_code_edits_go_to_the_strong_model(text):
+    tier, _, signals = classify(text)
+    assert tier == "strong"
+    assert {"edit", "code"} <= set(signals)
+
+
+@pytest.mark.parametrize("text", ["Fix the login bug", "Thanks. Now rename the helper.", "could you please optimise it"])
+def test_edit_verbs_in_imperative_position(text):
+    assert "edit" in classify(text)[2]
+
+
+def test_an_edit_alone_stays_fast():
+    tier, score, _ = classify("Rename the variable")
+    assert tier == "fast"
+    assert score < multi_ai_proxy.AUTO_ROUTER_THRESHOLD
+
+
+def test_tools_and_long_prompts_go_to_the_strong_model():
+    assert classify("hi", tools=[{"type": "function"}])[0] == "strong"
+    assert classify("x " * multi_ai_proxy.AUTO_ROUTER_LONG_PROMPT_TOKENS * 4)[0] == "strong"
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+from cachetools import Cache
+
+import groq_proxy
+import multi_ai_proxy
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def test_values_round_trip(proxy):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60)
+    values = {"text": "hello", "bytes": b"\x00\x01", "json": {"a": [1, 2]}, "int": 3, "none": None, "large": "x" * 5000}
+    for key, value in values.items():
+        cache[key] = value
+    assert {key: cache[key] for key in values} == values
+
+
+def test_large_values_are_compressed(proxy):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60)
+    cache["small"] = "x" * (proxy.CACHE_COMPRESS_THRESHOLD - 1)
+    cache["large"] = "x" * proxy.CACHE_COMPRESS_THRESHOLD * 4
+    entries = {key: Cache.__getitem__(cache, key) for key in ("small", "large")}
+    assert entries["small"].encoding == "raw"
+    assert entries["large"].encoding == "zlib-str"
+    assert entries["large"].size < entries["large"].raw_size
+
+
+def test_long_keys_are_hashed(proxy):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60)
+    long_key = "k" * (proxy.CACHE_KEY_HASH_THRESHOLD + 1)
+    cache[long_key] = "value"
+    assert cache[long_key] == "value"
+    assert [key.startswith("sha256:") for key in Cache.__iter__(cache)] == [True]
+
+
+def test_usage_stays_within_the_byte_limit(proxy):
+    cache = proxy.ByteBudgetCache("c", max_bytes=4 * 1024, ttl=60)
+    for index in range(50):
+        cache[f"key-{index}"] = f"{index}-" + "abcdefgh" * 40
+    assert cache.used_bytes() <= 4 * 1024
+    assert cache.evictions > 0
+    assert "key-49" in cache
+    assert "key-0" not in cache
+
+
+def test_entries_larger_than_the_cache_are_rejected(proxy):
+    cache = proxy.ByteBudgetCache("c", max_bytes=1024, ttl=60)
+    cache["kept"] = "small"
+    cache["huge"] = os.urandom(4096)
+    assert cache.rejected == 1
+    assert "huge" not in cache
+    assert cache["kept"] == "small"
+
+
+def test_shared_budget_evicts_from_the_largest_cache(proxy):
+    budget = proxy.CacheMemoryBudget(6 * 1024)
+    large = proxy.ByteBudgetCache("large", max_bytes=64 * 1024, ttl=60, budget=budget)
+    small = proxy.ByteBudgetCache("small", max_bytes=64 * 1024, ttl=60, budget=budget)
+    small["only"] = "y" * 200
+    for index in range(20):
+        large[f"key-{index}"] = f"{index}-" + "abcdefgh" * 40
+    assert budget.used_bytes() <= 6 * 1024
+    assert large.evictions > 0
+    assert small["only"] == "y" * 200
@@ -0,0 +1,91 @@
+import pytest
+
+import groq_proxy
+
+
+@pytest.mark.parametrize("line", [
+    "Current date: 2024-03-01",
+    "The current date is Mon Mar 04 2024.",
+    "Today is Monday, March 4, 2024",
+    "- Today's date: 03/04/2024",
+    "Current time: 10:20 PM UTC",
+    "2024-03-01T10:20:33Z",
+])
+def test_date_and_time_stamps_are_volatile(line):
+    assert groq_proxy.is_volatile_line(line)
+
+
+@pytest.mark.parametrize("line", [
+    "Always use the current date when writing changelog entries",
+    "Released on 2024-03-01",
+    "Slice it as x[10:20]",
+    "You have 3 tools available at 10:00",
+    "Today is a good day to refactor",
+    "2024",
+])
+def test_lines_with_other_content_are_kept(line):
+    assert not groq_proxy.is_volatile_line(line)
+
+
+def test_canonical_form_ignores_transport_fields_and_date_lines():
+    first = {
+        "model": "m", "stream": True, "user": "a", "temperature": 1,
+        "messages": [
+            {"role": "system", "content": "Be brief.\nCurrent date: 2024-03-01"},
+            {"role": "user", "content": "What happened on 2024-03-01?  "}
+        ]
+    }
+    second = {
+        "model": "m", "stream": False,
+        "messages": [
+            {"role": "system", "content": "Be brief.\nCurrent date: 2024-03-02"},
+            {"role": "user", "content": "What happened on 2024-03-01?"}
+        ]
+    }
+    canonical, fired = groq_proxy.canonicalize_request(first)
+    assert canonical == groq_proxy.canonicalize_request(second)[0]
+    # User text keeps its date
+    assert canonical["messages"][1]["content"] == "What happened on 2024-03-01?"
+    assert {"drop:stream", "drop:user", "default:temperature", "volatile_datetime_lines", "trailing_whitespace"} <= set(fired)
+
+
+def test_canonicalizing_does_not_count_by_itself():
+    before = groq_proxy.canonicalization_counts["requests"]
+    groq_proxy.canonicalize_request({"model": "m", "messages": []})
+    assert groq_proxy.canonicalization_counts["requests"] == before
+    groq_proxy.record_canonicalization([])
+    assert groq_proxy.canonicalization_counts["requests"] == before + 1
+
+
+class FakeStream:
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_lines(self):
+        for line in [
+            'data: {"id": "c", "choices": [{"index": 0, "delta": {"role": "assistant", "content": "Hello"}, "finish_reason": null}]}',
+            'data: {"id": "c", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}',
+            "data: [DONE]"
+        ]:
+            yield line.encode("utf-8")
+
+
+def test_requests_that_differ_only_in_transport_fields_share_a_cached_answer(monkeypatch):
+    calls = []
+    monkeypatch.setattr(groq_proxy, "post_to_groq", lambda *args, **kwargs: calls.append(args) or FakeStream())
+    monkeypatch.setattr(groq_proxy, "semantic_cache", None)
+    monkeypatch.setattr(groq_proxy, "SUPERSEDE_ENABLED", False)
+    monkeypatch.setattr(groq_proxy, "HEARTBEAT_ENABLED", False)
+    monkeypatch.setattr(groq_proxy, "COALESCE_ENABLED", False)
+    client = groq_proxy.app.test_client()
+    messages = [{"role": "user", "content": "Say hello to the request cache"}]
+    first = client.post("/v1/chat/completions", json={"model": "llama3-8b-8192", "messages": messages, "stream": True, "user": "a"})
+    assert "Hello" in first.get_data(as_text=True)
+    second = client.post("/v1/chat/completions", json={"model": "llama3-8b-8192", "messages": messages, "stream": False})
+    assert second.get_json()["choices"][0]["message"]["content"] == "Hello"
+    assert len(calls) == 1
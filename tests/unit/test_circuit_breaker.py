@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def open_breaker(proxy):
+    breaker = proxy.CircuitBreaker("test/m")
+    for _ in range(proxy.CIRCUIT_BREAKER_MIN_CALLS):
+        breaker.record_result(time.time(), 503)
+    return breaker
+
+
+def test_breaker_stays_closed_below_the_minimum_calls(proxy):
+    breaker = proxy.CircuitBreaker("test/m")
+    for _ in range(proxy.CIRCUIT_BREAKER_MIN_CALLS - 1):
+        breaker.record_result(time.time(), 500)
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+
+def test_breaker_opens_at_the_error_rate(proxy):
+    breaker = open_breaker(proxy)
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_client_errors_are_not_failures(proxy):
+    breaker = proxy.CircuitBreaker("test/m")
+    for _ in range(proxy.CIRCUIT_BREAKER_MIN_CALLS * 2):
+        breaker.record_result(time.time(), 400)
+    assert breaker.state == "closed"
+
+
+def test_slow_calls_are_failures(proxy):
+    breaker = proxy.CircuitBreaker("test/m")
+    for _ in range(proxy.CIRCUIT_BREAKER_MIN_CALLS):
+        breaker.record_result(time.time() - proxy.CIRCUIT_BREAKER_SLOW_CALL - 1, 200)
+    assert breaker.state == "open"
+
+
+def cool_down(proxy, breaker):
+    breaker.opened_at -= proxy.CIRCUIT_BREAKER_COOLDOWN
+
+
+def test_successful_trial_closes_the_breaker(proxy):
+    breaker = open_breaker(proxy)
+    cool_down(proxy, breaker)
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    # Only CIRCUIT_BREAKER_HALF_OPEN_CALLS trial calls go through
+    assert not breaker.allow_request()
+    breaker.record_result(time.time(), 200)
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_opens_the_breaker_again(proxy):
+    breaker = open_breaker(proxy)
+    cool_down(proxy, breaker)
+    assert breaker.allow_request()
+    breaker.record_result(time.time(), None)
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+
+def test_retry_budget_has_a_floor_at_low_traffic(proxy):
+    budget = proxy.RetryBudget()
+    floor = int(proxy.RETRY_BUDGET_MIN_PER_SECOND * proxy.RETRY_BUDGET_WINDOW)
+    assert all(budget.try_acquire() for _ in range(floor))
+    assert not budget.try_acquire()
+    assert budget.stats()["denied"] == 1
+
+
+def test_retry_budget_grows_with_traffic(proxy):
+    budget = proxy.RetryBudget()
+    for _ in range(100):
+        budget.record_request()
+    allowed = int(proxy.RETRY_BUDGET_RATIO * 100 + proxy.RETRY_BUDGET_MIN_PER_SECOND * proxy.RETRY_BUDGET_WINDOW)
+    assert all(budget.try_acquire() for _ in range(allowed))
+    assert not budget.try_acquire()
@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+import multi_ai_proxy
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+def queued_acquire(limiter, order, label):
+    thread = threading.Thread(target=lambda: (limiter.acquire(timeout=5), order.append(label)))
+    thread.start()
+    return thread
+
+
+def test_queue_full(monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy, "CONCURRENCY_MAX_QUEUE", 0)
+    limiter = multi_ai_proxy.ConcurrencyLimiter("p", 1)
+    limiter.acquire()
+    with pytest.raises(multi_ai_proxy.ConcurrencyLimitExceeded) as error:
+        limiter.acquire()
+    assert error.value.code == "queue_full"
+    assert limiter.snapshot()["rejected"] == 1
+
+
+def test_queue_timeout():
+    limiter = multi_ai_proxy.ConcurrencyLimiter("p", 1)
+    limiter.acquire()
+    with pytest.raises(multi_ai_proxy.ConcurrencyLimitExceeded) as error:
+        limiter.acquire(timeout=0.01)
+    assert error.value.code == "queue_timeout"
+    snapshot = limiter.snapshot()
+    assert (snapshot["queued"], snapshot["in_flight"], snapshot["timed_out"]) == (0, 1, 1)
+
+
+def test_release_hands_the_slot_to_the_oldest_waiter():
+    limiter = multi_ai_proxy.ConcurrencyLimiter("p", 1)
+    limiter.acquire()
+    order = []
+    first = queued_acquire(limiter, order, "first")
+    wait_until(lambda: len(limiter.waiters) == 1)
+    second = queued_acquire(limiter, order, "second")
+    wait_until(lambda: len(limiter.waiters) == 2)
+    limiter.release()
+    first.join(2)
+    assert order == ["first"]
+    limiter.release()
+    second.join(2)
+    assert order == ["first", "second"]
+    # The slot moved between requests without ever being free
+    assert limiter.snapshot()["in_flight"] == 1
+    limiter.release()
+    assert limiter.snapshot()["in_flight"] == 0
+
+
+def test_waiter_timing_out_as_the_slot_is_handed_over(monkeypatch):
+    limiter = multi_ai_proxy.ConcurrencyLimiter("p", 1)
+    limiter.acquire()
+
+    class RacingEvent(threading.Event):
+        def wait(self, timeout=None):
+            # The holder releases between the wait timing out and the waiter re-taking the lock
+            limiter.release()
+            return False
+
+    with monkeypatch.context() as patch:
+        patch.setattr(multi_ai_proxy.threading, "Event", RacingEvent)
+        limiter.acquire(timeout=0.01)
+    # The handed-over slot is kept rather than leaked
+    snapshot = limiter.snapshot()
+    assert (snapshot["in_flight"], snapshot["queued"], snapshot["timed_out"]) == (1, 0, 0)
+    limiter.release()
+    assert limiter.snapshot()["in_flight"] == 0
+
+
+def test_provider_slot_is_released_when_the_model_slot_is_not_available(monkeypatch):
+    provider = multi_ai_proxy.ConcurrencyLimiter("p", 2)
+    model = multi_ai_proxy.ConcurrencyLimiter("p/m", 1)
+    monkeypatch.setattr(multi_ai_proxy, "concurrency_limiters", {"p": provider, "p/m": model})
+    model.acquire()
+    with pytest.raises(multi_ai_proxy.ConcurrencyLimitExceeded):
+        multi_ai_proxy.acquire_concurrency("p", "m", timeout=0)
+    assert provider.snapshot()["in_flight"] == 0
+    acquired = multi_ai_proxy.acquire_concurrency("p", "other", timeout=0)
+    assert acquired == [provider]
+    multi_ai_proxy.release_concurrency(acquired)
+
+
+def test_endpoint_with_the_fewest_outstanding_requests_is_chosen():
+    pool = multi_ai_proxy.EndpointPool("p", ["http://a", "http://b"])
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    pool.release(first, failed=False)
+    assert pool.acquire() is first
+
+
+def test_p2c_picks_the_less_loaded_of_two(monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy, "ENDPOINT_BALANCER", "p2c")
+    pool = multi_ai_proxy.EndpointPool("p", ["http://a", "http://b", "http://c"])
+    busy, idle = pool.endpoints[0], pool.endpoints[1]
+    busy.outstanding = 5
+    monkeypatch.setattr(multi_ai_proxy.random, "sample", lambda population, k: [busy, idle])
+    assert pool.acquire() is idle
+
+
+def test_endpoints_at_their_cap_are_skipped():
+    pool = multi_ai_proxy.EndpointPool("p", [{"url": "http://a", "max_concurrency": 1}, {"url": "http://b", "max_concurrency": 2}])
+    chosen = [pool.acquire() for _ in range(3)]
+    assert [endpoint.url for endpoint in chosen].count("http://a") == 1
+    assert pool.acquire() is None
+    pool.release(chosen[0], failed=False)
+    assert pool.acquire() is chosen[0]
+
+
+def test_failing_endpoint_is_ejected_and_recovers(monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy, "ENDPOINT_EJECT_AFTER_FAILURES", 2)
+    pool = multi_ai_proxy.EndpointPool("p", ["http://a", "http://b"])
+    bad, good = pool.endpoints
+    for _ in range(2):
+        bad.outstanding += 1
+        pool.release(bad, failed=True)
+    assert pool.snapshot()[0]["ejected_for"] > 0
+    assert all(pool.acquire() is good for _ in range(3))
+    bad.ejected_until = 0
+    assert pool.acquire() is bad
+
+
+def test_a_success_resets_the_failure_count():
+    pool = multi_ai_proxy.EndpointPool("p", ["http://a", "http://b"])
+    endpoint = pool.endpoints[0]
+    for failed in [True] * (multi_ai_proxy.ENDPOINT_EJECT_AFTER_FAILURES - 1) + [False, True]:
+        endpoint.outstanding += 1
+        pool.release(endpoint, failed)
+    assert endpoint.ejections == 0
+
+
+def test_a_single_endpoint_is_never_ejected():
+    pool = multi_ai_proxy.EndpointPool("p", ["http://a"])
+    endpoint = pool.endpoints[0]
+    for _ in range(multi_ai_proxy.ENDPOINT_EJECT_AFTER_FAILURES * 2):
+        pool.release(endpoint, failed=True)
+    assert endpoint.ejections == 0
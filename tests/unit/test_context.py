@@ -0,0 +1,48 @@
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def request_of(tokens, **extra):
+    # estimate_prompt_tokens counts about 4 characters per token
+    return {"messages": [{"role": "user", "content": "x" * tokens * 4}], **extra}
+
+
+def test_small_prompt_is_unchanged(proxy):
+    request = request_of(100)
+    assert proxy.fit_request_to_context(request, "llama3-8b-8192") == (request, "llama3-8b-8192")
+
+
+def test_max_tokens_is_clamped_to_the_room_left(proxy):
+    request = request_of(6000, max_tokens=8000)
+    fitted, model = proxy.fit_request_to_context(request, "llama3-8b-8192")
+    assert model == "llama3-8b-8192"
+    assert 0 < fitted["max_tokens"] <= 8192 - 6000
+    assert request["max_tokens"] == 8000
+
+
+def test_oversized_prompt_is_rerouted(proxy):
+    fitted, model = proxy.fit_request_to_context(request_of(20000), "llama3-8b-8192", ["llama3-70b-8192", "mixtral-8x7b-32768"])
+    assert model == "mixtral-8x7b-32768"
+
+
+def test_prompt_that_fits_nothing_is_rejected(proxy):
+    with pytest.raises(proxy.ContextLengthExceeded):
+        proxy.fit_request_to_context(request_of(40000), "llama3-8b-8192", ["mixtral-8x7b-32768"])
+
+
+def test_unknown_models_are_left_alone(proxy):
+    request = request_of(40000, max_tokens=100000)
+    assert proxy.fit_request_to_context(request, "unknown-model") == (request, "unknown-model")
+
+
+def test_routing_can_be_turned_off(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, "CONTEXT_ROUTING_ENABLED", False)
+    request = request_of(40000)
+    assert proxy.fit_request_to_context(request, "llama3-8b-8192") == (request, "llama3-8b-8192")
@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+@pytest.fixture
+def tier(proxy, tmp_path, monkeypatch):
+    # A long flush interval so the test decides when writes reach SQLite
+    disk = proxy.DiskCacheTier(str(tmp_path / "cache.db"), 1024 * 1024, 300, flush_interval=3600)
+    monkeypatch.setattr(proxy, "disk_cache_tier", disk)
+    return disk
+
+
+def rows(disk):
+    return disk.conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+
+def test_writes_are_batched_and_visible_before_the_flush(proxy, tier):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60, persistent=True)
+    cache["a"] = {"answer": [1, 2, 3]}
+    assert rows(tier) == 0
+    restarted = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60, persistent=True)
+    assert restarted["a"] == {"answer": [1, 2, 3]}
+    tier.flush()
+    assert rows(tier) == 1
+    assert tier.conn.execute("SELECT encoding FROM cache_entries").fetchone()[0] == "json"
+
+
+def test_delete_queued_after_a_write_wins(proxy, tier):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60, persistent=True)
+    cache["a"] = "value"
+    del cache["a"]
+    tier.flush()
+    assert rows(tier) == 0
+
+
+def test_misses_on_unknown_keys_skip_the_disk(proxy, tier, monkeypatch):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60, persistent=True)
+
+    def unexpected_get(*args):
+        raise AssertionError("disk lookup for a key that was never stored")
+
+    monkeypatch.setattr(tier, "get", unexpected_get)
+    assert "missing" not in cache
+
+
+def test_eviction_does_not_decode_values(proxy, tier, monkeypatch):
+    cache = proxy.ByteBudgetCache("c", max_bytes=8 * 1024, ttl=60)
+
+    def unexpected_decode(entry):
+        raise AssertionError("evicted value was decoded")
+
+    monkeypatch.setattr(cache, "decode_value", unexpected_decode)
+    for index in range(20):
+        cache[f"key-{index}"] = {"text": "x" * 500, "index": index}
+    assert cache.evictions > 0
+
+
+def test_pickled_rows_from_older_versions_are_dropped(proxy, tmp_path):
+    path = str(tmp_path / "old.db")
+    proxy.DiskCacheTier(path, 1024 * 1024, 300, flush_interval=3600)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO cache_entries VALUES ('c', 'k', 'pickle', x'80', 1, 1, 1e12, 0)")
+    conn.commit()
+    conn.close()
+    reopened = proxy.DiskCacheTier(path, 1024 * 1024, 300, flush_interval=3600)
+    assert rows(reopened) == 0
+
+
+def test_compaction_forgets_removed_keys(proxy, tier):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60, persistent=True)
+    cache["expired"] = "old"
+    cache["live"] = "new"
+    tier.flush()
+    tier.conn.execute("UPDATE cache_entries SET expires = 0 WHERE key = 'expired'")
+    tier.conn.commit()
+    tier.compact()
+    assert cache.disk_keys == {"live"}
+
+
+def test_compaction_keeps_keys_written_again(proxy, tier):
+    cache = proxy.ByteBudgetCache("c", max_bytes=64 * 1024, ttl=60, persistent=True)
+    cache["a"] = "old"
+    tier.flush()
+    tier.conn.execute("UPDATE cache_entries SET expires = 0")
+    tier.conn.commit()
+    # Compaction flushes first, so queue the rewrite between that flush and the delete
+    flush = tier.flush
+
+    def flush_then_rewrite():
+        flush()
+        cache["a"] = "new"
+
+    tier.flush = flush_then_rewrite
+    tier.compact()
+    assert "a" in cache.disk_keys
@@ -0,0 +1,217 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+import multi_ai_proxy
+from multi_ai_proxy import ConcurrencyLimitExceeded, UpstreamError
+
+
+class FakePool:
+    def __init__(self, size):
+        self.endpoints = list(range(size))
+
+
+class FakeKeyPool:
+    def available_count(self):
+        return 1
+
+
+class FakeAdapter:
+    supports_streaming = True
+    configured = True
+
+    def __init__(self, provider, endpoints=1, key_pool=None):
+        self.provider = provider
+        self.endpoint_pool = FakePool(endpoints)
+        self.key_pool = key_pool
+
+    def format_request(self, data, model):
+        return {"model": model, "messages": data.get("messages", [])}
+
+
+def content_chunk(text, finish_reason=None):
+    chunk = {"choices": [{"index": 0, "delta": {"content": text}, "finish_reason": finish_reason}]}
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+def answer(text):
+    return [content_chunk(text, "stop"), "data: [DONE]\n\n"]
+
+
+class Dropped:
+    """Stream the given events, then lose the connection"""
+
+    def __init__(self, *events):
+        self.events = events
+
+
+class Upstreams:
+    """Scripted outcomes per model: an exception to raise, a Dropped stream or the text to answer with"""
+
+    def __init__(self, outcomes):
+        self.outcomes = {model: list(results) for model, results in outcomes.items()}
+        self.calls = []
+        self.requests = []
+
+    def stream(self, adapter, request_data, original_model, deadline=None, canceller=None):
+        model = request_data["model"]
+        self.calls.append(model)
+        self.requests.append(request_data)
+        results = self.outcomes[model]
+        outcome = results.pop(0) if len(results) > 1 else results[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, Dropped):
+            yield from outcome.events
+            raise requests.exceptions.ConnectionError("Connection reset by peer")
+        yield from answer(outcome)
+
+
+@pytest.fixture
+def failover(monkeypatch, request):
+    adapters = {"fake": FakeAdapter("fake"), "backup": FakeAdapter("backup")}
+    for name, adapter in adapters.items():
+        monkeypatch.setitem(multi_ai_proxy.PROVIDER_ADAPTERS, name, adapter)
+    monkeypatch.setattr(multi_ai_proxy, "build_failover_chain", lambda *args: [("fake", "a"), ("backup", "b")])
+    monkeypatch.setattr(multi_ai_proxy, "failover_backoff", lambda attempt: 0)
+    monkeypatch.setattr(multi_ai_proxy, "retry_budget", multi_ai_proxy.RetryBudget())
+    monkeypatch.setattr(multi_ai_proxy, "SUPERSEDE_ENABLED", False)
+    monkeypatch.setattr(multi_ai_proxy, "MAX_RETRIES", 1)
+
+    def run(outcomes):
+        upstreams = Upstreams(outcomes)
+        monkeypatch.setattr(multi_ai_proxy, "stream_from_provider", upstreams.stream)
+        response = multi_ai_proxy.app.test_client().post("/v1/chat/completions", json={
+            "model": "fake/a",
+            "messages": [{"role": "user", "content": f"Hello from {request.node.name}"}],
+            "stream": False
+        })
+        run.upstreams = upstreams
+        body = response.get_json()
+        if "error" in body:
+            return body["error"]["code"], upstreams.calls
+        return body["choices"][0]["message"]["content"], upstreams.calls
+
+    run.adapters = adapters
+    return run
+
+
+def unavailable(status=503):
+    return UpstreamError(f"status {status}", status_code=status, retryable=True)
+
+
+def test_fails_over_to_the_next_candidate(failover):
+    content, calls = failover({"a": [unavailable()], "b": ["from b"]})
+    assert content == "from b"
+    assert calls == ["a", "b"]
+
+
+def test_rejected_key_retries_the_same_candidate_with_another_key(failover):
+    failover.adapters["fake"].key_pool = FakeKeyPool()
+    content, calls = failover({"a": [unavailable(429), "from a"], "b": ["from b"]})
+    assert content == "from a"
+    assert calls == ["a", "a"]
+
+
+def test_server_error_retries_another_endpoint_once(failover):
+    failover.adapters["fake"].endpoint_pool = FakePool(2)
+    content, calls = failover({"a": [unavailable(502), unavailable(502), "from a"], "b": ["from b"]})
+    assert content == "from b"
+    assert calls == ["a", "a", "b"]
+
+
+def test_exhausted_retry_budget_stops_failover(failover, monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy.retry_budget, "try_acquire", lambda: False)
+    content, calls = failover({"a": [unavailable()], "b": ["from b"]})
+    assert "status 503" in content
+    assert calls == ["a"]
+
+
+def test_concurrency_limit_skips_without_spending_retry_budget(failover, monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy.retry_budget, "try_acquire", lambda: pytest.fail("retry budget spent"))
+    full = ConcurrencyLimitExceeded("full", "queue_timeout")
+    content, calls = failover({"a": [full], "b": [full]})
+    # One pass only: each candidate already waited out its queue
+    assert calls == ["a", "b"]
+    assert content == "queue_timeout"
+
+
+def test_last_error_is_raised_when_every_pass_fails(failover):
+    content, calls = failover({"a": [unavailable(503)], "b": [unavailable(502)]})
+    assert calls == ["a", "b", "a", "b"]
+    assert "status 502" in content
+
+
+def test_client_disconnect_ends_the_backoff(failover, monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy, "failover_backoff", lambda attempt: 30)
+    cancellers = []
+
+    class RecordingCanceller(multi_ai_proxy.StreamCanceller):
+        def __init__(self):
+            super().__init__()
+            cancellers.append(self)
+
+    monkeypatch.setattr(multi_ai_proxy, "StreamCanceller", RecordingCanceller)
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(zip(("content", "calls"), failover({"a": [unavailable()], "b": [unavailable()]}))))
+    started = time.time()
+    worker.start()
+    while not cancellers:
+        time.sleep(0.01)
+    # Let the first pass fail so the request is sleeping in the backoff
+    time.sleep(0.2)
+    cancellers[0].cancel()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert time.time() - started < 5
+    assert result["calls"] == ["a", "b"]
+
+
+def test_superseding_wakes_registered_waits():
+    token = multi_ai_proxy.SupersedeToken(("client", "m"), ["h"])
+    canceller = multi_ai_proxy.StreamCanceller()
+    token.wakeups.append(canceller.wakeup)
+    token.cancel()
+    assert canceller.wait(0)
+    assert token.cancelled.is_set()
+
+
+def test_continuation_request_appends_the_partial_answer():
+    original = {"messages": [{"role": "user", "content": "Count"}], "max_tokens": 100}
+    continued = multi_ai_proxy.continuation_request(original, "one two " * 10)
+    assert continued["messages"][-1] == {"role": "assistant", "content": "one two " * 10}
+    assert continued["max_tokens"] == 100 - len("one two " * 10) // 4
+    assert len(original["messages"]) == 1
+
+
+def test_dropped_stream_is_continued_and_spliced(failover):
+    content, calls = failover({"a": [Dropped(content_chunk("Hello")), "world"], "b": ["from b"]})
+    assert content == "Helloworld"
+    assert calls == ["a", "a"]
+    assert failover.upstreams.requests[1]["messages"][-1] == {"role": "assistant", "content": "Hello"}
+
+
+def test_finished_stream_is_not_continued_after_a_drop(failover):
+    content, calls = failover({"a": [Dropped(content_chunk("Done."), content_chunk("", "stop"))], "b": ["from b"]})
+    assert calls == ["a"]
+    assert content == "Done."
+
+
+@pytest.mark.parametrize("provider, lines, finish_reason", [
+    ("anthropic", ['data: {"type": "message_delta", "delta": {"stop_reason": "end_turn"}}', 'data: {"type": "message_stop"}'], "stop"),
+    ("anthropic", ['data: {"type": "message_delta", "delta": {"stop_reason": "max_tokens"}}'], "length"),
+    ("ollama", ['{"message": {"role": "assistant", "content": ""}, "done": true, "done_reason": "stop"}'], "stop"),
+])
+def test_terminal_events_carry_a_finish_reason(provider, lines, finish_reason):
+    adapter = multi_ai_proxy.PROVIDER_ADAPTERS.get(provider) or multi_ai_proxy.ProviderAdapter(provider)
+    events = [event for line in lines for event in adapter.convert_stream_line(line, "m")]
+    assert [json.loads(event[6:])["choices"][0]["finish_reason"] for event in events] == [finish_reason]
+
+
+def test_ollama_content_still_streams():
+    adapter = multi_ai_proxy.PROVIDER_ADAPTERS.get("ollama") or multi_ai_proxy.ProviderAdapter("ollama")
+    events = adapter.convert_stream_line('{"message": {"role": "assistant", "content": "Hi"}, "done": false}', "m")
+    assert json.loads(events[0][6:])["choices"][0]["delta"] == {"content": "Hi"}
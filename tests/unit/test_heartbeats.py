@@ -0,0 +1,74 @@
+import json
+import threading
+
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def chunk_event(delta, finish_reason=None):
+    chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+class BlockingResponse:
+    """Stands in for an upstream response whose reader is stuck waiting for the next chunk"""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+def test_strip_role_delta(proxy):
+    stripped = proxy.strip_role_delta(chunk_event({"role": "assistant", "content": "Hi"}))
+    assert json.loads(stripped[6:])["choices"][0]["delta"] == {"content": "Hi"}
+    plain = chunk_event({"content": "Hi"})
+    assert proxy.strip_role_delta(plain) == plain
+    assert proxy.strip_role_delta("data: [DONE]\n\n") is None
+    assert proxy.strip_role_delta('data: {"error": {"message": "x"}}\n\n') is None
+
+
+def test_upstream_role_is_not_sent_twice(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, "HEARTBEAT_ENABLED", True)
+    events = iter([chunk_event({"role": "assistant", "content": ""}), chunk_event({"content": "Hi"}), "data: [DONE]\n\n"])
+    output = "".join(proxy.stream_with_heartbeats((event for event in events), "m", 0))
+    assert output.count('"role"') == 1
+
+
+def test_client_disconnect_closes_upstream_and_stops_the_worker(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, "HEARTBEAT_ENABLED", True)
+    canceller = proxy.StreamCanceller()
+    upstream = canceller.attach(BlockingResponse())
+    finished = threading.Event()
+
+    def events():
+        try:
+            yield chunk_event({"content": "Hi"})
+            # Blocks like a socket read until the response is closed
+            upstream.closed.wait(5)
+            raise ConnectionError("Response ended prematurely")
+        finally:
+            finished.set()
+
+    stream = proxy.stream_with_heartbeats(events(), "m", 0, canceller)
+    next(stream)  # role delta
+    next(stream)  # first token
+    stream.close()
+    assert upstream.closed.is_set()
+    assert finished.wait(2)
+    assert canceller.cancelled
+
+
+def test_responses_attached_after_cancel_are_closed(proxy):
+    canceller = proxy.StreamCanceller()
+    canceller.cancel()
+    late = canceller.attach(BlockingResponse())
+    assert late.closed.is_set()
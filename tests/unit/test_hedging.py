@@ -0,0 +1,45 @@
+import threading
+import time
+
+import multi_ai_proxy
+
+
+class BlockingResponse:
+    """Stands in for an upstream response whose reader is stuck waiting for the next chunk"""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+def test_losing_stream_is_closed_when_the_other_wins(monkeypatch):
+    monkeypatch.setattr(multi_ai_proxy.hedge_budget, "try_acquire", lambda: True)
+    slow_primary = BlockingResponse()
+
+    def start_primary(canceller):
+        canceller.attach(slow_primary)
+        slow_primary.closed.wait(5)
+        yield "data: primary\n\n"
+
+    def start_hedge(canceller):
+        yield "data: hedge\n\n"
+
+    request_canceller = multi_ai_proxy.StreamCanceller()
+    stream = multi_ai_proxy.hedged_stream(start_primary, start_hedge, 0.05, request_canceller)
+    started = time.time()
+    assert next(stream) == "data: hedge\n\n"
+    # The primary's response is closed as soon as the hedge wins, not at the primary's next event
+    assert slow_primary.closed.wait(1)
+    assert time.time() - started < 1
+    stream.close()
+
+
+def test_request_cancel_reaches_both_sides():
+    request_canceller = multi_ai_proxy.StreamCanceller()
+    side = request_canceller.child()
+    response = side.attach(BlockingResponse())
+    request_canceller.cancel()
+    assert response.closed.is_set()
+    assert request_canceller.child().cancelled
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+import multi_ai_proxy
+
+
+def test_unreported_keys_go_first_then_the_most_remaining_budget():
+    pool = multi_ai_proxy.ApiKeyPool("p", ["a", "b"])
+    first = pool.choose()
+    pool.release(first)
+    pool.record_response(first, 200, {"x-ratelimit-remaining-tokens": "100"})
+    # The other key has no report yet
+    second = pool.choose()
+    assert second != first
+    pool.release(second)
+    pool.record_response(second, 200, {"x-ratelimit-remaining-tokens": "500"})
+    assert pool.choose() == second
+
+
+def test_ties_go_to_the_key_with_fewer_requests_in_flight():
+    pool = multi_ai_proxy.ApiKeyPool("p", ["a", "b"])
+    busy = pool.choose()
+    assert pool.choose() != busy
+
+
+def test_rate_limited_key_is_ejected_for_retry_after():
+    pool = multi_ai_proxy.ApiKeyPool("p", ["a", "b"])
+    key = pool.choose()
+    pool.record_response(key, 429, {"retry-after": "120"})
+    pool.release(key)
+    assert pool.available_count() == 1
+    assert 110 < pool.snapshot()[multi_ai_proxy.api_key_label(key)]["ejected_for"] <= 120
+    assert all(pool.choose() != key for _ in range(3))
+
+
+def test_unauthorized_key_is_ejected_for_at_least_the_auth_period():
+    pool = multi_ai_proxy.ApiKeyPool("p", ["a"])
+    pool.record_response(pool.choose(), 401, {"retry-after": "1"})
+    assert pool.snapshot()[multi_ai_proxy.api_key_label("a")]["ejected_for"] > multi_ai_proxy.KEY_EJECT_AUTH_SECONDS - 5
+    # With every key ejected the one returning first is still used
+    assert pool.choose() == "a"
+
+
+class FakeResponse:
+    def __init__(self, status_code, lines=(), headers=None):
+        self.status_code = status_code
+        self.lines = lines
+        self.headers = headers or {}
+        self.text = "error"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def iter_lines(self):
+        for line in self.lines:
+            yield line.encode("utf-8")
+
+
+@pytest.fixture
+def adapter(monkeypatch):
+    adapter = multi_ai_proxy.ProviderAdapter("groq")
+    adapter.key_pool = multi_ai_proxy.ApiKeyPool("groq", ["key-one", "key-two"])
+    monkeypatch.setattr(multi_ai_proxy, "get_circuit_breaker", lambda *args: multi_ai_proxy.CircuitBreaker("test"))
+    return adapter
+
+
+def in_flight(pool):
+    return sum(usage["in_flight"] for usage in pool.usage.values())
+
+
+def test_key_stays_in_flight_until_the_stream_ends(adapter, monkeypatch):
+    chunk = {"choices": [{"index": 0, "delta": {"content": "Hi"}, "finish_reason": None}]}
+    response = FakeResponse(200, [f"data: {json.dumps(chunk)}", "data: [DONE]"])
+    monkeypatch.setattr(multi_ai_proxy.requests, "post", lambda *args, **kwargs: response)
+    stream = multi_ai_proxy.stream_from_provider(adapter, {"model": "m", "messages": []}, "m")
+    next(stream)
+    assert in_flight(adapter.key_pool) == 1
+    stream.close()
+    assert in_flight(adapter.key_pool) == 0
+
+
+def test_rejected_key_is_not_used_for_the_retry(adapter, monkeypatch):
+    used = []
+
+    def post(url, headers=None, **kwargs):
+        used.append(headers["Authorization"])
+        return FakeResponse(429 if len(used) == 1 else 200, ["data: [DONE]"], {"retry-after": "60"})
+
+    monkeypatch.setattr(multi_ai_proxy.requests, "post", post)
+    with pytest.raises(multi_ai_proxy.UpstreamError) as error:
+        list(multi_ai_proxy.stream_from_provider(adapter, {"model": "m", "messages": []}, "m"))
+    assert error.value.status_code == 429
+    assert adapter.key_pool.available_count() == 1
+    monkeypatch.setattr(multi_ai_proxy.time, "sleep", lambda seconds: None)
+    list(multi_ai_proxy.stream_from_provider(adapter, {"model": "m", "messages": []}, "m"))
+    assert used[0] != used[1]
+    assert in_flight(adapter.key_pool) == 0
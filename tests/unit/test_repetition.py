@@ -0,0 +1,89 @@
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+DEFAULT_LIMITS = {"ngram": 8, "loop_words": 150, "echo_words": 0}
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def source_file(marker):
+    """A few hundred words of plausible code, with one line that differs by marker"""
+    lines = [f"def handler_{i}(request):\n    value = compute(request, {i})\n    return respond(value, status={i})\n" for i in range(60)]
+    lines[30] = f"def handler_30(request):\n    return {marker}\n"
+    return "".join(lines)
+
+
+def feed_in_chunks(detector, text, size=7):
+    for start in range(0, len(text), size):
+        reason = detector.feed(text[start:start + size])
+        if reason:
+            return reason, start
+    return None, len(text)
+
+
+def test_rolling_hash_matches_recomputed_hash(proxy):
+    rolling = proxy.RollingNgramHash(3)
+    hashes = [rolling.push(word) for word in "a b c d a b c".split()]
+    assert hashes[:2] == [None, None]
+    # The same three words give the same hash wherever they appear
+    assert hashes[2] == hashes[6]
+    assert hashes[2] != hashes[3]
+
+
+def test_defaults_leave_the_echo_check_off(proxy):
+    assert proxy.REPETITION_LIMITS["default"]["echo_words"] == 0
+
+
+def test_reemitting_an_earlier_file_is_not_cut_off(proxy):
+    messages = [
+        {"role": "user", "content": "Write the handlers"},
+        {"role": "assistant", "content": source_file("None")},
+        {"role": "user", "content": "Change handler_30 to return 404, show the full file"}
+    ]
+    detector = proxy.RepetitionDetector(proxy.REPETITION_LIMITS["default"], messages, 4096)
+    reason, _ = feed_in_chunks(detector, "Here is the full updated file:\n\n" + source_file("404"))
+    assert reason is None
+
+
+def test_a_response_looping_on_itself_is_stopped(proxy):
+    detector = proxy.RepetitionDetector(DEFAULT_LIMITS, [], 4096)
+    text = "I will now apply the same edit to the file again. " * 100
+    reason, position = feed_in_chunks(detector, text)
+    assert reason == "loop"
+    assert position < len(text) // 2
+
+
+def test_a_single_word_loop_is_stopped(proxy):
+    detector = proxy.RepetitionDetector(DEFAULT_LIMITS, [], 4096)
+    assert feed_in_chunks(detector, "and " * 400)[0] == "loop"
+
+
+def test_the_echo_check_fires_when_enabled(proxy):
+    messages = [{"role": "assistant", "content": source_file("None")}]
+    limits = dict(DEFAULT_LIMITS, echo_words=100)
+    detector = proxy.RepetitionDetector(limits, messages, 4096)
+    assert feed_in_chunks(detector, source_file("None"))[0] == "echo"
+
+
+def test_words_split_across_chunks_are_joined(proxy):
+    detector = proxy.RepetitionDetector(dict(DEFAULT_LIMITS, ngram=2, loop_words=1), [], 4096)
+    # "alpha beta" appears twice only if "be" + "ta" are joined into one word
+    for chunk in ["alpha be", "ta gamma alp", "ha be", "ta "]:
+        reason = detector.feed(chunk)
+    assert reason == "loop"
+
+
+def test_abort_events_finish_cleanly_and_count_saved_tokens(proxy):
+    detector = proxy.RepetitionDetector(DEFAULT_LIMITS, [], 1000)
+    feed_in_chunks(detector, "again " * 400)
+    before = proxy.repetition_snapshot()["tokens_saved"]
+    events = list(proxy.repetition_abort_events(detector, "model"))
+    assert events[-1] == "data: [DONE]\n\n"
+    assert '"finish_reason": "stop"' in events[-2]
+    assert "repeating" in events[0]
+    assert proxy.repetition_snapshot()["tokens_saved"] == before + 1000 - detector.chars // 4
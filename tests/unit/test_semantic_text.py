@@ -0,0 +1,34 @@
+import groq_proxy
+
+
+def test_code_and_dates_in_user_text_are_kept():
+    text = "Why does x[10:20] differ on 2024-03-01?"
+    assert groq_proxy.normalize_semantic_text(text) == text
+
+
+def test_dates_and_times_are_stripped_from_system_text():
+    text = "Current time: 2024-03-01 10:20:33"
+    assert groq_proxy.normalize_semantic_text(text, system=True) == "Current time:"
+
+
+def test_cursor_markers_are_stripped_everywhere():
+    assert groq_proxy.normalize_semantic_text("fix <|cursor|>this") == "fix this"
+
+
+def test_direct_requests_with_other_sampling_settings_miss_the_cache(monkeypatch):
+    calls = []
+
+    def completion(request_data, headers, deadline=None):
+        calls.append(request_data)
+        return 200, {"choices": [{"message": {"content": f"answer {len(calls)}"}, "finish_reason": "stop"}]}
+
+    monkeypatch.setattr(groq_proxy, "streamed_groq_completion", completion)
+    monkeypatch.setattr(groq_proxy, "semantic_cache", groq_proxy.SemanticCache(8, groq_proxy.SEMANTIC_CACHE_DIM, 0.95, 60))
+    client = groq_proxy.app.test_client()
+    first = client.post("/direct", json={"message": "Explain decorators", "temperature": 0})
+    hot = client.post("/direct", json={"message": "Explain decorators", "temperature": 1.5})
+    again = client.post("/direct", json={"message": "Explain decorators", "temperature": 0})
+    assert first.get_json()["response"] == "answer 1"
+    assert hot.get_json()["response"] == "answer 2"
+    assert again.get_json()["response"] == "answer 1"
+    assert len(calls) == 2
@@ -0,0 +1,65 @@
+import pytest
+
+import groq_proxy
+import multi_ai_proxy
+
+SYSTEM = {"role": "system", "content": "You are a coding assistant."}
+
+
+@pytest.fixture(params=[groq_proxy, multi_ai_proxy], ids=["groq", "multi"])
+def proxy(request):
+    return request.param
+
+
+def test_first_turns_of_different_chats_are_independent(proxy):
+    tracker = proxy.ConversationTracker()
+    first = tracker.start(proxy.conversation_key([SYSTEM, {"role": "user", "content": "Explain decorators"}], "m", "client"))
+    tracker.start(proxy.conversation_key([SYSTEM, {"role": "user", "content": "Write a SQL query"}], "m", "client"))
+    assert not first.cancelled.is_set()
+
+
+def test_continuing_a_conversation_supersedes_it(proxy):
+    tracker = proxy.ConversationTracker()
+    messages = [SYSTEM, {"role": "user", "content": "Explain decorators"}]
+    first = tracker.start(proxy.conversation_key(messages, "m", "client"))
+    extended = messages + [{"role": "assistant", "content": "A decorator..."}, {"role": "user", "content": "Show an example"}]
+    tracker.start(proxy.conversation_key(extended, "m", "client"))
+    assert first.cancelled.is_set()
+    assert tracker.snapshot()["superseded"] == 1
+
+
+def test_resending_the_same_request_supersedes_it(proxy):
+    tracker = proxy.ConversationTracker()
+    messages = [SYSTEM, {"role": "user", "content": "Explain decorators"}]
+    first = tracker.start(proxy.conversation_key(messages, "m", "client"))
+    tracker.start(proxy.conversation_key(list(messages), "m", "client"))
+    assert first.cancelled.is_set()
+
+
+def test_other_clients_and_models_are_not_superseded(proxy):
+    tracker = proxy.ConversationTracker()
+    messages = [SYSTEM, {"role": "user", "content": "Explain decorators"}]
+    first = tracker.start(proxy.conversation_key(messages, "m", "client"))
+    tracker.start(proxy.conversation_key(messages, "m", "other-client"))
+    tracker.start(proxy.conversation_key(messages, "other-model", "client"))
+    assert not first.cancelled.is_set()
+
+
+def test_shorter_request_does_not_supersede_a_longer_one(proxy):
+    tracker = proxy.ConversationTracker()
+    messages = [SYSTEM, {"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}, {"role": "user", "content": "c"}]
+    first = tracker.start(proxy.conversation_key(messages, "m", "client"))
+    tracker.start(proxy.conversation_key(messages[:2], "m", "client"))
+    assert not first.cancelled.is_set()
+
+
+def test_finished_requests_are_forgotten(proxy):
+    tracker = proxy.ConversationTracker()
+    token = tracker.start(proxy.conversation_key([{"role": "user", "content": "hi"}], "m", "client"))
+    assert tracker.snapshot()["in_flight"] == 1
+    tracker.finish(token)
+    assert tracker.snapshot()["in_flight"] == 0
+
+
+def test_no_messages_has_no_key(proxy):
+    assert proxy.conversation_key([], "m", "client") is None